@@ -0,0 +1,186 @@
+import os
+import socket
+import struct
+import threading
+
+class AdbServerClient(object):
+    TAG = "AdbServerClient"
+
+    DEFAULT_HOST = "127.0.0.1"
+    DEFAULT_PORT = 5037
+
+    # Packet ids of the shell protocol v2
+    SHELL_ID_STDIN = 0
+    SHELL_ID_STDOUT = 1
+    SHELL_ID_STDERR = 2
+    SHELL_ID_EXIT = 3
+    SHELL_ID_CLOSE_STDIN = 4
+
+    def __init__(self, host=None, port=None):
+        if not host:
+            host = os.environ.get("ANDROID_ADB_SERVER_ADDRESS", __class__.DEFAULT_HOST)
+        if not port:
+            port = os.environ.get("ANDROID_ADB_SERVER_PORT", __class__.DEFAULT_PORT)
+        self.host = host
+        self.port = int(port)
+        self.features = {}
+        self.features_lock = threading.Lock()
+
+    def connect(self, timeoutsec=None):
+        return socket.create_connection((self.host, self.port), timeout=timeoutsec)
+
+    @staticmethod
+    def send_request(sock, request):
+        request = request.encode("utf-8")
+        sock.sendall("{:04x}".format(len(request)).encode("ascii") + request)
+
+    @staticmethod
+    def read_exactly(sock, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise RuntimeError("connection closed by the adb server")
+            data += chunk
+        return bytes(data)
+
+    @staticmethod
+    def read_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    @staticmethod
+    def read_payload(sock):
+        size = int(__class__.read_exactly(sock, 4), 16)
+        return __class__.read_exactly(sock, size)
+
+    @staticmethod
+    def read_status(sock):
+        status = __class__.read_exactly(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise RuntimeError(__class__.read_payload(sock).decode("utf-8", errors="replace"))
+        raise RuntimeError("unexpected status from the adb server: {}".format(status))
+
+    def host_request(self, request, timeoutsec=None):
+        with self.connect(timeoutsec) as sock:
+            __class__.send_request(sock, request)
+            __class__.read_status(sock)
+            return __class__.read_payload(sock).decode("utf-8", errors="replace")
+
+    @staticmethod
+    def parse_devices(payload):
+        return [tuple(line.split("\t")[:2]) for line in payload.splitlines() if "\t" in line]
+
+    def devices(self, timeoutsec=None):
+        return __class__.parse_devices(self.host_request("host:devices", timeoutsec=timeoutsec))
+
+    def track_devices(self, timeoutsec=None):
+        # The server keeps the connection and sends the whole device list whenever it changes,
+        # read them with read_devices() and close the socket to stop tracking.
+        sock = self.connect(timeoutsec)
+        try:
+            __class__.send_request(sock, "host:track-devices")
+            __class__.read_status(sock)
+        except:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    @staticmethod
+    def read_devices(sock):
+        payload = __class__.read_payload(sock).decode("utf-8", errors="replace")
+        return __class__.parse_devices(payload)
+
+    def get_features(self, serialno=None, timeoutsec=None):
+        with self.features_lock:
+            if serialno in self.features:
+                return self.features[serialno]
+
+        request = "host-serial:{}:features".format(serialno) if serialno else "host:features"
+        features = self.host_request(request, timeoutsec=timeoutsec).strip().split(",")
+        with self.features_lock:
+            self.features[serialno] = features
+        return features
+
+    def open_service(self, service, serialno=None, timeoutsec=None):
+        sock = self.connect(timeoutsec)
+        try:
+            __class__.send_request(
+                sock, "host:transport:{}".format(serialno) if serialno else "host:transport-any")
+            __class__.read_status(sock)
+            __class__.send_request(sock, service)
+            __class__.read_status(sock)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, cmd, serialno=None, timeoutsec=None):
+        if not "shell_v2" in self.get_features(serialno, timeoutsec=timeoutsec):
+            # stdout and stderr are merged and the exit code is lost without the shell protocol
+            with self.open_service("shell:{}".format(cmd), serialno, timeoutsec) as sock:
+                return __class__.read_all(sock), b"", None
+
+        with self.open_service("shell,v2,raw:{}".format(cmd), serialno, timeoutsec) as sock:
+            sock.sendall(struct.pack("<BI", __class__.SHELL_ID_CLOSE_STDIN, 0))
+            out, err, returncode = [], [], None
+            while True:
+                try:
+                    header = __class__.read_exactly(sock, 5)
+                except RuntimeError:
+                    break
+
+                packet_id, size = struct.unpack("<BI", header)
+                data = __class__.read_exactly(sock, size)
+                if packet_id == __class__.SHELL_ID_STDOUT:
+                    out.append(data)
+                elif packet_id == __class__.SHELL_ID_STDERR:
+                    err.append(data)
+                elif packet_id == __class__.SHELL_ID_EXIT:
+                    returncode = data[0] if len(data) > 0 else None
+                    break
+
+            return b"".join(out), b"".join(err), returncode
+
+    @staticmethod
+    def read_chunks(sock, shell_v2=False):
+        # Yields the stdout of an opened service as it arrives, until the service ends or the
+        # socket is shut down.
+        while True:
+            try:
+                if not shell_v2:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        return
+                    yield chunk
+                    continue
+
+                packet_id, size = struct.unpack("<BI", __class__.read_exactly(sock, 5))
+                data = __class__.read_exactly(sock, size)
+            except (RuntimeError, OSError):
+                return
+
+            if packet_id == __class__.SHELL_ID_EXIT:
+                return
+            if packet_id == __class__.SHELL_ID_STDOUT:
+                yield data
+
+    def open_shell(self, cmd, serialno=None, timeoutsec=None):
+        # Returns the socket of the shell service and whether it speaks the shell protocol v2
+        if not "shell_v2" in self.get_features(serialno, timeoutsec=timeoutsec):
+            return self.open_service("shell:{}".format(cmd), serialno, timeoutsec), False
+
+        sock = self.open_service("shell,v2,raw:{}".format(cmd), serialno, timeoutsec)
+        sock.sendall(struct.pack("<BI", __class__.SHELL_ID_CLOSE_STDIN, 0))
+        return sock, True
+
+    def exec_out(self, cmd, serialno=None, timeoutsec=None):
+        with self.open_service("exec:{}".format(cmd), serialno, timeoutsec) as sock:
+            return __class__.read_all(sock)
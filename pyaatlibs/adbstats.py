@@ -0,0 +1,142 @@
+import bisect
+import collections
+import re
+import threading
+import time
+
+# The latency of the executed adb commands, counted in histograms per device, transport and
+# command kind. The commands slower than the threshold are kept with their argv.
+class AdbCommandStats(object):
+    TAG = "AdbCommandStats"
+
+    # The upper bounds of the histogram buckets in ms, the last bucket is unbounded
+    BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+    DEFAULT_SLOW_THRESHOLD_MS = 1000
+    MAX_SLOW_COMMANDS = 100
+
+    TRANSPORT_USB = "usb"
+    TRANSPORT_WIFI = "wifi"
+    TRANSPORT_HOST = "host"
+
+    def __init__(self, slow_threshold_ms=None):
+        self.slow_threshold_ms = slow_threshold_ms \
+            if slow_threshold_ms is not None else __class__.DEFAULT_SLOW_THRESHOLD_MS
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+            self.slow_commands = collections.deque(maxlen=__class__.MAX_SLOW_COMMANDS)
+
+    @staticmethod
+    def get_transport(serialno):
+        if not serialno:
+            return __class__.TRANSPORT_HOST
+        if re.match("(\\d+\\.){3}\\d+(:\\d+)?$", serialno):
+            return __class__.TRANSPORT_WIFI
+        return __class__.TRANSPORT_USB
+
+    @staticmethod
+    def get_kind(cmd, batch_marker=None):
+        if len(cmd) == 0:
+            return "unknown"
+        if cmd[0] != "shell" or len(cmd) < 2:
+            return cmd[0]
+
+        shell_cmd = " ".join(cmd[1:]).strip()
+        if batch_marker and batch_marker in shell_cmd:
+            return "batch"
+        for prefix, kind in [
+            ("getprop", "getprop"), ("setprop", "setprop"), ("am broadcast", "broadcast"),
+            ("am ", "am"), ("dumpsys", "dumpsys"), ("input", "input"), ("pm ", "pm")]:
+            if shell_cmd.startswith(prefix):
+                return kind
+        return "shell"
+
+    def record(self, serialno, transport, kind, elapsed_ms, cmd=None, failed=False):
+        key = (serialno, transport, kind)
+        with self.lock:
+            if not key in self.entries:
+                self.entries[key] = {
+                    "count": 0,
+                    "failures": 0,
+                    "total_ms": 0.,
+                    "max_ms": 0.,
+                    "histogram": [0] * (len(__class__.BUCKETS_MS) + 1)
+                }
+
+            entry = self.entries[key]
+            entry["count"] += 1
+            entry["failures"] += 1 if failed else 0
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["histogram"][bisect.bisect_left(__class__.BUCKETS_MS, elapsed_ms)] += 1
+
+            is_slow = self.slow_threshold_ms is not None and elapsed_ms > self.slow_threshold_ms
+            if is_slow:
+                self.slow_commands.append({
+                    "time": time.time(),
+                    "serialno": serialno,
+                    "transport": transport,
+                    "kind": kind,
+                    "elapsed_ms": elapsed_ms,
+                    "cmd": list(cmd) if cmd else []
+                })
+
+        return is_slow
+
+    @staticmethod
+    def percentile(histogram, count, q):
+        # The upper bound of the bucket holding the q-quantile
+        if count == 0:
+            return None
+        target = q * count
+        accumulated = 0
+        for idx, n in enumerate(histogram):
+            accumulated += n
+            if accumulated >= target:
+                return __class__.BUCKETS_MS[idx] if idx < len(__class__.BUCKETS_MS) else None
+        return None
+
+    def get_stats(self):
+        with self.lock:
+            entries = {key: dict(entry, histogram=list(entry["histogram"]))
+                for key, entry in self.entries.items()}
+            slow_commands = list(self.slow_commands)
+
+        stats = []
+        for (serialno, transport, kind), entry in entries.items():
+            count = entry["count"]
+            stats.append({
+                "serialno": serialno,
+                "transport": transport,
+                "kind": kind,
+                "count": count,
+                "failures": entry["failures"],
+                "mean_ms": entry["total_ms"] / count,
+                "max_ms": entry["max_ms"],
+                "p50_ms": __class__.percentile(entry["histogram"], count, 0.5),
+                "p90_ms": __class__.percentile(entry["histogram"], count, 0.9),
+                "p99_ms": __class__.percentile(entry["histogram"], count, 0.99),
+                "histogram": dict(zip(__class__.BUCKETS_MS + [float("inf")], entry["histogram"]))
+            })
+
+        return {"commands": stats, "slow_commands": slow_commands}
+
+    def dump(self):
+        stats = self.get_stats()
+        lines = ["{:<24} {:<5} {:<10} {:>7} {:>6} {:>9} {:>9} {:>9}".format(
+            "serialno", "trans", "kind", "count", "fail", "mean(ms)", "p90(ms)", "max(ms)")]
+        for entry in sorted(stats["commands"], key=lambda e: (str(e["serialno"]), e["kind"])):
+            lines.append("{:<24} {:<5} {:<10} {:>7} {:>6} {:>9.1f} {:>9} {:>9.1f}".format(
+                str(entry["serialno"]), entry["transport"], entry["kind"], entry["count"],
+                entry["failures"], entry["mean_ms"], str(entry["p90_ms"]), entry["max_ms"]))
+
+        if len(stats["slow_commands"]) > 0:
+            lines.append("slow commands (> {} ms):".format(self.slow_threshold_ms))
+        for slow_command in stats["slow_commands"]:
+            lines.append("  {:.1f} ms [{}] {}".format(
+                slow_command["elapsed_ms"], slow_command["serialno"], slow_command["cmd"]))
+
+        return lines
@@ -1,8 +1,20 @@
+import atexit
 import subprocess
 import threading
 import signal
 import re
+import socket
+import uuid
 from pyaatlibs.logger import Logger
+from pyaatlibs.adbclient import AdbServerClient
+from pyaatlibs.adbstats import AdbCommandStats
+from pyaatlibs.dumpsys import DumpsysParser
+from pyaatlibs.wifiadbcache import WifiAdbCache
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 class AdbScreenRecordingThread(threading.Thread):
     def __init__(self, serialno):
@@ -26,13 +38,423 @@ class AdbScreenRecordingThread(threading.Thread):
         self.proc = subprocess.Popen(
             cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
+class AdbShellScript(object):
+    SENTINEL_PREFIX = "__PYAAT_SENTINEL"
+
+    @staticmethod
+    def new_sentinel():
+        return "{}_{}__".format(AdbShellScript.SENTINEL_PREFIX, uuid.uuid4().hex)
+
+    @staticmethod
+    def wrap(cmd, sentinel, index=0):
+        # The command runs in a subshell with a closed stdin, so it can neither consume the
+        # following lines of the script nor terminate the shell by calling "exit". An empty line
+        # is printed ahead of each sentinel to make sure it always starts at a new line.
+        return (
+            "(\n{cmd}\n) </dev/null\n"
+            "__pyaat_rc=$?; echo \"\" >&2; echo \"{sentinel} {idx}\" >&2; "
+            "echo \"\"; echo \"{sentinel} {idx} $__pyaat_rc\"\n").format(
+                cmd=cmd, sentinel=sentinel, idx=index)
+
+    @staticmethod
+    def build(cmds, sentinel):
+        return "".join(AdbShellScript.wrap(cmd, sentinel, idx) for idx, cmd in enumerate(cmds))
+
+    @staticmethod
+    def split(out, err, sentinel, num_cmds):
+        # Returns (stdout, stderr, exit code) of each command, the exit code is None when the
+        # script was interrupted before the command finished.
+        results = []
+        out_pos, err_pos = 0, 0
+        for idx in range(num_cmds):
+            out_end = "\n{} {} ".format(sentinel, idx)
+            err_end = "\n{} {}\n".format(sentinel, idx)
+            out_idx = out.find(out_end, out_pos)
+            if out_idx < 0:
+                results.append((out[out_pos:], err[err_pos:], None))
+                out_pos, err_pos = len(out), len(err)
+                continue
+
+            body = out[out_pos:out_idx]
+            eol = out.find("\n", out_idx + len(out_end))
+            eol = len(out) if eol < 0 else eol
+            returncode = int(out[out_idx+len(out_end):eol])
+            out_pos = eol + 1
+
+            if body.endswith(err_end):
+                # Devices without the shell protocol v2 merge stderr into stdout
+                results.append((body[:-len(err_end)], "", returncode))
+                continue
+
+            err_idx = err.find(err_end, err_pos)
+            if err_idx < 0:
+                results.append((body, err[err_pos:], returncode))
+                err_pos = len(err)
+                continue
+
+            results.append((body, err[err_pos:err_idx], returncode))
+            err_pos = err_idx + len(err_end)
+
+        return results
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", errors="replace")
+        return data.replace("\r\n", "\n")
+
+class AdbStream(object):
+    def __init__(
+        self, cmd, serialno=None, binary=False, chunksize=65536, client=None, timeoutsec=None,
+        semaphores=[]):
+        self.cmd = cmd
+        self.binary = binary
+        self.timeoutsec = timeoutsec
+        self.timedout = False
+        self.timer = None
+        self.proc = None
+        self.sock = None
+
+        # The stream counts as an adb command in flight until it ends, see Adb._execute()
+        self.semaphores = []
+        self.semaphores_lock = threading.Lock()
+        for semaphore in semaphores:
+            semaphore.acquire()
+            self.semaphores.append(semaphore)
+        try:
+            self._open(cmd, serialno, chunksize, client)
+        except:
+            self._release()
+            raise
+
+        # The command is stopped once the deadline has passed, see _expire()
+        if timeoutsec is not None:
+            self.timer = threading.Timer(timeoutsec, self._expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _open(self, cmd, serialno, chunksize, client):
+        if client is not None:
+            if cmd[0] == "exec-out":
+                self.sock = client.open_service(
+                    "exec:{}".format(" ".join(cmd[1:])), serialno, self.timeoutsec)
+                self.chunks = AdbServerClient.read_chunks(self.sock)
+            else:
+                self.sock, shell_v2 = client.open_shell(
+                    " ".join(cmd[1:]), serialno, self.timeoutsec)
+                self.chunks = AdbServerClient.read_chunks(self.sock, shell_v2=shell_v2)
+            self.sock.settimeout(None)
+            return
+
+        cmd_prefix = ["adb"]
+        if serialno:
+            cmd_prefix += ["-s", serialno]
+        self.proc = subprocess.Popen(
+            cmd_prefix + cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.chunks = iter(lambda: self.proc.stdout.read1(chunksize), b"")
+
+    def _expire(self):
+        # Ends the iteration as close() does, and leaves the cleanup to close()
+        self.timedout = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        yield from self._iter_output()
+        self._release()
+        if self.timedout:
+            raise subprocess.TimeoutExpired(self.cmd, self.timeoutsec)
+
+    def _iter_output(self):
+        if self.binary:
+            yield from self.chunks
+            return
+
+        remaining = b""
+        for chunk in self.chunks:
+            lines = (remaining + chunk).split(b"\n")
+            remaining = lines.pop()
+            for line in lines:
+                yield AdbShellScript.decode(line).rstrip("\r")
+
+        if len(remaining) > 0:
+            yield AdbShellScript.decode(remaining)
+
+    def _release(self):
+        with self.semaphores_lock:
+            semaphores, self.semaphores = self.semaphores, []
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+
+    def close(self):
+        # It can be called from another thread to stop the iteration.
+        if self.timer is not None:
+            self.timer.cancel()
+
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc.stdout.close()
+
+        self._release()
+
+class AdbShellSession(object):
+    TAG = "AdbShellSession"
+    CLOSED_ERROR = "error: adb shell session closed\n"
+
+    def __init__(self, serialno):
+        self.serialno = serialno
+        self.proc = None
+        self.out_q = None
+        self.err_q = None
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _connect(self):
+        cmd = ["adb", "-s", self.serialno, "shell"]
+        Logger.log(self.TAG, "open the shell session with the command '{}'".format(cmd))
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.out_q = queue.Queue()
+        self.err_q = queue.Queue()
+        for stream, q in [(self.proc.stdout, self.out_q), (self.proc.stderr, self.err_q)]:
+            th = threading.Thread(target=self._read_lines, args=(stream, q))
+            th.daemon = True
+            th.start()
+
+    @staticmethod
+    def _read_lines(stream, q):
+        try:
+            for line in iter(stream.readline, b""):
+                q.put(line)
+        except (OSError, ValueError):
+            pass
+        q.put(None)
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.stdin.close()
+        except (OSError, ValueError):
+            pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def execute(self, cmd, timeoutsec=None):
+        with self.lock:
+            for retry in range(2):
+                if not self.is_alive():
+                    self.close()
+                    self._connect()
+
+                sentinel = AdbShellScript.new_sentinel()
+                try:
+                    self.proc.stdin.write(AdbShellScript.wrap(cmd, sentinel).encode("utf-8"))
+                    self.proc.stdin.flush()
+                except (OSError, ValueError):
+                    # The transport has dropped before the command was delivered, so it is safe
+                    # to reconnect and send it again.
+                    Logger.log(self.TAG, "the session of '{}' is broken, reconnect".format(
+                        self.serialno))
+                    self.close()
+                    continue
+
+                return self._receive(cmd, sentinel, timeoutsec)
+
+        return "", AdbShellSession.CLOSED_ERROR, None
+
+    def _get_line(self, q, deadline, cmd, timeoutsec):
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            # The output of the next command cannot be told apart from this one anymore
+            self.close()
+            raise subprocess.TimeoutExpired(cmd, timeoutsec)
+
+    def _receive(self, cmd, sentinel, timeoutsec):
+        deadline = None if timeoutsec is None else time.time() + timeoutsec
+        out_lines = []
+        err_merged = False
+        err_end = "{} 0\n".format(sentinel).encode("utf-8")
+        out_end = "{} 0 ".format(sentinel).encode("utf-8")
+        while True:
+            line = self._get_line(self.out_q, deadline, cmd, timeoutsec)
+            if line is None:
+                self.close()
+                return AdbShellScript.decode(b"".join(out_lines)), \
+                    AdbShellSession.CLOSED_ERROR, None
+            if line.startswith(out_end):
+                returncode = int(line[len(out_end):].strip())
+                break
+            if line == err_end:
+                # Devices without the shell protocol v2 merge stderr into stdout, so only the new
+                # line printed ahead of the sentinel is removed
+                err_merged = True
+                out_lines = [b"".join(out_lines)[:-1]]
+                continue
+            out_lines.append(line)
+
+        out = AdbShellScript.decode(b"".join(out_lines)[:-1])
+        if err_merged:
+            return out, "", returncode
+
+        err_lines = []
+        while True:
+            line = self._get_line(self.err_q, deadline, cmd, timeoutsec)
+            if line is None:
+                self.close()
+                return out, AdbShellSession.CLOSED_ERROR, returncode
+            if line == err_end:
+                break
+            err_lines.append(line)
+
+        return out, AdbShellScript.decode(b"".join(err_lines)[:-1]), returncode
+
+class AdbDeviceTracker(threading.Thread):
+    TAG = "AdbDeviceTracker"
+
+    def __init__(self, client=None, period_sec=1.0):
+        super(AdbDeviceTracker, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.period_sec = period_sec
+        self.stoprequest = threading.Event()
+        self.changed = threading.Condition()
+        self.devices = None
+        self.sock = None
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with self.changed:
+            self.changed.notify_all()
+        super(AdbDeviceTracker, self).join(timeout)
+
+    def is_ready(self):
+        return self.is_alive() and self.devices is not None
+
+    def get_devices(self):
+        with self.changed:
+            return [serialno for serialno, state in self.devices.items() if state == "device"]
+
+    def wait_for_ready(self, timeoutsec):
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: self.devices is not None or self.stoprequest.is_set(), timeoutsec)
+
+    def wait_for_devices(self, predicate, timeoutsec):
+        # Waits until predicate(the available devices) holds. It is checked under the lock, so a
+        # change right before the wait is not missed.
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: self.stoprequest.is_set() or \
+                    (self.devices is not None and predicate(self.get_devices())), timeoutsec)
+
+    def _update(self, devices):
+        devices = dict(devices)
+        with self.changed:
+            if devices == self.devices:
+                return
+            self.devices = devices
+
+        Logger.log(self.TAG, "devices: {}".format(devices))
+
+        # Resolve the serialno of new wifi adb devices before notifying the waiters
+        Adb._update_wifi_adb_devices(self.get_devices(), tolog=False)
+        with self.changed:
+            self.changed.notify_all()
+
+    def _track(self):
+        self.sock = self.client.track_devices(timeoutsec=self.period_sec)
+        try:
+            while not self.stoprequest.is_set():
+                self._update(AdbServerClient.read_devices(self.sock))
+        finally:
+            self.sock.close()
+            self.sock = None
+
+    def _poll(self):
+        out, _ = Adb._execute(["devices"], tolog=False)
+        self._update([line.split()[:2] for line in out.splitlines()[1:] if len(line.split()) > 1])
+
+    def run(self):
+        while not self.stoprequest.is_set():
+            if self.client:
+                try:
+                    self._track()
+                    continue
+                except (RuntimeError, OSError) as e:
+                    if self.stoprequest.is_set():
+                        break
+                    Logger.log(
+                        self.TAG, "track-devices is unavailable ({}), poll instead".format(e))
+
+            try:
+                self._poll()
+            except Exception as e:
+                Logger.log(self.TAG, "failed to poll devices: {}".format(e))
+            self.stoprequest.wait(self.period_sec)
+
 class Adb(object):
     HAS_BEEN_INIT = False
     SCREEN_RECORDING_THREADS = {}
     SERIAL_TO_IP_INFO = {}
+    WIFI_ADB_CACHE = None
+    SHELL_SESSION_ENABLED = False
+    SHELL_SESSIONS = {}
+    SHELL_SESSIONS_LOCK = threading.Lock()
+
+    BACKEND_CLI = "cli"
+    BACKEND_NATIVE = "native"
+    BACKEND = BACKEND_CLI
+    NATIVE_CLIENT = None
+    DEVICE_TRACKER = None
+    COMMAND_SEMAPHORE = None
+    # The cap of the adb commands of the current thread on top of COMMAND_SEMAPHORE, which is
+    # shared with the other threads working for the same caller, e.g. a DeviceGroup
+    THREAD_COMMAND_LIMIT = threading.local()
+    COMMAND_STATS = AdbCommandStats()
 
     TAG = "Adb"
 
+    # The errors of adb itself when the device cannot be reached, rather than the ones printed by
+    # the commands on the device
+    TRANSPORT_ERROR_PATTERN = re.compile(
+        "^(adb: )?error: (device '.*' not found|device offline|device unauthorized|closed|"
+        "no devices/emulators found|protocol fault.*|failed to connect.*)\\s*$")
+
     @staticmethod
     def init():
         Adb._execute("start-server")
@@ -43,6 +465,166 @@ class Adb(object):
         if not Adb.HAS_BEEN_INIT:
             Adb.init()
 
+    @staticmethod
+    def finalize():
+        Adb.stop_device_tracker()
+        Adb.close_shell_sessions()
+        Adb.dump_stats()
+        # Avoid dumping the same stats again when it is called both explicitly and at exit
+        Adb.reset_stats()
+
+    @staticmethod
+    def stats():
+        return Adb.COMMAND_STATS.get_stats()
+
+    @staticmethod
+    def reset_stats():
+        Adb.COMMAND_STATS.reset()
+
+    @staticmethod
+    def dump_stats():
+        if len(Adb.COMMAND_STATS.entries) == 0:
+            return
+
+        Logger.log(Adb.TAG, "command stats:")
+        for line in Adb.COMMAND_STATS.dump():
+            Logger.log(Adb.TAG, line)
+
+    @staticmethod
+    def set_slow_command_threshold(threshold_ms=None):
+        # The commands slower than threshold_ms are logged with their argv, None disables it
+        Adb.COMMAND_STATS.slow_threshold_ms = threshold_ms
+
+    @staticmethod
+    def _record_command(cmd, serialno, elapsed_ms, failed=False):
+        transport = AdbCommandStats.get_transport(serialno)
+        if transport == AdbCommandStats.TRANSPORT_WIFI:
+            serialno = next((k for k, v in list(Adb.SERIAL_TO_IP_INFO.items()) \
+                if Adb._wifi_adb_addr(k) == serialno), serialno)
+
+        kind = AdbCommandStats.get_kind(cmd, batch_marker=AdbShellScript.SENTINEL_PREFIX)
+        if Adb.COMMAND_STATS.record(serialno, transport, kind, elapsed_ms, cmd, failed):
+            Logger.log(Adb.TAG, "slow command: {:.1f} ms [{}] {}".format(
+                elapsed_ms, serialno, cmd), level=Logger.Verbosity.WARN)
+
+    @staticmethod
+    def start_device_tracker(track_devices=True, period_sec=1.0, timeoutsec=5):
+        if Adb.DEVICE_TRACKER is not None:
+            return
+
+        Adb._check_init()
+        client = None
+        if track_devices:
+            client = Adb.NATIVE_CLIENT if Adb.NATIVE_CLIENT else AdbServerClient()
+        Adb.DEVICE_TRACKER = AdbDeviceTracker(client=client, period_sec=period_sec)
+        Adb.DEVICE_TRACKER.start()
+        Adb.DEVICE_TRACKER.wait_for_ready(timeoutsec)
+
+    @staticmethod
+    def stop_device_tracker():
+        if Adb.DEVICE_TRACKER is None:
+            return
+
+        Adb.DEVICE_TRACKER.join(timeout=10)
+        Adb.DEVICE_TRACKER = None
+
+    @staticmethod
+    def enable_wifi_adb_cache(enabled=True, path=None):
+        # Persists SERIAL_TO_IP_INFO in a file shared by all processes on the host, so that the
+        # known Wifi adb devices are not probed again by every new process.
+        if not enabled:
+            Adb.WIFI_ADB_CACHE = None
+            return
+
+        Adb.WIFI_ADB_CACHE = WifiAdbCache(path)
+        Adb._sync_wifi_adb_cache()
+
+    @staticmethod
+    def _sync_wifi_adb_cache():
+        if Adb.WIFI_ADB_CACHE is not None:
+            Adb.SERIAL_TO_IP_INFO.update(Adb.WIFI_ADB_CACHE.get_ip_infos())
+
+    @staticmethod
+    def _set_wifi_adb_ip_info(serialno, ip_info):
+        # An address belongs to one device only, the other mappings of it are stale.
+        for stale_serialno in [k for k, v in Adb.SERIAL_TO_IP_INFO.items() \
+            if k != serialno and v == ip_info]:
+            Adb._remove_wifi_adb_ip_info(stale_serialno)
+
+        Adb.SERIAL_TO_IP_INFO[serialno] = ip_info
+        if Adb.WIFI_ADB_CACHE is not None:
+            Adb.WIFI_ADB_CACHE.update(serialno, ip_info)
+
+    @staticmethod
+    def _remove_wifi_adb_ip_info(serialno):
+        Adb.SERIAL_TO_IP_INFO.pop(serialno, None)
+        if Adb.WIFI_ADB_CACHE is not None:
+            Adb.WIFI_ADB_CACHE.remove(serialno)
+
+    @staticmethod
+    def _invalidate_wifi_adb_ip_info(serialno):
+        # The device will be probed again once it shows up in the device list. The in-memory
+        # mapping is kept as before when the cache is disabled.
+        if Adb.WIFI_ADB_CACHE is None:
+            return
+
+        Adb.SERIAL_TO_IP_INFO.pop(serialno, None)
+        Adb.WIFI_ADB_CACHE.invalidate(serialno)
+
+    @staticmethod
+    def is_transport_error(err):
+        return Adb.TRANSPORT_ERROR_PATTERN.match(err) is not None
+
+    @staticmethod
+    def enable_shell_session(enabled=True):
+        Adb.SHELL_SESSION_ENABLED = enabled
+        if not enabled:
+            Adb.close_shell_sessions()
+
+    @staticmethod
+    def set_max_concurrent_commands(num_commands=None):
+        # Caps the number of adb commands in flight across all threads to ease the adb server
+        Adb.COMMAND_SEMAPHORE = threading.BoundedSemaphore(num_commands) if num_commands else None
+
+    @staticmethod
+    def set_thread_command_limit(semaphore=None):
+        # Returns the previous semaphore of the current thread, to be restored by the caller
+        saved = getattr(Adb.THREAD_COMMAND_LIMIT, "semaphore", None)
+        Adb.THREAD_COMMAND_LIMIT.semaphore = semaphore
+        return saved
+
+    @staticmethod
+    def _command_semaphores():
+        # They are always acquired in this order, so that no thread waits for the other in a cycle
+        semaphores = [getattr(Adb.THREAD_COMMAND_LIMIT, "semaphore", None), Adb.COMMAND_SEMAPHORE]
+        return [semaphore for semaphore in semaphores if semaphore is not None]
+
+    @staticmethod
+    def set_backend(backend, host=None, port=None):
+        if not backend in [Adb.BACKEND_CLI, Adb.BACKEND_NATIVE]:
+            raise ValueError("unknown adb backend '{}'".format(backend))
+
+        Adb.BACKEND = backend
+        Adb.NATIVE_CLIENT = AdbServerClient(host=host, port=port) \
+            if backend == Adb.BACKEND_NATIVE else None
+
+    @staticmethod
+    def close_shell_sessions():
+        with Adb.SHELL_SESSIONS_LOCK:
+            sessions = list(Adb.SHELL_SESSIONS.values())
+            Adb.SHELL_SESSIONS.clear()
+
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+    @staticmethod
+    def _get_shell_session(serialno):
+        with Adb.SHELL_SESSIONS_LOCK:
+            if not serialno in Adb.SHELL_SESSIONS:
+                Adb.SHELL_SESSIONS[serialno] = AdbShellSession(serialno)
+            return Adb.SHELL_SESSIONS[serialno]
+
     @classmethod
     def _log(child, msg, tolog):
         if not tolog:
@@ -53,20 +635,88 @@ class Adb(object):
     def execute(child, cmd, serialno=None, tolog=True, timeoutsec=None):
         child._check_init()
 
+        resolved_serialno = child._resolve_serialno(serialno, tolog=tolog)
+        out, err = child._execute(
+            cmd=cmd, serialno=resolved_serialno, tolog=tolog, timeoutsec=timeoutsec)
+        if resolved_serialno != serialno and Adb.is_transport_error(err):
+            Adb._invalidate_wifi_adb_ip_info(serialno)
+
+        return out, err
+
+    @classmethod
+    def _resolve_serialno(child, serialno, tolog=True):
         if serialno and not serialno in child.get_devices(tolog=tolog) and \
             child.is_device_available(serialno=serialno, tolog=tolog):
-            ip_info = Adb.SERIAL_TO_IP_INFO[serialno]
-            ip_addr = "{}:{}".format(ip_info["addr"], ip_info["port"])
+            ip_addr = Adb._wifi_adb_addr(serialno)
             child._log("use Wifi adb: addr[{}] of serialno '{}'".format(ip_addr, serialno), tolog)
             serialno = ip_addr
 
-        return child._execute(cmd=cmd, serialno=serialno, tolog=tolog, timeoutsec=timeoutsec)
+        return serialno
+
+    @classmethod
+    def stream(
+        child, cmd, serialno=None, binary=False, chunksize=65536, tolog=True, timeoutsec=None):
+        # Iterates over the output of "shell" or "exec-out" commands as it arrives, either as
+        # decoded lines or raw byte chunks. Leaving the iteration early and calling close()
+        # terminates the command. With timeoutsec, the command is terminated once the deadline
+        # has passed and the iteration raises subprocess.TimeoutExpired as execute() does, e.g.
+        #
+        #   with Adb.stream(["shell", "dumpsys audio"], serialno=serialno) as stream:
+        #       for line in stream:
+        #           ...
+        child._check_init()
+        if not isinstance(cmd, list):
+            cmd = [cmd]
+
+        serialno = child._resolve_serialno(serialno, tolog=tolog)
+        child._log("stream: {}".format(cmd), tolog)
+        client = Adb.NATIVE_CLIENT \
+            if Adb.BACKEND == Adb.BACKEND_NATIVE and cmd[0] in ["shell", "exec-out"] else None
+        return AdbStream(
+            cmd, serialno=serialno, binary=binary, chunksize=chunksize, client=client,
+            timeoutsec=timeoutsec, semaphores=Adb._command_semaphores())
 
     @classmethod
     def _execute(child, cmd, serialno=None, tolog=True, timeoutsec=None):
         if not isinstance(cmd, list):
             cmd = [cmd]
 
+        semaphores = Adb._command_semaphores()
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            return child._execute_timed(
+                cmd, serialno=serialno, tolog=tolog, timeoutsec=timeoutsec)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    @classmethod
+    def _execute_timed(child, cmd, serialno=None, tolog=True, timeoutsec=None):
+        start = time.perf_counter()
+        failed = True
+        try:
+            out, err = child._execute_command(
+                cmd, serialno=serialno, tolog=tolog, timeoutsec=timeoutsec)
+            failed = err.startswith("error:")
+            return out, err
+        finally:
+            Adb._record_command(cmd, serialno, (time.perf_counter() - start) * 1000., failed)
+
+    @classmethod
+    def _execute_command(child, cmd, serialno=None, tolog=True, timeoutsec=None):
+        if Adb.SHELL_SESSION_ENABLED and serialno and len(cmd) > 1 and cmd[0] == "shell":
+            child._log("exec (session): {}".format(cmd), tolog)
+            out, err, _ = Adb._get_shell_session(serialno).execute(
+                " ".join(cmd[1:]), timeoutsec=timeoutsec)
+            return out, err
+
+        if Adb.BACKEND == Adb.BACKEND_NATIVE:
+            result = child._execute_native(cmd=cmd, serialno=serialno, timeoutsec=timeoutsec)
+            if result is not None:
+                child._log("exec (native): {}".format(cmd), tolog)
+                return result
+
         cmd_prefix = ["adb"]
         if serialno:
             cmd_prefix += ["-s", serialno]
@@ -80,45 +730,112 @@ class Adb(object):
         return out, err
 
     @classmethod
-    def get_devices(child, **kwargs):
-        out, _ = child.execute(["devices"], **kwargs)
+    def dumpsys(child, service, serialno=None, section_prefix=None, header_pattern=None, **kwargs):
+        # With section_prefix, the output is read only until the sections have passed.
+        with child.stream(
+            ["shell", "dumpsys {}".format(service)], serialno=serialno, **kwargs) as stream:
+            return DumpsysParser.from_lines(
+                stream, section_prefix=section_prefix, header_pattern=header_pattern)
+
+    @classmethod
+    def execute_batch(child, serialno, cmds, tolog=True, timeoutsec=None):
+        if len(cmds) == 0:
+            return []
+
+        sentinel = AdbShellScript.new_sentinel()
+        child._log("exec batch: {}".format(cmds), tolog)
+        out, err = child.execute(
+            ["shell", AdbShellScript.build(cmds, sentinel)], serialno=serialno, tolog=False,
+            timeoutsec=timeoutsec)
+
+        return AdbShellScript.split(out, err, sentinel, len(cmds))
+
+    @classmethod
+    def _execute_native(child, cmd, serialno=None, timeoutsec=None):
+        # Returns None for the commands that only the adb CLI can handle (install, pull, etc.)
+        client = Adb.NATIVE_CLIENT
+        try:
+            if cmd == ["devices"]:
+                lines = ["List of devices attached"]
+                lines += ["{}\t{}".format(*device) for device in client.devices(timeoutsec)]
+                return "\n".join(lines) + "\n\n", ""
+
+            if len(cmd) > 1 and cmd[0] == "shell":
+                out, err, _ = client.shell(" ".join(cmd[1:]), serialno, timeoutsec)
+                return AdbShellScript.decode(out), AdbShellScript.decode(err)
+
+            if len(cmd) > 1 and cmd[0] == "exec-out":
+                out = client.exec_out(" ".join(cmd[1:]), serialno, timeoutsec)
+                return AdbShellScript.decode(out), ""
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(cmd, timeoutsec)
+        except ConnectionRefusedError:
+            # The adb server is not running, let the adb CLI start it.
+            return None
+        except (RuntimeError, OSError) as e:
+            return "", "error: {}\n".format(e)
+
+        return None
+
+    @staticmethod
+    def parse_devices(out):
         devices = list(map(lambda x: x.strip(), out.splitlines()))
         del devices[0]
         devices = [x.split()[0] for x in devices if len(x) > 0 and x.split()[1] == "device"]
         return devices
 
     @classmethod
-    def is_device_available(child, serialno, tolog=True, **kwargs):
-        devices = child.get_devices(tolog=tolog, **kwargs)
+    def get_devices(child, **kwargs):
+        if Adb.DEVICE_TRACKER is not None and Adb.DEVICE_TRACKER.is_ready():
+            return Adb.DEVICE_TRACKER.get_devices()
 
-        # establish unknown ip
+        out, _ = child.execute(["devices"], **kwargs)
+        return Adb.parse_devices(out)
+
+    @staticmethod
+    def _wifi_adb_addr(serialno):
+        if not serialno in Adb.SERIAL_TO_IP_INFO or not "port" in Adb.SERIAL_TO_IP_INFO[serialno]:
+            return None
+
+        ip_info = Adb.SERIAL_TO_IP_INFO[serialno]
+        return "{}:{}".format(ip_info["addr"], ip_info["port"])
+
+    @staticmethod
+    def _unknown_wifi_adb_devices(devices):
+        synced = False
         for device in devices:
             m = re.match("(?P<addr>(\\d+\\.?)+)(:(?P<port>\\d+))?$", device)
             if not m:
                 continue
 
             ip_info = m.groupdict()
+            if not synced and not ip_info in Adb.SERIAL_TO_IP_INFO.values():
+                # another process might have probed it already
+                Adb._sync_wifi_adb_cache()
+                synced = True
             if ip_info in Adb.SERIAL_TO_IP_INFO.values():
                 continue
 
+            yield device, ip_info
+
+    @classmethod
+    def _update_wifi_adb_devices(child, devices, tolog=True, **kwargs):
+        # establish unknown ip
+        for device, ip_info in list(Adb._unknown_wifi_adb_devices(devices)):
             out, err = child.execute(
                 ["shell", "getprop ro.serialno"], serialno=device, tolog=tolog, **kwargs)
             if len(err) > 0:
                 continue
 
-            Adb.SERIAL_TO_IP_INFO[out.strip()] = ip_info
+            Adb._set_wifi_adb_ip_info(out.strip(), ip_info)
             child._log("update wifi adb device: {}, {}".format(out.strip(), ip_info), tolog)
 
-        if serialno in devices:
-            return True
-
-        if serialno in Adb.SERIAL_TO_IP_INFO and "port" in Adb.SERIAL_TO_IP_INFO[serialno]:
-            ip_info = Adb.SERIAL_TO_IP_INFO[serialno]
-            ip_addr = "{}:{}".format(ip_info["addr"], ip_info["port"])
-            if ip_addr in devices:
-                return True
+    @classmethod
+    def is_device_available(child, serialno, tolog=True, **kwargs):
+        devices = child.get_devices(tolog=tolog, **kwargs)
+        child._update_wifi_adb_devices(devices, tolog=tolog, **kwargs)
 
-        return False
+        return serialno in devices or Adb._wifi_adb_addr(serialno) in devices
 
     @classmethod
     def get_wifi_status(child, serialno, tolog=True, **kwargs):
@@ -191,11 +908,10 @@ class Adb(object):
         if "IP" in wifi_status:
             m = re.match("/(?P<addr>(\\d+\\.?)+)", wifi_status["IP"])
             if m is not None:
-                Adb.SERIAL_TO_IP_INFO[serialno] = dict(m.groupdict())
+                Adb._set_wifi_adb_ip_info(serialno, dict(m.groupdict()))
                 return True
 
-        if serialno in Adb.SERIAL_TO_IP_INFO:
-            del Adb.SERIAL_TO_IP_INFO[serialno]
+        Adb._remove_wifi_adb_ip_info(serialno)
         return False
 
     @classmethod
@@ -226,6 +942,7 @@ class Adb(object):
             return False
 
         ip_info["port"] = str(port)
+        Adb._set_wifi_adb_ip_info(serialno, ip_info)
         return True
 
     @classmethod
@@ -253,7 +970,7 @@ class Adb(object):
             child._log("unexpected output: {}".format(out.strip()), tolog)
             return False
 
-        del Adb.SERIAL_TO_IP_INFO[serialno]
+        Adb._remove_wifi_adb_ip_info(serialno)
         return True
 
     @classmethod
@@ -272,22 +989,40 @@ class Adb(object):
         child._log(
             "get_wifi_adb_ip_addr: addr[{}] of serialno '{}'".format(ip_addr, serialno), tolog)
 
+        # The mapping validated by any process is trusted until a command through it fails
+        if Adb.WIFI_ADB_CACHE is not None \
+            and Adb.WIFI_ADB_CACHE.is_validated(serialno, ip_info) \
+            and ip_addr in child.get_devices(tolog=tolog, **kwargs):
+            return ip_addr
+
         out, err = child.execute(
             ["shell", "getprop ro.serialno"], serialno=ip_addr, tolog=tolog, **kwargs)
         out = out.strip()
         if len(err):
             child._log("get_wifi_adb_ip_addr: get error: {}".format(err), tolog)
+            if Adb.is_transport_error(err):
+                Adb._invalidate_wifi_adb_ip_info(serialno)
             return None
 
         if out != serialno:
             child._log("get_wifi_adb_ip_addr: the serialno does not match: " \
                 "detected[{}], expected[{}]".format(serialno, out), tolog)
+            if Adb.WIFI_ADB_CACHE is not None:
+                Adb._remove_wifi_adb_ip_info(serialno)
             return None
 
+        Adb._set_wifi_adb_ip_info(serialno, ip_info)
         return ip_addr
 
     @classmethod
     def wait_for_device(child, serialno, timeoutsec, tolog=True):
+        if Adb.DEVICE_TRACKER is not None and Adb.DEVICE_TRACKER.is_ready():
+            # The tracker resolves the wifi adb devices before notifying the waiters
+            Adb.DEVICE_TRACKER.wait_for_devices(
+                lambda devices: serialno in devices or Adb._wifi_adb_addr(serialno) in devices,
+                timeoutsec)
+            return
+
         while not child.is_device_available(serialno=serialno, tolog=tolog) and timeoutsec > 0:
             time.sleep(1)
             timeoutsec -= 1
@@ -322,15 +1057,19 @@ class Adb(object):
     @classmethod
     def device_lock(child, serialno=None, tolog=True, **kwargs):
         child._log("lock the screen", tolog)
-        child.device_stayon(serialno=serialno, tolog=tolog, on=True, **kwargs)
-        child.device_keyevent_power(serialno=serialno, tolog=tolog, **kwargs)
-        child.device_stayon(serialno=serialno, tolog=tolog, on=False, **kwargs)
+        child.execute_batch(serialno, [
+            "svc power stayon true",
+            "input keyevent KEYCODE_POWER",
+            "svc power stayon false"
+        ], tolog=tolog, **kwargs)
 
     @classmethod
     def device_unlock(child, serialno=None, tolog=True, **kwargs):
         child._log("unlock the screen", tolog)
-        child.device_stayon(serialno=serialno, tolog=tolog, on=True, **kwargs)
-        child.device_keyevent_menu(serialno=serialno, tolog=tolog, **kwargs)
+        child.execute_batch(serialno, [
+            "svc power stayon true",
+            "input keyevent KEYCODE_MENU"
+        ], tolog=tolog, **kwargs)
 
     @staticmethod
     def screen_recording_start(serialno=None, tolog=True):
@@ -369,11 +1108,7 @@ class Adb(object):
                 ["pull", "/sdcard/screenrecord.mp4", pullto], serialno=serialno, tolog=tolog)
         return True
 
-try:
-    import functools
-    reduce = functools.reduce
-except:
-    pass
+atexit.register(Adb.finalize)
 
 import time
 
@@ -382,46 +1117,12 @@ class AudioAdb(Adb):
 
     @staticmethod
     def get_stream_volumes(serialno=None, **kwargs):
-        out, _ = AudioAdb.execute(["shell", "dumpsys audio"], serialno=serialno, **kwargs)
-        lines = [line.strip() \
-            if isinstance(line, str) \
-            else line.decode("utf-8").strip() for line in out.splitlines()]
-        idices = [idx for idx, line in enumerate(lines) if line.startswith("- STREAM")]
-        if len(idices) < 2:
+        parser = AudioAdb.dumpsys("audio", serialno=serialno, section_prefix="STREAM_", **kwargs)
+        sections = parser.get_sections("STREAM_")
+        if len(sections) < 2:
             return None
-        nlines = idices[1] - idices[0]
-        volumes = {}
-
-        def parse_str_v(str_v):
-            str_v = str_v.strip()
-            if str_v.lower() in ["true", "false"]:
-                return str_v.lower() == "true"
 
-            if str_v.isdigit():
-                return int(str_v)
-
-            try:
-                return float(str_v)
-            except ValueError:
-                return str_v
-
-        for idx in idices:
-            stream = lines[idx].split()[1][:-1]
-            volumes[stream] = {}
-            for line in lines[idx+1:idx+nlines]:
-                result = [fragment.split(",") for fragment in line.split(":")]
-                result = reduce(lambda x, y: x + y, result)
-                if len(result) == 2:
-                    k, v = result
-                    volumes[stream][k.strip()] = parse_str_v(v)
-                elif len(result) % 2 == 1:
-                    k = result[0]
-                    volumes[stream][k] = {}
-                    for idx in range(1, len(result), 2):
-                        subk, v = result[idx], result[idx+1]
-                        volumes[stream][k][subk.strip()] = parse_str_v(v)
-
-        return volumes
+        return {section.name: dict(section.values()) for section in sections}
 
     @staticmethod
     def adj_volume(keycode, times, serialno=None, **kwargs):
@@ -1,3 +1,5 @@
+import time
+
 from pyaatlibs.adbutils import Adb
 from pyaatlibs.logger import Logger
 
@@ -50,8 +52,17 @@ class AppInterface(object):
             child.log("{} should be installed on the device.".format(child.TAG))
             return None
 
-        out, _ = Adb.execute(["shell", "dumpsys package {}".format(child.get_package())], serialno=serialno, tolog=tolog)
-        lines = out.splitlines()
+        # Stop reading the output once the runtime permissions have passed
+        lines = []
+        runtime_perm_found = False
+        cmd = ["shell", "dumpsys package {}".format(child.get_package())]
+        with Adb.stream(cmd, serialno=serialno, tolog=tolog) as stream:
+            for line in stream:
+                if runtime_perm_found and not "android.permission." in line:
+                    break
+                runtime_perm_found = runtime_perm_found or "runtime permissions:" == line.strip()
+                lines.append(line)
+
         requested_perm_idx = [idx for idx, line in enumerate(lines) \
             if "requested permissions:" == line.strip()][0]
         install_perm_idx = [idx for idx, line in enumerate(lines) \
@@ -88,11 +99,11 @@ class AppInterface(object):
 
     @classmethod
     def grant_permissions(child, serialno=None, tolog=True, warning=True):
-        for perm, granted in child.get_permissions(serialno=serialno, tolog=tolog).items():
-            if granted or not perm.startswith("android.permission."):
-                continue
-            cmd = "pm grant {} {}".format(child.get_package(), perm)
-            out, err = Adb.execute(["shell", cmd], serialno=serialno, tolog=tolog)
+        cmds = ["pm grant {} {}".format(child.get_package(), perm) \
+            for perm, granted in child.get_permissions(serialno=serialno, tolog=tolog).items() \
+            if not granted and perm.startswith("android.permission.")]
+
+        for out, err, _ in Adb.execute_batch(serialno, cmds, tolog=tolog):
             if warning and len(err) > 0:
                 child.log("grant permission failed: {}".format(err.strip()))
 
@@ -103,3 +114,64 @@ class AppInterface(object):
     @classmethod
     def stop_app(child, device=None, serialno=None):
         Adb.execute(["shell", "am force-stop {}".format(child.get_package())], serialno=serialno)
+
+    # The death of the process is polled in steps growing from RELAUNCH_POLL_INTERVAL_SEC
+    RELAUNCH_POLL_INTERVAL_SEC = 0.02
+    RELAUNCH_POLL_MAX_INTERVAL_SEC = 0.08
+
+    @classmethod
+    def _relaunch_cmd(child, timeoutsec=10.):
+        # The uptime is printed around the wait for the process death to measure it on the device,
+        # and "am start -W" returns once the launched activity has been drawn.
+        intervals = []
+        interval, total = child.RELAUNCH_POLL_INTERVAL_SEC, 0.
+        while total < timeoutsec:
+            intervals.append(interval)
+            total += interval
+            interval = min(interval * 2, child.RELAUNCH_POLL_MAX_INTERVAL_SEC)
+
+        return ("echo STOP_BEGIN: $(cut -d ' ' -f 1 /proc/uptime); am force-stop {package}; "
+            "for d in {intervals}; do pidof {package} > /dev/null || break; sleep $d; done; "
+            "echo STOP_END: $(cut -d ' ' -f 1 /proc/uptime); am start -W -n {component}").format(
+                package=child.get_package(), component=child.get_launch_component(),
+                intervals=" ".join("{:g}".format(d) for d in intervals))
+
+    @staticmethod
+    def parse_launch_timings(out):
+        # Returns the launch state ("COLD", "WARM" or "HOT") and the times in ms of the stop and
+        # the start reported by "am start -W", or None for the values not found.
+        values = {}
+        for line in out.splitlines():
+            key, sep, value = line.partition(":")
+            if sep:
+                values[key.strip()] = value.strip()
+
+        def to_float(key):
+            try:
+                return float(values[key])
+            except (KeyError, ValueError):
+                return None
+
+        stop_begin, stop_end = to_float("STOP_BEGIN"), to_float("STOP_END")
+        return {
+            "status": values.get("Status"),
+            "launch_state": values.get("LaunchState"),
+            "stop_time_ms": (stop_end - stop_begin) * 1000. \
+                if stop_begin is not None and stop_end is not None else None,
+            "total_time_ms": to_float("TotalTime"),
+            "wait_time_ms": to_float("WaitTime")
+        }
+
+    @classmethod
+    def relaunch_app(child, device=None, serialno=None, timeoutsec=10., tolog=True):
+        # Stops the app, waits for its process to die and launches it in one shell invocation
+        # instead of fixed sleeps. Returns the timings, see parse_launch_timings().
+        tictoc = time.time()
+        out, _ = Adb.execute(
+            ["shell", child._relaunch_cmd(timeoutsec)], serialno=serialno, tolog=tolog,
+            timeoutsec=timeoutsec * 2)
+        timings = child.parse_launch_timings(out)
+        timings["elapsed_ms"] = (time.time() - tictoc) * 1000.
+        if tolog:
+            child.log("relaunch_app: {}".format(timings))
+        return timings
@@ -0,0 +1,109 @@
+import asyncio
+import subprocess
+import time
+
+from pyaatlibs.adbutils import Adb, AdbShellScript
+from pyaatlibs.logger import Logger
+
+# The coroutine counterparts of Adb. They share the device list, the wifi adb mapping and the
+# device tracker with Adb, but spawn the adb client with asyncio so that one event loop can
+# drive many devices without a thread per device.
+class AsyncAdb(object):
+    TAG = "AsyncAdb"
+
+    @classmethod
+    def _log(child, msg, tolog):
+        if not tolog:
+            return
+        Logger.log(child.TAG, msg)
+
+    @classmethod
+    async def execute(child, cmd, serialno=None, tolog=True, timeoutsec=None):
+        Adb._check_init()
+
+        if serialno and not serialno in await child.get_devices(tolog=tolog) and \
+            await child.is_device_available(serialno=serialno, tolog=tolog):
+            ip_addr = Adb._wifi_adb_addr(serialno)
+            child._log("use Wifi adb: addr[{}] of serialno '{}'".format(ip_addr, serialno), tolog)
+            serialno = ip_addr
+
+        return await child._execute(cmd=cmd, serialno=serialno, tolog=tolog, timeoutsec=timeoutsec)
+
+    @classmethod
+    async def _execute(child, cmd, serialno=None, tolog=True, timeoutsec=None):
+        if not isinstance(cmd, list):
+            cmd = [cmd]
+
+        cmd_prefix = ["adb"]
+        if serialno:
+            cmd_prefix += ["-s", serialno]
+
+        child._log("exec: {}".format(cmd_prefix + cmd), tolog)
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            *(cmd_prefix + cmd), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeoutsec)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            Adb._record_command(cmd, serialno, (time.perf_counter() - start) * 1000., True)
+            raise subprocess.TimeoutExpired(cmd_prefix + cmd, timeoutsec)
+
+        out, err = AdbShellScript.decode(out), AdbShellScript.decode(err)
+        Adb._record_command(
+            cmd, serialno, (time.perf_counter() - start) * 1000., err.startswith("error:"))
+        return out, err
+
+    @classmethod
+    async def execute_batch(child, serialno, cmds, tolog=True, timeoutsec=None):
+        if len(cmds) == 0:
+            return []
+
+        sentinel = AdbShellScript.new_sentinel()
+        child._log("exec batch: {}".format(cmds), tolog)
+        out, err = await child.execute(
+            ["shell", AdbShellScript.build(cmds, sentinel)], serialno=serialno, tolog=False,
+            timeoutsec=timeoutsec)
+
+        return AdbShellScript.split(out, err, sentinel, len(cmds))
+
+    @classmethod
+    async def get_devices(child, **kwargs):
+        if Adb.DEVICE_TRACKER is not None and Adb.DEVICE_TRACKER.is_ready():
+            return Adb.DEVICE_TRACKER.get_devices()
+
+        out, _ = await child.execute(["devices"], **kwargs)
+        return Adb.parse_devices(out)
+
+    @classmethod
+    async def _update_wifi_adb_devices(child, devices, tolog=True, **kwargs):
+        unknown_devices = list(Adb._unknown_wifi_adb_devices(devices))
+        results = await asyncio.gather(*[
+            child._execute(["shell", "getprop ro.serialno"], serialno=device, tolog=tolog, **kwargs)
+            for device, _ in unknown_devices])
+
+        for (device, ip_info), (out, err) in zip(unknown_devices, results):
+            if len(err) > 0:
+                continue
+
+            Adb._set_wifi_adb_ip_info(out.strip(), ip_info)
+            child._log("update wifi adb device: {}, {}".format(out.strip(), ip_info), tolog)
+
+    @classmethod
+    async def is_device_available(child, serialno, tolog=True, **kwargs):
+        devices = await child.get_devices(tolog=tolog, **kwargs)
+        await child._update_wifi_adb_devices(devices, tolog=tolog, **kwargs)
+
+        return serialno in devices or Adb._wifi_adb_addr(serialno) in devices
+
+    @classmethod
+    async def shell(child, cmd, serialno=None, **kwargs):
+        return await child.execute(["shell", cmd], serialno=serialno, **kwargs)
+
+    @staticmethod
+    async def gather(func, serialnos, *args, **kwargs):
+        results = await asyncio.gather(
+            *[func(*args, serialno=serialno, **kwargs) for serialno in serialnos],
+            return_exceptions=True)
+        return dict(zip(serialnos, results))
@@ -0,0 +1,122 @@
+import asyncio
+
+from pyaatlibs.asyncadb import AsyncAdb
+from pyaatlibs.audioworker import AudioWorkerApp, TaskIndex
+from pyaatlibs.logger import Logger
+
+# The coroutine counterparts of AudioWorkerApp. The intents and the parsing of info files are
+# shared with AudioWorkerApp, only the adb round trips are awaited.
+class AsyncAudioWorkerApp(object):
+    TAG = "AsyncAudioWorkerApp"
+
+    @classmethod
+    def log(child, msg):
+        Logger.log(child.TAG, msg)
+
+    @staticmethod
+    async def device_shell(serialno=None, cmd=None, tolog=True):
+        if not cmd:
+            return
+
+        return await AsyncAdb.execute(["shell", cmd], serialno=serialno, tolog=tolog)
+
+    @staticmethod
+    async def send_intent(serialno, name, configs={}, tolog=True):
+        # The info cache is shared with AudioWorkerApp
+        result = await __class__.device_shell(
+            serialno=serialno, cmd=AudioWorkerApp.build_intent_cmd(name, configs), tolog=tolog)
+        AudioWorkerApp._invalidate_info_cache_by_intent(serialno, name)
+        return result
+
+    @staticmethod
+    async def _common_info(
+        serialno=None, ctype=None, controller=None, tolog=False, extra_params={}):
+        name, configs, filepath = AudioWorkerApp._info_request(ctype, controller, extra_params)
+        cache_key = AudioWorkerApp._info_cache_key(ctype, extra_params)
+        info = AudioWorkerApp._get_cached_info(serialno, cache_key)
+        if info is not None:
+            return info
+        generation = AudioWorkerApp._get_info_cache_generation(serialno)
+
+        steps = AudioWorkerApp._info_query_steps(name, configs, filepath)
+        outs = None
+        try:
+            while True:
+                delay, intent, cmds = steps.send(outs)
+                await asyncio.sleep(delay)
+                intent_cmds = [AudioWorkerApp.build_intent_cmd(*intent)] if intent else []
+                results = await AsyncAdb.execute_batch(serialno, intent_cmds + cmds, tolog=tolog)
+                outs = [out for out, _, _ in results[len(intent_cmds):]]
+        except StopIteration as e:
+            info = e.value
+
+        AudioWorkerApp._set_cached_info(serialno, cache_key, info, generation)
+        return info
+
+    @staticmethod
+    async def is_alive(serialno=None, tolog=False):
+        infos = await asyncio.gather(
+            __class__.playback_info(serialno, tolog),
+            __class__.record_info(serialno, tolog=tolog),
+            __class__.voip_info(serialno, tolog))
+
+        return all(info != None for info in infos)
+
+    @staticmethod
+    async def playback_info(serialno=None, tolog=False):
+        return await __class__._common_info(serialno, "playback", "PlaybackController", tolog=tolog)
+
+    @staticmethod
+    async def playback_nonoffload(serialno=None, **kwargs):
+        await __class__.send_intent(serialno, *AudioWorkerApp._playback_nonoffload_intent(**kwargs))
+
+    @staticmethod
+    async def playback_offload(serialno=None, **kwargs):
+        await __class__.send_intent(serialno, *AudioWorkerApp._playback_offload_intent(**kwargs))
+
+    @staticmethod
+    async def playback_stop(serialno=None, tolog=False):
+        name = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "playback.stop"
+        info = await __class__.playback_info(serialno, tolog)
+        for configs in AudioWorkerApp._playback_stop_configs(info):
+            await __class__.send_intent(serialno, name, configs)
+
+    @staticmethod
+    async def record_info(serialno=None, task_index=TaskIndex.ALL, tolog=False):
+        info = await __class__._common_info(
+            serialno, "record", "RecordController",
+            extra_params={"task-index": int(task_index)}, tolog=tolog)
+        return AudioWorkerApp._parse_record_info(info)
+
+    @staticmethod
+    async def record_start(serialno=None, **kwargs):
+        await __class__.send_intent(serialno, *AudioWorkerApp._record_start_intent(**kwargs))
+
+    @staticmethod
+    async def record_stop(serialno=None, task_index=TaskIndex.ALL, tolog=False):
+        name = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "record.stop"
+        info = await __class__.record_info(serialno, task_index, tolog)
+        for track_index in AudioWorkerApp._record_task_indices(info, task_index):
+            await __class__.send_intent(serialno, name, {"task-index": track_index})
+
+    @staticmethod
+    async def record_dump(serialno=None, path=None, task_index=0):
+        if not path:
+            return
+
+        name = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "record.dump"
+        await __class__.send_intent(
+            serialno, name, {"filename": path, "task-index": int(task_index)})
+
+    @staticmethod
+    async def voip_info(serialno=None, tolog=False):
+        return await __class__._common_info(serialno, "voip", "VoIPController", tolog=tolog)
+
+    @staticmethod
+    async def voip_start(serialno=None, **kwargs):
+        await __class__.send_intent(serialno, *AudioWorkerApp._voip_start_intent(**kwargs))
+
+    @staticmethod
+    async def voip_stop(serialno=None):
+        name = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "voip.stop"
+        await __class__.send_intent(serialno, name)
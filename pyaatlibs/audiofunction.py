@@ -91,6 +91,10 @@ class ToneDetectorThread(threading.Thread):
         return diff_semitone < 2
 
 class ToneDetectorForServerThread(ToneDetectorThread):
+    # Set it to True to evaluate only the frequencies around the target instead of the whole
+    # spectrum, see ToneDetectCommand
+    TARGET_MODE = False
+
     def __init__(self, target_freq, callback):
         super(ToneDetectorForServerThread, self).__init__(target_freq=target_freq, callback=callback)
 
@@ -127,7 +131,12 @@ class ToneDetectorForServerThread(ToneDetectorThread):
                         shared_vars["last_event"] = ToneDetector.Event.TONE_MISSING
                 self.event_counter = 0
 
-        AudioFunction.start_record(cb=freq_cb)
+        cmd = None
+        if __class__.TARGET_MODE and self.target_freq:
+            cmd = ToneDetectCommand(
+                config=AudioFunction.AUDIO_CONFIG, framemillis=50, nfft=2048,
+                target_freqs=[self.target_freq], tolerance_semitone=2)
+        AudioFunction.start_record(cb=freq_cb, cmd=cmd)
 
         while not self.stoprequest.isSet():
             time.sleep(0.1)
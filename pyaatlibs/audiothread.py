@@ -1,9 +1,9 @@
 import threading
 import sounddevice as sd
 import numpy as np
-from scipy.fftpack import fft
-
-from pyaatlibs.signalanalyzer import find_peaks
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft
+from scipy.signal import get_window
 
 try:
     import queue
@@ -11,11 +11,235 @@ except ImportError:
     import Queue as queue
 
 class AudioConfig(object):
-    def __init__(self, fs, ch=1, dtype="float32", cb=None):
+    def __init__(self, fs, ch=1, dtype="float32", cb=None, raw_stream=False):
         self.fs = fs
         self.ch = ch
         self.dtype = dtype
         self.cb = cb
+        # Capture with sd.RawInputStream, whose buffers are viewed without conversion
+        self.raw_stream = raw_stream
+
+class AudioRingBuffer(object):
+    # A fixed-capacity buffer of frames. Every frame is stored twice, at i and i + capacity, so
+    # that any run of up to capacity frames can be read as a contiguous view without copying.
+    def __init__(self, capacity, ch=1, dtype="float32"):
+        self.capacity = int(capacity)
+        self.buff = np.zeros((2*self.capacity, ch), dtype=dtype)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.overruns = 0
+        self.dropped_frames = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def write(self, data):
+        # Returns the number of unread frames dropped to make room for data
+        num_frames = len(data)
+        dropped = max(0, self.available() + num_frames - self.capacity)
+        if dropped > 0:
+            self.overruns += 1
+            self.dropped_frames += dropped
+
+        data = data[-self.capacity:]
+        start = (self.write_pos + num_frames - len(data)) % self.capacity
+        end = start + len(data)
+        self.buff[start:end] = data
+        if end <= self.capacity:
+            self.buff[start+self.capacity:end+self.capacity] = data
+        else:
+            self.buff[start+self.capacity:] = data[:self.capacity-start]
+            self.buff[:end-self.capacity] = data[self.capacity-start:]
+
+        self.write_pos += num_frames
+        self.read_pos = max(self.read_pos, self.write_pos - self.capacity)
+        return dropped
+
+    def peek(self, num_frames):
+        # Returns a view of the next num_frames frames, which is valid until they are overwritten
+        if num_frames > self.capacity or self.available() < num_frames:
+            return None
+
+        start = self.read_pos % self.capacity
+        return self.buff[start:start+num_frames]
+
+    def skip(self, num_frames):
+        self.read_pos += min(num_frames, self.available())
+
+    def read(self, num_frames):
+        frames = self.peek(num_frames)
+        if frames is not None:
+            self.read_pos += num_frames
+        return frames
+
+    def reset(self):
+        self.read_pos = 0
+        self.write_pos = 0
+
+class AudioSpectralEngine(object):
+    # Computes the magnitude spectra of all the complete frames of a block with one batched rfft.
+    # The frames start every hop samples, and the window is normalized by its coherent gain so
+    # that the level of a tone matches the one without window. The frames longer than nfft are
+    # cut to their first nfft samples before the window, as the rfft would cut them.
+    def __init__(self, fs, framesize, nfft=-1, hop=None, window="hann"):
+        self.fs = fs
+        self.framesize = int(framesize)
+        self.nfft = int(nfft) if nfft > 0 else self.framesize
+        self.winsize = min(self.framesize, self.nfft)
+        self.hop = int(hop) if hop else self.framesize
+        if self.hop <= 0 or self.hop > self.framesize:
+            raise ValueError("the hop should be within (0, {}]".format(self.framesize))
+        self.window = None
+        if window:
+            self.window = get_window(window, self.winsize).astype(np.float32)
+            self.window *= self.winsize / np.sum(self.window)
+        # The mean power of the window, which scales the noise floor of the bins
+        self.window_power = 1. if self.window is None else \
+            np.mean(np.square(self.window, dtype=np.float64))
+        self.freqs = np.arange(self.nfft//2) * 1.0*self.fs / self.nfft
+
+    def num_frames(self, num_samples):
+        if num_samples < self.framesize:
+            return 0
+        return (num_samples - self.framesize) // self.hop + 1
+
+    def frames(self, signal):
+        # A strided view of shape (num_frames, framesize) over the signal
+        num_frames = self.num_frames(len(signal))
+        return sliding_window_view(signal, self.framesize, axis=0)[:num_frames*self.hop:self.hop]
+
+    def spectra(self, frames):
+        frames = frames[..., :self.winsize]
+        if self.window is not None:
+            frames = frames * self.window
+        return np.abs(rfft(frames, n=self.nfft, axis=-1))[..., :self.nfft//2]
+
+    def analyze(self, signal):
+        return self.spectra(self.frames(signal))
+
+    def consume_frames(self, ring, channel=0):
+        # Takes the complete frames in the ring buffer and skips the samples not needed by the
+        # next frame. Returns a view of shape (num_frames, framesize), or of shape
+        # (num_frames, num_channels, framesize) for all the channels with channel=None.
+        num_frames = self.num_frames(ring.available())
+        if num_frames == 0:
+            return None
+
+        signal = ring.peek((num_frames-1)*self.hop + self.framesize)
+        ring.skip(num_frames*self.hop)
+        return self.frames(signal if channel is None else signal[:, channel])
+
+    def consume(self, ring, channel=0):
+        frames = self.consume_frames(ring, channel)
+        return self.spectra(frames) if frames is not None else None
+
+    def set_targets(self, target_freqs, tolerance_semitone=0.):
+        # Only the frequencies within tolerance_semitone of the targets are evaluated, as one
+        # product with a precomputed DFT matrix instead of the whole FFT. The frequencies around
+        # a target are spaced by half of the resolution of the frame.
+        self.target_freqs = np.array(target_freqs, dtype=np.float64)
+        probe_freqs, self.target_groups = [], []
+        step = 0.5*self.fs / self.winsize
+        for freq in self.target_freqs:
+            lo, hi = freq * 2**(-tolerance_semitone/12.), freq * 2**(tolerance_semitone/12.)
+            offsets = np.arange(np.floor((lo-freq)/step), np.ceil((hi-freq)/step) + 1) * step
+            self.target_groups.append(len(probe_freqs))
+            probe_freqs += [freq + offset for offset in offsets if lo <= freq + offset <= hi]
+
+        self.probe_freqs = np.array(probe_freqs)
+        n = np.arange(self.winsize)
+        matrix = np.exp(-2j*np.pi * np.outer(n, self.probe_freqs) / self.fs)
+        if self.window is not None:
+            matrix *= self.window[:, None]
+        self.probe_matrix = matrix.astype(np.complex64)
+
+    def detect_targets(self, frames, min_snr_db=10.):
+        # Returns the frequency and the level in dB of the strongest target of each frame, and
+        # the magnitudes of all the targets. The frequency is 0 if the strongest target is less
+        # than min_snr_db above the noise floor, i.e. no target is detected. The noise floor is
+        # the rest of the energy of the mean-removed frame spread over the bins.
+        frames = frames[..., :self.winsize]
+        frames = frames - np.mean(frames, axis=-1, keepdims=True)
+        mags = np.abs(frames @ self.probe_matrix)
+        target_mags = np.maximum.reduceat(mags, self.target_groups, axis=-1)
+        idx = np.argmax(target_mags, axis=-1)
+        peak_mags = np.take_along_axis(target_mags, idx[..., None], axis=-1)[..., 0]
+        peak_mags = peak_mags.astype(np.float64)
+
+        # A sine of amplitude A has the magnitude A*winsize/2 and the energy A^2*winsize/2, and
+        # a noise of energy E has the mean power E*window_power in a bin
+        energies = np.sum(np.square(frames, dtype=np.float64), axis=-1)
+        noises = np.maximum(energies - 2*np.square(peak_mags)/self.winsize, 0.) * self.window_power
+        detected = (peak_mags > 0) & (np.square(peak_mags) >= 10**(min_snr_db/10.) * noises)
+        freqs = np.where(detected, self.target_freqs[idx], 0.)
+        return freqs, 20*np.log10(peak_mags + 1e-50), target_mags
+
+    @staticmethod
+    def find_peaks(spectra):
+        # The strongest bin of each spectrum, as find_peaks() in signalanalyzer does
+        idx = np.argmax(spectra, axis=-1)
+        peaks = np.take_along_axis(spectra, idx[..., None], axis=-1)[..., 0]
+        return idx, peaks.astype(np.float64) + 1e-50
+
+class AudioOscillator(object):
+    # Generates sums of sines per channel. The phase of each tone is accumulated in cycles and
+    # wrapped to [0, 1) on every block, so it does not lose precision over long runs.
+    def __init__(self, fs, ch=1, freqs=440., amp=0.99):
+        self.fs = fs
+        self.ch = ch
+        self.phase = None
+        self.ramp = np.zeros(0)
+        self.work = None
+        self.set_freqs(freqs, amp)
+
+    def set_freqs(self, freqs, amp=None):
+        # freqs is a frequency or a list of frequencies played on all the channels, or a list of
+        # the frequency (or the list of frequencies) of each channel. The tones of a channel
+        # share its amplitude, which is a value or a list of the value of each channel.
+        if amp is not None:
+            self.amp = amp
+        if np.isscalar(freqs):
+            freqs = [freqs]
+        if all(np.isscalar(freq) for freq in freqs):
+            channel_freqs = [list(freqs)] * self.ch
+        elif len(freqs) == self.ch:
+            channel_freqs = [[freq] if np.isscalar(freq) else list(freq) for freq in freqs]
+        else:
+            raise ValueError("the frequencies of {} channels are given for {} channels".format(
+                len(freqs), self.ch))
+
+        num_tones = max(1, max(len(freq) for freq in channel_freqs))
+        incr = np.zeros((self.ch, num_tones))
+        gains = np.zeros((self.ch, num_tones))
+        for cidx, freq in enumerate(channel_freqs):
+            incr[cidx, :len(freq)] = np.array(freq, dtype=np.float64) / self.fs
+            gains[cidx, :len(freq)] = 1. / len(freq) if len(freq) > 0 else 0.
+        gains *= np.broadcast_to(np.asarray(self.amp, dtype=np.float64), (self.ch,))[:, None]
+
+        # The phases are kept as long as the layout of the tones is the same
+        if self.phase is None or self.phase.shape != incr.shape:
+            self.phase = np.zeros(incr.shape)
+            self.work = None
+        self.incr = incr
+        self.gains = gains
+
+    def render(self, outdata):
+        # Writes the next len(outdata) frames into outdata of shape (frames, ch)
+        frames = len(outdata)
+        if len(self.ramp) < frames:
+            self.ramp = np.arange(frames, dtype=np.float64)
+        if self.work is None or len(self.work) < frames:
+            self.work = np.zeros((frames,) + self.incr.shape)
+
+        work = self.work[:frames]
+        np.multiply(self.ramp[:frames, None, None], self.incr, out=work)
+        work += self.phase
+        work *= 2*np.pi
+        np.sin(work, out=work)
+        np.einsum("fck,ck->fc", work, self.gains, out=outdata, casting="same_kind")
+
+        self.phase += self.incr * frames
+        self.phase %= 1.
 
 class AudioCommand(object):
     def __init__(self, config):
@@ -26,17 +250,23 @@ class RawRecordCommand(AudioCommand):
         super(RawRecordCommand, self).__init__(config)
         self.framemillis = framemillis
         self.is_recording = True
+        self.overruns = 0
 
     def stop(self):
         self.is_recording = False
 
     def reset(self):
         self.is_recording = True
+        self.overruns = 0
 
 class TonePlayCommand(AudioCommand):
-    def __init__(self, config, out_freq):
+    # out_freq and amp take the forms of AudioOscillator.set_freqs(), e.g. [440, 880] for two
+    # tones on all the channels or [440, [660, 880]] for different tones on 2 channels. They can
+    # be changed while playing.
+    def __init__(self, config, out_freq, amp=0.99):
         super(TonePlayCommand, self).__init__(config)
         self.out_freq = out_freq
+        self.amp = amp
         self.is_playing = True
 
     def stop(self):
@@ -46,19 +276,37 @@ class TonePlayCommand(AudioCommand):
         self.is_playing = True
 
 class ToneDetectCommand(AudioCommand):
-    def __init__(self, config, framemillis=100, nfft=-1):
+    # The frames start every hopmillis (framemillis without overlapping by default). The
+    # spectra_cb(spectra=..., freqs=...) gets the spectra of all the frames of a stream callback.
+    # With per_channel, all the channels are analyzed and the callback of the config gets the
+    # tones of each channel as channel_tones in addition to detected_tones of the first one.
+    # With target_freqs, only the frequencies within tolerance_semitone of the targets are
+    # evaluated, and the detected tone is the strongest target if it is min_snr_db above the
+    # noise floor, or (0, level of the strongest target) otherwise.
+    def __init__(
+        self, config, framemillis=100, nfft=-1, hopmillis=None, window="hann", spectra_cb=None,
+        per_channel=False, target_freqs=None, tolerance_semitone=0., min_snr_db=10.):
         super(ToneDetectCommand, self).__init__(config)
         self.framemillis = framemillis
         self.nfft = nfft
         if self.nfft < 0:
             self.nfft = int(framemillis*self.config.fs/1000)
+        self.hopmillis = hopmillis if hopmillis else framemillis
+        self.window = window
+        self.spectra_cb = spectra_cb
+        self.per_channel = per_channel
+        self.target_freqs = target_freqs
+        self.tolerance_semitone = tolerance_semitone
+        self.min_snr_db = min_snr_db
         self.is_detecting = True
+        self.overruns = 0
 
     def stop(self):
         self.is_detecting = False
 
     def reset(self):
         self.is_detecting = True
+        self.overruns = 0
 
 class AudioCommandThread(threading.Thread):
     def __init__(self, cmd_q=None):
@@ -99,110 +347,97 @@ class AudioCommandThread(threading.Thread):
             self._process_raw_record_command(cmd)
 
     def _process_tone_playback_command(self, cmd):
-        phase_offset = 0
         cfg = cmd.config
-
-        # Make the code adaptive to both python 2 and 3
-        shared_vars = {
-            "cmd"         : cmd,
-            "phase_offset": phase_offset
-        }
+        oscillator = AudioOscillator(cfg.fs, ch=cfg.ch, freqs=cmd.out_freq, amp=cmd.amp)
+        current = {"out_freq": cmd.out_freq, "amp": cmd.amp}
 
         def playback_cb(outdata, frames, time, status):
-            phase_offset = shared_vars["phase_offset"]
-            cmd = shared_vars["cmd"]
-            cfg = cmd.config
-
-            signal = np.arange(outdata.shape[0])
-            signal = signal * 2*np.pi/cfg.fs + phase_offset
-            phase_offset += outdata.shape[0] * 2*np.pi/cfg.fs
-            signal = 0.99 * np.sin(signal * cmd.out_freq)
+            if cmd.out_freq is not current["out_freq"] or cmd.amp is not current["amp"]:
+                current["out_freq"], current["amp"] = cmd.out_freq, cmd.amp
+                oscillator.set_freqs(cmd.out_freq, cmd.amp)
 
-            for cidx in range(outdata.shape[1]):
-                outdata[:, cidx] = signal
-
-            shared_vars["phase_offset"] = phase_offset
-            shared_vars["cmd"] = cmd
+            oscillator.render(outdata)
 
         with sd.OutputStream(channels=cfg.ch, callback=playback_cb, samplerate=cfg.fs, dtype="float32"):
             while cmd.is_playing:
                 sd.sleep(500)
 
-    def _process_tone_detect_command(self, cmd):
-        cfg = cmd.config
-        buff = np.array([])
-        framesize = int(cfg.fs*cmd.framemillis/1000)
+    # The captured frames are buffered in a preallocated ring buffer, so the callbacks of the
+    # input stream do not allocate or copy the backlog. The callback counts an overrun on the
+    # command whenever frames are lost, by the stream or by the ring buffer.
+    RING_BUFFER_SEC = 1.
 
-        # Make the code adaptive to both python 2 and 3
-        shared_vars = {
-            "cmd"      : cmd,
-            "buff"     : buff,
-            "framesize": framesize
-        }
+    def _process_input_command(self, cmd, framesize, process, is_active):
+        cfg = cmd.config
+        capacity = max(4*framesize, int(cfg.fs*self.RING_BUFFER_SEC))
+        ring = AudioRingBuffer(capacity, ch=cfg.ch, dtype="float32")
 
         def record_cb(indata, frames, time, status):
-            cmd = shared_vars["cmd"]
-            cfg = cmd.config
-            buff = shared_vars["buff"]
-            framesize = shared_vars["framesize"]
+            if cfg.raw_stream:
+                indata = np.frombuffer(indata, dtype=np.float32).reshape(-1, cfg.ch)
 
-            if buff.size > 0:
-                buff = np.vstack((buff, indata[:, :]))
-            else:
-                buff = np.array(indata[:, :])
-
-            while buff.size >= framesize:
-                spectrum = np.abs(fft(buff[:framesize, 0], cmd.nfft))
-                spectrum = spectrum[:int(cmd.nfft/2.0)]
-                unit_freq = 1.0*cfg.fs / cmd.nfft
-                peaks = find_peaks(spectrum)
-                tones = list(map(lambda x: (x[0]*unit_freq, 20*np.log10(x[1])), peaks))
-                if cfg.cb:
-                    cfg.cb(detected_tones=tones)
+            dropped = ring.write(indata)
+            if dropped > 0 or status.input_overflow:
+                cmd.overruns += 1
 
-                buff = buff[framesize:, :]
+            process(ring)
 
-            shared_vars["cmd"] = cmd
-            shared_vars["buff"] = buff
-            shared_vars["framesize"] = framesize
-
-        with sd.InputStream(channels=cfg.ch, callback=record_cb, samplerate=cfg.fs, dtype="float32"):
-            while cmd.is_detecting:
+        stream_class = sd.RawInputStream if cfg.raw_stream else sd.InputStream
+        with stream_class(channels=cfg.ch, callback=record_cb, samplerate=cfg.fs, dtype="float32"):
+            while is_active():
                 sd.sleep(500)
 
-    def _process_raw_record_command(self, cmd):
+    def _process_tone_detect_command(self, cmd):
         cfg = cmd.config
-        buff = np.array([])
         framesize = int(cfg.fs*cmd.framemillis/1000)
+        engine = AudioSpectralEngine(
+            cfg.fs, framesize, nfft=cmd.nfft, hop=int(cfg.fs*cmd.hopmillis/1000),
+            window=cmd.window)
+        if cmd.target_freqs is not None and len(cmd.target_freqs) > 0:
+            engine.set_targets(cmd.target_freqs, tolerance_semitone=cmd.tolerance_semitone)
+
+        def process(ring):
+            frames = engine.consume_frames(ring, channel=None if cmd.per_channel else 0)
+            if frames is None:
+                return
+
+            # In the target mode, the spectra are the magnitudes of the targets
+            if cmd.target_freqs is not None and len(cmd.target_freqs) > 0:
+                freqs, dbs, spectra = engine.detect_targets(frames, min_snr_db=cmd.min_snr_db)
+                if cmd.spectra_cb:
+                    cmd.spectra_cb(spectra=spectra, freqs=engine.target_freqs)
+            else:
+                spectra = engine.spectra(frames)
+                if cmd.spectra_cb:
+                    cmd.spectra_cb(spectra=spectra, freqs=engine.freqs)
+                idx, amps = engine.find_peaks(spectra)
+                freqs, dbs = engine.freqs[idx], 20*np.log10(amps)
 
-        # Make the code adaptive to both python 2 and 3
-        shared_vars = {
-            "cmd"      : cmd,
-            "buff"     : buff,
-            "framesize": framesize
-        }
+            if not cfg.cb:
+                return
 
-        def record_cb(indata, frames, time, status):
-            cmd = shared_vars["cmd"]
-            cfg = cmd.config
-            buff = shared_vars["buff"]
-            framesize = shared_vars["framesize"]
+            if not cmd.per_channel:
+                for freq, db in zip(freqs, dbs):
+                    cfg.cb(detected_tones=[(freq, db)])
+                return
 
-            if buff.any():
-                buff = np.vstack((buff, indata[:, :]))
-            else:
-                buff = np.array(indata[:, :])
+            # freqs and dbs are of shape (num_frames, num_channels)
+            for frame_freqs, frame_dbs in zip(freqs.tolist(), dbs.tolist()):
+                channel_tones = [[tone] for tone in zip(frame_freqs, frame_dbs)]
+                cfg.cb(detected_tones=channel_tones[0], channel_tones=channel_tones)
 
-            while buff.size >= framesize:
-                if cfg.cb:
-                    cfg.cb(indata=np.array(buff[:framesize, :]))
+        self._process_input_command(cmd, framesize, process, lambda: cmd.is_detecting)
 
-                buff = buff[framesize:, :]
+    def _process_raw_record_command(self, cmd):
+        cfg = cmd.config
+        framesize = int(cfg.fs*cmd.framemillis/1000)
 
-            shared_vars["cmd"] = cmd
-            shared_vars["buff"] = buff
-            shared_vars["framesize"] = framesize
+        def process(ring):
+            frame = ring.read(framesize)
+            while frame is not None:
+                # The frame is copied since the callback might keep it
+                if cfg.cb:
+                    cfg.cb(indata=np.array(frame))
+                frame = ring.read(framesize)
 
-        with sd.InputStream(channels=cfg.ch, callback=record_cb, samplerate=cfg.fs, dtype="float32"):
-            while cmd.is_recording:
-                sd.sleep(500)
+        self._process_input_command(cmd, framesize, process, lambda: cmd.is_recording)
@@ -1,8 +1,13 @@
 import os
+import copy
+import re
 import subprocess
 import json
 import datetime
+import struct
+import threading
 import time
+import numpy as np
 from enum import IntEnum, auto
 
 from pyaatlibs import ROOT_DIR
@@ -53,6 +58,25 @@ class AudioWorkerApp(AppInterface):
 
     DATA_FOLDER = "/storage/emulated/0/Google-AudioWorker-data"
 
+    # Set it to True to run the broadcast, the wait for the info file, the read and the removal of
+    # the info queries in one device-side script instead of polling the file from the host.
+    INFO_QUERY_COMBINED = False
+    INFO_QUERY_TIMEOUT_SEC = 5.
+    INFO_QUERY_POLL_INTERVAL_SEC = 0.02
+
+    # The active intent pipelines of the current thread, see pipeline()
+    INTENT_PIPELINES = threading.local()
+
+    # The info queries within INFO_CACHE_TTL_SEC are answered from the cache, which is cleared by
+    # any intent other than the info queries. It is disabled with a TTL of 0.
+    INFO_CACHE_TTL_SEC = 0
+    INFO_CACHE = {}
+    INFO_CACHE_GENERATIONS = {}
+    INFO_CACHE_LOCK = threading.Lock()
+
+    # A dumped file is taken as finished once its size is unchanged over this many checks in a row
+    DUMP_STABLE_CHECKS = 3
+
     @staticmethod
     def get_apk_path():
         for path in __class__.APK_PATHS:
@@ -115,14 +139,83 @@ class AudioWorkerApp(AppInterface):
 
         return True
 
+    @classmethod
+    def launch_app(child, device=None, serialno=None):
+        super().launch_app(device=device, serialno=serialno)
+        __class__.invalidate_info_cache(serialno)
+
+    @classmethod
+    def stop_app(child, device=None, serialno=None):
+        super().stop_app(device=device, serialno=serialno)
+        __class__.invalidate_info_cache(serialno)
+
     @staticmethod
-    def relaunch_app(device=None, serialno=None):
-        __class__.stop_app(device, serialno)
-        time.sleep(2)
-        __class__.launch_app(device, serialno)
+    def set_info_cache_ttl(ttl_sec=0):
+        __class__.INFO_CACHE_TTL_SEC = ttl_sec
+        if not ttl_sec:
+            with __class__.INFO_CACHE_LOCK:
+                __class__.INFO_CACHE.clear()
 
     @staticmethod
-    def send_intent(device, serialno, name, configs={}, tolog=True):
+    def invalidate_info_cache(serialno=None):
+        # The info queried before the invalidation is not cached, see _set_cached_info()
+        with __class__.INFO_CACHE_LOCK:
+            __class__.INFO_CACHE.pop(serialno, None)
+            __class__.INFO_CACHE_GENERATIONS[serialno] = \
+                __class__.INFO_CACHE_GENERATIONS.get(serialno, 0) + 1
+
+    @staticmethod
+    def _get_info_cache_generation(serialno):
+        with __class__.INFO_CACHE_LOCK:
+            return __class__.INFO_CACHE_GENERATIONS.get(serialno, 0)
+
+    @staticmethod
+    def _invalidate_info_cache_by_intent(serialno, name):
+        if not name.endswith(".info"):
+            __class__.invalidate_info_cache(serialno)
+
+    @staticmethod
+    def _info_cache_key(ctype, extra_params={}):
+        return (ctype, json.dumps(extra_params, sort_keys=True))
+
+    @staticmethod
+    def _get_cached_info(serialno, key):
+        if not __class__.INFO_CACHE_TTL_SEC:
+            return None
+
+        with __class__.INFO_CACHE_LOCK:
+            cached = __class__.INFO_CACHE.get(serialno, {}).get(key)
+            if cached is None or time.time() - cached[0] > __class__.INFO_CACHE_TTL_SEC:
+                return None
+            return copy.deepcopy(cached[1])
+
+    @staticmethod
+    def _set_cached_info(serialno, key, info, generation=None):
+        if not __class__.INFO_CACHE_TTL_SEC or info is None:
+            return
+
+        with __class__.INFO_CACHE_LOCK:
+            # An intent delivered during the query might have changed the info
+            if generation is not None \
+                and generation != __class__.INFO_CACHE_GENERATIONS.get(serialno, 0):
+                return
+            __class__.INFO_CACHE.setdefault(serialno, {})[key] = (time.time(), copy.deepcopy(info))
+
+    @classmethod
+    def relaunch_app(child, device=None, serialno=None, timeoutsec=10., tolog=True):
+        # The app is ready once it answers an info query, which waits for the answer on the device
+        timings = super().relaunch_app(
+            device=device, serialno=serialno, timeoutsec=timeoutsec, tolog=tolog)
+        __class__.invalidate_info_cache(serialno)
+        tictoc = time.time()
+        ready = __class__.playback_info(serialno=serialno) is not None
+        timings["ready_time_ms"] = (time.time() - tictoc) * 1000. if ready else None
+        if not ready:
+            __class__.log("relaunch_app: the app is not ready")
+        return timings
+
+    @staticmethod
+    def build_intent_cmd(name, configs={}):
         cmd_arr = [__class__.INTENT_PREFIX, name]
         for key, value in configs.items():
             if value is None:
@@ -137,12 +230,88 @@ class AudioWorkerApp(AppInterface):
                 cmd_arr += ["--es", key]
             cmd_arr.append(str(value))
 
+        return " ".join(cmd_arr)
+
+    @staticmethod
+    def pipeline(serialno=None, tolog=True):
+        # Queues the intents sent to the device by the current thread and sends them in one shell
+        # invocation when the block exits, e.g.
+        #
+        #   with AudioWorkerApp.pipeline(serialno) as pipeline:
+        #       AudioWorkerApp.record_start(serialno=serialno)
+        #       AudioWorkerApp.playback_nonoffload(serialno=serialno)
+        #   results = pipeline.results
+        return AudioWorkerIntentPipeline(serialno, tolog=tolog)
+
+    @staticmethod
+    def record_session(serialno=None, task_indices=[0], info_ttl_sec=0.5, tolog=False, **configs):
+        # configs are the arguments of record_start() applied to all the tasks of the session
+        return AudioWorkerRecordSession(
+            serialno, task_indices=task_indices, info_ttl_sec=info_ttl_sec, tolog=tolog, **configs)
+
+    @staticmethod
+    def _get_intent_pipeline(device, serialno):
+        if device:
+            return None
+        return getattr(__class__.INTENT_PIPELINES, "pipelines", {}).get(serialno)
+
+    @staticmethod
+    def _flush_intent_pipeline(device, serialno):
+        pipeline = __class__._get_intent_pipeline(device, serialno)
+        if pipeline:
+            pipeline.flush()
+
+    @staticmethod
+    def parse_broadcast_result(out):
+        m = re.search(
+            "Broadcast completed: result=(?P<result>-?\\d+)(, data=\"(?P<data>.*)\")?", out)
+        if not m:
+            return None, None
+        return int(m.group("result")), m.group("data")
+
+    @staticmethod
+    def send_intent(device, serialno, name, configs={}, tolog=True):
+        # The queued intents clear the info cache once the pipeline is flushed
+        pipeline = __class__._get_intent_pipeline(device, serialno)
+        if pipeline:
+            pipeline.add(name, configs)
+            return
+
         __class__.device_shell(
-            device=device, serialno=serialno, cmd=" ".join(cmd_arr), tolog=tolog)
+            device=device, serialno=serialno, cmd=__class__.build_intent_cmd(name, configs),
+            tolog=tolog)
+        __class__._invalidate_info_cache_by_intent(serialno, name)
+
+    @staticmethod
+    def send_intents(device, serialno, intents, tolog=True):
+        pipeline = __class__._get_intent_pipeline(device, serialno)
+        if pipeline:
+            for name, configs in intents:
+                pipeline.add(name, configs)
+            return
+
+        if device:
+            for name, configs in intents:
+                __class__.send_intent(device, serialno, name, configs, tolog=tolog)
+            return
+
+        Adb.execute_batch(
+            serialno, [__class__.build_intent_cmd(name, configs) for name, configs in intents],
+            tolog=tolog)
+        for name, _ in intents:
+            __class__._invalidate_info_cache_by_intent(serialno, name)
 
     @staticmethod
     def playback_nonoffload(
         device=None, serialno=None,
+        freqs=[440.], playback_id=0, file="null",
+        fs=16000, nch=2, amp=0.6, bit_depth=16, low_latency_mode=False):
+        __class__.send_intent(device, serialno, *__class__._playback_nonoffload_intent(
+            freqs=freqs, playback_id=playback_id, file=file, fs=fs, nch=nch, amp=amp,
+            bit_depth=bit_depth, low_latency_mode=low_latency_mode))
+
+    @staticmethod
+    def _playback_nonoffload_intent(
         freqs=[440.], playback_id=0, file="null",
         fs=16000, nch=2, amp=0.6, bit_depth=16, low_latency_mode=False):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "playback.start"
@@ -157,7 +326,7 @@ class AudioWorkerApp(AppInterface):
             "low-latency-mode": low_latency_mode,
             "file": file
         }
-        __class__.send_intent(device, serialno, name, configs)
+        return name, configs
 
     @staticmethod
     def playback_nonoffload_seek_to(device=None, serialno=None, playback_id=0, seek_position_ms=0):
@@ -173,6 +342,13 @@ class AudioWorkerApp(AppInterface):
     def playback_offload(
         device=None, serialno=None, file="null",
         freqs=[440.], playback_id=0, fs=16000, nch=2, amp=0.6, bit_depth=16):
+        __class__.send_intent(device, serialno, *__class__._playback_offload_intent(
+            file=file, freqs=freqs, playback_id=playback_id, fs=fs, nch=nch, amp=amp,
+            bit_depth=bit_depth))
+
+    @staticmethod
+    def _playback_offload_intent(
+        file="null", freqs=[440.], playback_id=0, fs=16000, nch=2, amp=0.6, bit_depth=16):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "playback.start"
         configs = {
             "type": "offload",
@@ -184,7 +360,7 @@ class AudioWorkerApp(AppInterface):
             "pcm-bit-width": bit_depth,
             "file": file
         }
-        __class__.send_intent(device, serialno, name, configs)
+        return name, configs
 
     @staticmethod
     def playback_offload_seek_to(device=None, serialno=None, playback_id=0, seek_position_ms=0):
@@ -197,8 +373,7 @@ class AudioWorkerApp(AppInterface):
         __class__.send_intent(device, serialno, name, configs)
 
     @staticmethod
-    def _common_info(
-        device=None, serialno=None, ctype=None, controller=None, tolog=False, extra_params={}):
+    def _info_request(ctype, controller, extra_params={}):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "{}.info".format(ctype)
         ts = datetime.datetime.timestamp(datetime.datetime.now())
         ts = int(ts * 1000)
@@ -206,20 +381,79 @@ class AudioWorkerApp(AppInterface):
         filepath = "{}/{}/{}".format(__class__.DATA_FOLDER, controller, filename)
         configs = {"filename": filename}
         configs.update(extra_params)
-        __class__.send_intent(device, serialno, name, configs, tolog=tolog)
+        return name, configs, filepath
+
+    @staticmethod
+    def _info_query_cmd(name, configs, filepath):
+        retry = __class__.INFO_QUERY_TIMEOUT_SEC / __class__.INFO_QUERY_POLL_INTERVAL_SEC
+        retry = max(1, int(retry))
+        return ("{intent} > /dev/null; i=0; "
+            "while [ ! -s {filepath} ] && [ $i -lt {retry} ]; do "
+            "sleep {interval}; i=$((i+1)); done; "
+            "cat {filepath} 2> /dev/null; rm -f {filepath}").format(
+                intent=__class__.build_intent_cmd(name, configs), filepath=filepath,
+                retry=retry, interval=__class__.INFO_QUERY_POLL_INTERVAL_SEC)
+
+    @staticmethod
+    def _common_info(
+        device=None, serialno=None, ctype=None, controller=None, tolog=False, extra_params={}):
+        name, configs, filepath = __class__._info_request(ctype, controller, extra_params)
+
+        # The queued intents might change the info
+        __class__._flush_intent_pipeline(device, serialno)
+
+        cache_key = __class__._info_cache_key(ctype, extra_params)
+        info = __class__._get_cached_info(serialno, cache_key)
+        if info is not None:
+            return info
+        generation = __class__._get_info_cache_generation(serialno)
+
+        steps = __class__._info_query_steps(name, configs, filepath)
+        outs = None
+        try:
+            while True:
+                delay, intent, cmds = steps.send(outs)
+                time.sleep(delay)
+                intent_cmds = []
+                if intent and device:
+                    __class__.send_intent(device, serialno, *intent, tolog=tolog)
+                elif intent:
+                    intent_cmds = [__class__.build_intent_cmd(*intent)]
+                results = Adb.execute_batch(serialno, intent_cmds + cmds, tolog=tolog)
+                outs = [out for out, _, _ in results[len(intent_cmds):]]
+        except StopIteration as e:
+            info = e.value
+
+        __class__._set_cached_info(serialno, cache_key, info, generation)
+        return info
+
+    @staticmethod
+    def _info_query_steps(name, configs, filepath):
+        # The round trips of an info query, shared with AsyncAudioWorkerApp. It yields
+        # (seconds to wait, (name, configs) of the intent to send first or None, shell commands)
+        # and takes the outputs of the shell commands back, until it returns the parsed info.
+        if __class__.INFO_QUERY_COMBINED:
+            outs = yield 0, None, [__class__._info_query_cmd(name, configs, filepath)]
+            return __class__._parse_info(outs[0])
+
+        # The file is removed once it has been read, so the last retry leaves nothing behind
+        cat_cmd = "[ -s {0} ] && cat {0} && rm {0}".format(filepath)
+        outs = yield 0, (name, configs), [cat_cmd]
+        out = outs[0]
 
         retry = 10
-        while retry > 0:
-            out, err = __class__.device_shell(
-                None, serialno, cmd="cat {}".format(filepath), tolog=tolog)
-            if len(out) == 0:
-                time.sleep(0.5)
-                retry -= 1
-                continue
-            break
+        while len(out) == 0 and retry > 0:
+            retry -= 1
+            outs = yield 0.5, None, [cat_cmd]
+            out = outs[0]
 
+        if len(out) == 0:
+            yield 0, None, ["rm -f {}".format(filepath)]
+        return __class__._parse_info(out)
+
+    @staticmethod
+    def _parse_info(out):
         out = out.splitlines()
-        __class__.device_shell(None, serialno, cmd="rm {}".format(filepath), tolog=tolog)
         if len(out) == 0:
             return None
         elif len(out) == 1:
@@ -246,16 +480,16 @@ class AudioWorkerApp(AppInterface):
     def playback_stop(device=None, serialno=None, tolog=False):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "playback.stop"
         info = __class__.playback_info(device, serialno, tolog)
+        __class__.send_intents(device, serialno, [(name, configs) \
+            for configs in __class__._playback_stop_configs(info)])
+
+    @staticmethod
+    def _playback_stop_configs(info):
         if not info:
-            return
+            return []
 
-        for pbtype in info.keys():
-            for pbid in info[pbtype].keys():
-                configs = {
-                    "type": pbtype,
-                    "playback-id": int(pbid)
-                }
-                __class__.send_intent(device, serialno, name, configs)
+        return [{"type": pbtype, "playback-id": int(pbid)} \
+            for pbtype in info.keys() for pbid in info[pbtype].keys()]
 
     @staticmethod
     def record_info(device=None, serialno=None, task_index=TaskIndex.ALL, tolog=False):
@@ -263,6 +497,10 @@ class AudioWorkerApp(AppInterface):
         info = __class__._common_info(
             device, serialno, "record", "RecordController",
             extra_params={"task-index": task_index}, tolog=tolog)
+        return __class__._parse_record_info(info)
+
+    @staticmethod
+    def _parse_record_info(info):
         if info == None:
             return None
 
@@ -336,6 +574,14 @@ class AudioWorkerApp(AppInterface):
     def record_start(
         device=None, serialno=None, fs=16000, nch=2, bit_depth=16, btsco_on=True,
         perf=None, input_src=None, api=None, dump_buffer_ms=1000, task_index=0):
+        __class__.send_intent(device, serialno, *__class__._record_start_intent(
+            fs=fs, nch=nch, bit_depth=bit_depth, btsco_on=btsco_on, perf=perf,
+            input_src=input_src, api=api, dump_buffer_ms=dump_buffer_ms, task_index=task_index))
+
+    @staticmethod
+    def _record_start_intent(
+        fs=16000, nch=2, bit_depth=16, btsco_on=True,
+        perf=None, input_src=None, api=None, dump_buffer_ms=1000, task_index=0):
         task_index = int(task_index)
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "record.start"
         configs = {
@@ -349,21 +595,25 @@ class AudioWorkerApp(AppInterface):
             "dump-buffer-ms": dump_buffer_ms,
             "task-index" : task_index
         }
-        __class__.send_intent(device, serialno, name, configs)
+        return name, configs
 
     @staticmethod
     def record_stop(device=None, serialno=None, task_index=TaskIndex.ALL, tolog=False):
         task_index = int(task_index)
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "record.stop"
         info = __class__.record_info(device, serialno, task_index, tolog)
+        __class__.send_intents(device, serialno, [(name, {"task-index": track_index}) \
+            for track_index in __class__._record_task_indices(info, task_index)])
 
-        # Each task contributes to 2 elements with the track info and the detector info
-        for idx in range(0, len(info), 2):
-            track_index = info[idx]["params"]["task-index"]
-            if task_index >= 0 and task_index != track_index:
-                continue
+    @staticmethod
+    def _record_task_indices(info, task_index=TaskIndex.ALL):
+        task_index = int(task_index)
+        if not info:
+            return []
 
-            __class__.send_intent(device, serialno, name, {"task-index": track_index})
+        # Each task contributes to 2 elements with the track info and the detector info
+        return [info[idx]["params"]["task-index"] for idx in range(0, len(info), 2) \
+            if task_index < 0 or task_index == info[idx]["params"]["task-index"]]
 
     @staticmethod
     def record_dump(device=None, serialno=None, path=None, task_index=0):
@@ -374,6 +624,120 @@ class AudioWorkerApp(AppInterface):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "record.dump"
         __class__.send_intent(device, serialno, name, {"filename": path, "task-index": task_index})
 
+    @staticmethod
+    def get_record_dump_path(path):
+        if path.startswith("/"):
+            return path
+        return "{}/RecordController/{}".format(__class__.DATA_FOLDER, path)
+
+    @staticmethod
+    def _record_task_params(info, task_index=0):
+        task_index = int(task_index)
+        if not info:
+            return None
+
+        for idx in range(0, len(info), 2):
+            params = info[idx]["params"]
+            if params["task-index"] == task_index:
+                return params
+        return None
+
+    @staticmethod
+    def record_dump_fetch(
+        serialno=None, path=None, task_index=0, delete=True, timeoutsec=10, tolog=False):
+        # Dumps the buffer of the record task and reads the file through "adb exec-out" into a
+        # numpy array of shape (num_frames, num_channels) without any file on the host. Returns
+        # (data, fs), or None if the dump cannot be fetched.
+        if not path:
+            path = "record-dump-{}.wav".format(int(time.time() * 1000))
+
+        params = __class__._record_task_params(
+            __class__.record_info(serialno=serialno, task_index=task_index, tolog=tolog),
+            task_index)
+        if params is None:
+            __class__.log("record_dump_fetch: no record task {}".format(task_index))
+            return None
+
+        __class__.record_dump(serialno=serialno, path=path, task_index=task_index)
+
+        # Wait until the size of the dumped file stops growing
+        devpath = __class__.get_record_dump_path(path)
+        retry = max(1, int(timeoutsec / 0.1))
+        out, _ = Adb.execute(["shell",
+            ("prev=-1; n=0; i=0; while [ $i -lt {1} ]; do "
+            "size=$(stat -c %s {0} 2> /dev/null || echo 0); "
+            "if [ $size -gt 0 ] && [ $size -eq $prev ]; then n=$((n+1)); else n=0; fi; "
+            "[ $n -ge {2} ] && break; "
+            "prev=$size; sleep 0.1; i=$((i+1)); done; echo $size").format(
+                devpath, retry, __class__.DUMP_STABLE_CHECKS)],
+            serialno=serialno, tolog=tolog)
+        try:
+            size = int(out.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            size = 0
+        if size == 0:
+            __class__.log("record_dump_fetch: '{}' is not dumped".format(devpath))
+            return None
+
+        cmd = "cat {0}; rm -f {0}".format(devpath) if delete else "cat {}".format(devpath)
+        buf = bytearray()
+        with Adb.stream(["exec-out", cmd], serialno=serialno, binary=True, tolog=tolog) as stream:
+            for chunk in stream:
+                buf += chunk
+
+        return __class__.parse_pcm(
+            buf, fs=params["sampling-freq"], nch=params["num-channels"],
+            bit_depth=params["pcm-bit-width"])
+
+    @staticmethod
+    def parse_wav_header(buf):
+        # Returns (fs, nch, bit_depth, is_float, data offset, data size) of a RIFF/WAVE buffer,
+        # or None if it is not one.
+        if len(buf) < 12 or buf[:4] != b"RIFF" or buf[8:12] != b"WAVE":
+            return None
+
+        fmt = None
+        offset = 12
+        while offset + 8 <= len(buf):
+            chunk_id = bytes(buf[offset:offset+4])
+            chunk_size = struct.unpack("<I", buf[offset+4:offset+8])[0]
+            if chunk_id == b"fmt ":
+                audio_format, nch, fs = struct.unpack("<HHI", buf[offset+8:offset+16])
+                bit_depth = struct.unpack("<H", buf[offset+22:offset+24])[0]
+                fmt = (fs, nch, bit_depth, audio_format == 3)
+            elif chunk_id == b"data" and fmt is not None:
+                # The size might not be updated while the file is being written
+                size = min(chunk_size, len(buf) - offset - 8)
+                return fmt + (offset + 8, size)
+            offset += 8 + chunk_size + (chunk_size & 1)
+
+        return None
+
+    @staticmethod
+    def parse_pcm(buf, fs, nch, bit_depth, is_float=None):
+        # Returns (data, fs) viewing buf without copying it. A WAV header overrides the given
+        # parameters. 24-bit samples are unpacked into int32. The 32-bit samples are taken as float
+        # by default, which is how AudioWorker records them.
+        header = __class__.parse_wav_header(buf)
+        offset, size = 0, len(buf)
+        if header is not None:
+            fs, nch, bit_depth, is_float, offset, size = header
+        elif is_float is None:
+            is_float = bit_depth == 32
+
+        frame_size = nch * bit_depth // 8
+        size -= size % frame_size
+        raw = np.frombuffer(buf, dtype=np.uint8, count=size, offset=offset)
+        if bit_depth == 24:
+            raw = raw.reshape(-1, 3)
+            data = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) \
+                | (raw[:, 2].astype(np.int8).astype(np.int32) << 16))
+        else:
+            dtype = {8: np.uint8, 16: np.int16, 32: np.float32 if is_float else np.int32}
+            data = raw.view(dtype[bit_depth])
+
+        return data.reshape(-1, nch), fs
+
     @staticmethod
     def record_detector_register(device=None, serialno=None, dclass=None, params={}, task_index=0):
         __class__.tx_detector_register("record", device, serialno, dclass, params, task_index)
@@ -396,7 +760,17 @@ class AudioWorkerApp(AppInterface):
         return __class__._common_info(device, serialno, "voip", "VoIPController", tolog=tolog)
 
     @staticmethod
-    def voip_start(device=None, serialno=None, rxfreq=440., rxamp=0.6, rxspkr=False,
+    def voip_start(
+        device=None, serialno=None, rxfreq=440., rxamp=0.6, rxspkr=False,
+        rxfs=8000, txfs=8000, rxnch=1, txnch=1, rxbit_depth=16, txbit_depth=16, dump_buffer_ms=0):
+        __class__.send_intent(device, serialno, *__class__._voip_start_intent(
+            rxfreq=rxfreq, rxamp=rxamp, rxspkr=rxspkr, rxfs=rxfs, txfs=txfs, rxnch=rxnch,
+            txnch=txnch, rxbit_depth=rxbit_depth, txbit_depth=txbit_depth,
+            dump_buffer_ms=dump_buffer_ms))
+
+    @staticmethod
+    def _voip_start_intent(
+        rxfreq=440., rxamp=0.6, rxspkr=False,
         rxfs=8000, txfs=8000, rxnch=1, txnch=1, rxbit_depth=16, txbit_depth=16, dump_buffer_ms=0):
         name = __class__.AUDIOWORKER_INTENT_PREFIX + "voip.start"
         configs = {
@@ -411,7 +785,7 @@ class AudioWorkerApp(AppInterface):
             "tx-pcm-bit-width": txbit_depth,
             "tx-dump-buffer-ms": dump_buffer_ms
         }
-        __class__.send_intent(device, serialno, name, configs)
+        return name, configs
 
     @staticmethod
     def voip_stop(device=None, serialno=None):
@@ -471,7 +845,184 @@ class AudioWorkerApp(AppInterface):
     def print_log(device=None, serialno=None, severity="i", tag="AudioWorkerAPIs", log=None):
         pass
 
+class AudioWorkerIntentPipeline(object):
+    def __init__(self, serialno=None, tolog=True):
+        self.serialno = serialno
+        self.tolog = tolog
+        self.intents = []
+        self.results = []
+        self.outer = None
+
+    def __enter__(self):
+        if not hasattr(AudioWorkerApp.INTENT_PIPELINES, "pipelines"):
+            AudioWorkerApp.INTENT_PIPELINES.pipelines = {}
+        pipelines = AudioWorkerApp.INTENT_PIPELINES.pipelines
+        self.outer = pipelines.get(self.serialno)
+        if self.outer:
+            self.outer.flush()
+        pipelines[self.serialno] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The queued intents are sent even on errors, as they would have been without pipelining
+        pipelines = AudioWorkerApp.INTENT_PIPELINES.pipelines
+        if self.outer:
+            pipelines[self.serialno] = self.outer
+        else:
+            del pipelines[self.serialno]
+        self.flush()
+
+    def add(self, name, configs={}):
+        self.intents.append((name, dict(configs)))
+
+    def flush(self):
+        # Returns the results of the sent intents as dicts with the intent name, the result code
+        # and data of "am broadcast" (None if the broadcast did not complete) and the output.
+        intents, self.intents = self.intents, []
+        if len(intents) == 0:
+            return []
+
+        outputs = Adb.execute_batch(
+            self.serialno, [AudioWorkerApp.build_intent_cmd(name, configs) \
+                for name, configs in intents], tolog=self.tolog)
+        for name, _ in intents:
+            AudioWorkerApp._invalidate_info_cache_by_intent(self.serialno, name)
+
+        results = []
+        for (name, _), (out, err, _) in zip(intents, outputs):
+            result, data = AudioWorkerApp.parse_broadcast_result(out)
+            results.append({"intent": name, "result": result, "data": data, "out": out + err})
+
+        self.results += results
+        return results
+
+# Owns a set of concurrent record tasks on a device. The tasks are started and stopped together
+# in one shell invocation, and the track and detector info of all the tasks comes from one info
+# query kept for info_ttl_sec, e.g.
+#
+#   with AudioWorkerApp.record_session(serialno, task_indices=range(4)) as session:
+#       session.detector_register(2, dclass, params)
+#       detectors = session.get_detectors(2)
+class AudioWorkerRecordSession(object):
+    TAG = "AudioWorkerRecordSession"
+
+    def __init__(self, serialno=None, task_indices=[0], info_ttl_sec=0.5, tolog=False, **configs):
+        self.serialno = serialno
+        self.task_indices = sorted(set(int(task_index) for task_index in task_indices))
+        if len(self.task_indices) == 0 or self.task_indices[0] < 0:
+            raise ValueError("invalid task indices: {}".format(list(task_indices)))
+
+        self.info_ttl_sec = info_ttl_sec
+        self.tolog = tolog
+        self.configs = configs
+        self.task_configs = {}
+        self.cached_info = None
+        self.cached_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
+    def log(self, msg):
+        Logger.log(self.TAG, msg)
+
+    def _check_task_index(self, task_index):
+        task_index = int(task_index)
+        if not task_index in self.task_indices:
+            raise ValueError("the task {} is not in the session".format(task_index))
+        return task_index
+
+    def set_task_configs(self, task_index, **configs):
+        # Overrides the record configs of one task, e.g. a different input source
+        self.task_configs[self._check_task_index(task_index)] = configs
+
+    def _send(self, intents):
+        self.invalidate()
+        with AudioWorkerApp.pipeline(self.serialno, tolog=self.tolog) as pipeline:
+            AudioWorkerApp.send_intents(None, self.serialno, intents, tolog=self.tolog)
+        return pipeline.results
+
+    def start(self):
+        intents = []
+        for task_index in self.task_indices:
+            configs = dict(self.configs)
+            configs.update(self.task_configs.get(task_index, {}))
+            configs["task_index"] = task_index
+            intents.append(AudioWorkerApp._record_start_intent(**configs))
+
+        if self.tolog:
+            self.log("start the tasks {}".format(self.task_indices))
+        return self._send(intents)
+
+    def stop(self):
+        # The owned tasks are known, so no info query is needed before stopping them
+        name = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "record.stop"
+        if self.tolog:
+            self.log("stop the tasks {}".format(self.task_indices))
+        return self._send([(name, {"task-index": task_index}) for task_index in self.task_indices])
+
+    def invalidate(self):
+        self.cached_info = None
+        self.cached_time = None
+
+    def info(self, refresh=False):
+        # Returns {task_index: (track info, detector info)} of the running tasks in the session
+        if refresh or self.cached_info is None \
+            or time.time() - self.cached_time > self.info_ttl_sec:
+            info = AudioWorkerApp.record_info(serialno=self.serialno, tolog=self.tolog)
+            self.cached_time = time.time()
+            self.cached_info = {}
+            for idx in range(0, len(info) if info else 0, 2):
+                task_index = info[idx]["params"]["task-index"]
+                if task_index in self.task_indices:
+                    self.cached_info[task_index] = (info[idx], info[idx+1])
+
+        return copy.deepcopy(self.cached_info)
+
+    def is_running(self, task_index=None):
+        info = self.info()
+        task_indices = self.task_indices if task_index is None \
+            else [self._check_task_index(task_index)]
+        return all(task_index in info for task_index in task_indices)
+
+    def get_track_info(self, task_index):
+        return self.info().get(self._check_task_index(task_index), (None, None))[0]
+
+    def get_detectors(self, task_index):
+        return self.info().get(self._check_task_index(task_index), (None, None))[1]
+
+    def detector_register(self, task_index, dclass, params={}):
+        self.invalidate()
+        AudioWorkerApp.record_detector_register(
+            serialno=self.serialno, dclass=dclass, params=params,
+            task_index=self._check_task_index(task_index))
+
+    def detector_unregister(self, task_index, chandle):
+        self.invalidate()
+        AudioWorkerApp.record_detector_unregister(
+            serialno=self.serialno, chandle=chandle, task_index=self._check_task_index(task_index))
+
+    def detector_set_params(self, task_index, chandle, params={}):
+        self.invalidate()
+        AudioWorkerApp.record_detector_set_params(
+            serialno=self.serialno, chandle=chandle, params=params,
+            task_index=self._check_task_index(task_index))
+
+    def detector_clear(self, task_index=None):
+        # Unregisters the detectors of one or all tasks with the cached info in one batch
+        task_indices = self.task_indices if task_index is None \
+            else [self._check_task_index(task_index)]
+        info = self.info()
+        with AudioWorkerApp.pipeline(self.serialno, tolog=self.tolog):
+            for task_index in task_indices:
+                for chandle in info.get(task_index, (None, {}))[1].keys():
+                    self.detector_unregister(task_index, chandle)
+
+
+import queue
 import threading
 import time
 from pyaatlibs.timeutils import TicToc, TimeUtils
@@ -479,16 +1030,100 @@ from pyaatlibs.audiofunction import ToneDetectorThread, ToneDetector
 from pyaatlibs.aatapp import AATAppToneDetectorThread
 from pyaatlibs.logger import Logger
 
+# Reads a detector history file incrementally: only the bytes appended since the last read are
+# transferred, and the complete lines are parsed into a structured array.
+class AudioWorkerDetectorHistory(object):
+    DTYPE = np.dtype([("timestamp", np.float64), ("freq", np.float64), ("active", np.bool_)])
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = ""
+
+    def build_read_cmd(self):
+        # Prints the file size, then the bytes after the offset, or the whole file if it has been
+        # truncated since the last read.
+        return ("size=$(stat -c %s {0} 2> /dev/null || echo 0); echo $size; "
+            "if [ $size -lt {1} ]; then cat {0}; else tail -c +{2} {0} 2> /dev/null; fi").format(
+                self.path, self.offset, self.offset + 1)
+
+    def feed(self, out):
+        # Returns the records and the lines of the new complete lines in the output of the
+        # command built by build_read_cmd(). The history is ASCII, so chars count as bytes.
+        header, _, data = out.partition("\n")
+        try:
+            size = int(header.strip())
+        except ValueError:
+            return __class__.parse([])
+
+        if size < self.offset:
+            self.offset = 0
+            self.partial = ""
+
+        self.offset += len(data)
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        return __class__.parse(lines)
+
+    def read(self, serialno=None):
+        out, _ = Adb.execute(["shell", self.build_read_cmd()], serialno=serialno, tolog=False)
+        return self.feed(out)
+
+    @staticmethod
+    def parse(lines):
+        # Each line is like "1572251050140: 440.0 active"
+        rows = [line.split() for line in lines]
+        rows = [row for row in rows if len(row) >= 3]
+        records = np.empty(len(rows), dtype=__class__.DTYPE)
+        if len(rows) == 0:
+            return records, []
+
+        try:
+            records["timestamp"] = np.array([row[0][:-1] for row in rows]).astype(np.float64)
+            records["freq"] = np.array([row[1] for row in rows]).astype(np.float64)
+        except ValueError:
+            # Leave out the malformed lines
+            rows = [row for row in rows if __class__.is_valid_row(row)]
+            return __class__.parse([" ".join(row) for row in rows])
+
+        records["active"] = np.array([row[2].lower() == "active" for row in rows])
+        return records, [" ".join(row) for row in rows]
+
+    @staticmethod
+    def is_valid_row(row):
+        try:
+            float(row[0][:-1])
+            float(row[1])
+            return True
+        except ValueError:
+            return False
+
+    @staticmethod
+    def match_target(freqs, target_freq, tolerance_semitone=2):
+        # The vectorized ToneDetectorThread.target_detected()
+        freqs = np.asarray(freqs, dtype=np.float64)
+        if target_freq is None:
+            return freqs != 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            diff_semitone = np.abs(np.log2(freqs / target_freq) * 12)
+        return (freqs != 0) & (diff_semitone < tolerance_semitone)
+
 class AudioWorkerToneDetectorThread(AATAppToneDetectorThread):
     def __init__(self, serialno, target_freq,
         detector_reg_func, detector_unreg_func,
         detector_setparams_func, info_func, parse_detector_func,
-        callback=None, listener=None):
+        callback=None, listener=None, streaming=False, shared_poller=False):
         super(AudioWorkerToneDetectorThread, self).__init__(
             serialno=serialno, target_freq=target_freq, callback=callback)
         self.serialno = serialno
         self.chandle = None
         self.listener = listener
+        # Follow the detector history with one long-lived "tail -f" instead of polling it
+        self.streaming = streaming
+        # Share one polling loop with the other threads on the device, see
+        # AudioWorkerDetectorPoller
+        self.shared_poller = shared_poller
         self.detector_reg_func = detector_reg_func
         self.detector_unreg_func = detector_unreg_func
         self.detector_setparams_func = detector_setparams_func
@@ -500,6 +1135,9 @@ class AudioWorkerToneDetectorThread(AATAppToneDetectorThread):
     def get_tag(self):
         return "AudioWorkerToneDetectorThread"
 
+    def get_history_path(self):
+        return "{}/{}.txt".format(AudioWorkerApp.DATA_FOLDER, self.chandle)
+
     def get_info(self):
         # Record
         # [
@@ -698,28 +1336,9 @@ class AudioWorkerToneDetectorThread(AATAppToneDetectorThread):
                     if isinstance(self.listener, DetectionStateListener):
                         self.listener.tone_detected_event_cb((t_str, event))
 
-        self.enable_detect_dump(enable=True)
-
         freq_cb_tictoc = TicToc()
-        adb_tictoc = TicToc()
-
-        freq_cb_tictoc.tic()
-        while not self.stoprequest.isSet():
-            if not self.chandle:
-                self.get_info()
-
-            adb_tictoc.tic()
-            msg_in_device, _ = Adb.execute(
-                cmd=["shell",
-                    "cat /storage/emulated/0/Google-AudioWorker-data/{}.txt".format(self.chandle)],
-                serialno=self.serialno, tolog=False)
-            elapsed = adb_tictoc.toc()
-
-            msg_in_device = map(lambda x: x.strip(), msg_in_device.splitlines())
-            msg_in_device = [x for x in msg_in_device if self.target_detected(float(x.split()[1]))]
-            self.shared_vars["msg"] = \
-                msg_in_device[-1] if len(msg_in_device) > 0 else self.shared_vars["msg"]
 
+        def handle_msg(elapsed):
             if elapsed > self.extra["adb-read-prop-max-elapsed"]:
                 self.extra["adb-read-prop-max-elapsed"] = elapsed
 
@@ -737,6 +1356,257 @@ class AudioWorkerToneDetectorThread(AATAppToneDetectorThread):
                 if elapsed > self.extra["freq-cb-max-elapsed"]:
                     self.extra["freq-cb-max-elapsed"] = elapsed
 
-            time.sleep(0.04)
+        if self.shared_poller:
+            # The poller resolves the handle and enables the dump of the history
+            freq_cb_tictoc.tic()
+            self.run_shared(handle_msg)
+            return
+
+        self.enable_detect_dump(enable=True)
+
+        freq_cb_tictoc.tic()
+        if self.streaming:
+            self.run_streaming(handle_msg)
+        else:
+            self.run_polling(handle_msg)
 
         self.enable_detect_dump(enable=False)
+
+    def run_shared(self, handle_msg):
+        msgs = queue.Queue()
+        poller = AudioWorkerDetectorPoller.subscribe(self, msgs)
+        try:
+            while not self.stoprequest.is_set():
+                elapsed = 0
+                try:
+                    self.shared_vars["msg"], elapsed = msgs.get(timeout=0.04)
+                except queue.Empty:
+                    pass
+
+                handle_msg(elapsed)
+        finally:
+            poller.unsubscribe(self)
+
+    def is_target_msg(self, msg):
+        try:
+            return self.target_detected(float(msg.split()[1]))
+        except (IndexError, ValueError):
+            return False
+
+    def run_polling(self, handle_msg):
+        adb_tictoc = TicToc()
+        history = None
+        while not self.stoprequest.is_set():
+            if not self.chandle:
+                self.get_info()
+
+            if history is None or history.path != self.get_history_path():
+                history = AudioWorkerDetectorHistory(self.get_history_path())
+
+            adb_tictoc.tic()
+            records, lines = history.read(self.serialno)
+            elapsed = adb_tictoc.toc()
+
+            matched = np.flatnonzero(
+                AudioWorkerDetectorHistory.match_target(records["freq"], self.target_freq))
+            if len(matched) > 0:
+                self.shared_vars["msg"] = lines[matched[-1]]
+
+            handle_msg(elapsed)
+            time.sleep(0.04)
+
+    @staticmethod
+    def read_stream(stream, msgs):
+        for line in stream:
+            msgs.put((line.strip(), time.time()))
+
+    def run_streaming(self, handle_msg):
+        # Each new line of the history is handled as soon as it arrives. Without new lines, the
+        # last message is handled again every 40 ms as the polling does, so that the detection
+        # state keeps accumulating its duration.
+        msgs = queue.Queue()
+        stream = None
+        reader = None
+        while not self.stoprequest.is_set():
+            if not self.chandle:
+                self.get_info()
+                if not self.chandle:
+                    time.sleep(0.04)
+                    continue
+
+            if reader is None or not reader.is_alive():
+                if stream is not None:
+                    stream.close()
+                path = self.get_history_path()
+                cmd = "while [ ! -f {0} ]; do sleep 0.04; done; exec tail -n 1 -f {0}".format(path)
+                stream = Adb.stream(["shell", cmd], serialno=self.serialno, tolog=False)
+                reader = threading.Thread(target=__class__.read_stream, args=(stream, msgs))
+                reader.daemon = True
+                reader.start()
+
+            elapsed = 0
+            try:
+                msg, t = msgs.get(timeout=0.04)
+                if self.is_target_msg(msg):
+                    self.shared_vars["msg"] = msg
+                    elapsed = (time.time() - t) * 1000.
+            except queue.Empty:
+                pass
+
+            handle_msg(elapsed)
+
+        if stream is not None:
+            stream.close()
+            reader.join()
+
+# One polling loop per device and info function serving all the subscribed
+# AudioWorkerToneDetectorThreads. The detector handles are resolved from one info query, and
+# the histories of all the handles are read in one adb round trip per cycle.
+class AudioWorkerDetectorPoller(threading.Thread):
+    POLLERS = {}
+    POLLERS_LOCK = threading.Lock()
+    PERIOD_SEC = 0.04
+
+    def __init__(self, serialno, info_func, parse_detector_func, detector_setparams_func):
+        super(AudioWorkerDetectorPoller, self).__init__()
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        self.serialno = serialno
+        self.info_func = info_func
+        self.parse_detector_func = parse_detector_func
+        self.detector_setparams_func = detector_setparams_func
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        # The number of subscribers of each handle, whose history is dumped while it is subscribed
+        self.dump_refs = {}
+        self.dump_lock = threading.Lock()
+        self.histories = {}
+        self.extra = {"adb-read-prop-max-elapsed": -1}
+
+    def get_tag(self):
+        return "AudioWorkerDetectorPoller"
+
+    @staticmethod
+    def subscribe(th, msgs):
+        # The new lines matching th.target_freq are put into msgs as (line, elapsed ms)
+        key = (th.serialno, th.info_func)
+        with __class__.POLLERS_LOCK:
+            poller = __class__.POLLERS.get(key)
+            if poller is None:
+                poller = AudioWorkerDetectorPoller(
+                    th.serialno, th.info_func, th.parse_detector_func,
+                    th.detector_setparams_func)
+                __class__.POLLERS[key] = poller
+                poller.start()
+
+            with poller.subscribers_lock:
+                poller.subscribers[th] = msgs
+
+        return poller
+
+    def unsubscribe(self, th):
+        with self.dump_lock:
+            with self.subscribers_lock:
+                self.subscribers.pop(th, None)
+            if th.chandle in self.dump_refs:
+                self.dump_refs[th.chandle] -= 1
+                if self.dump_refs[th.chandle] == 0:
+                    del self.dump_refs[th.chandle]
+                    self.detector_setparams_func(
+                        serialno=self.serialno, chandle=th.chandle,
+                        params={"dump-history": "false"})
+
+        with __class__.POLLERS_LOCK:
+            with self.subscribers_lock:
+                if len(self.subscribers) > 0:
+                    return
+
+            if __class__.POLLERS.get((self.serialno, self.info_func)) is self:
+                del __class__.POLLERS[(self.serialno, self.info_func)]
+
+        self.join()
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(AudioWorkerDetectorPoller, self).join(timeout)
+
+    def resolve_handles(self, subscribers):
+        info = self.info_func(serialno=self.serialno)
+        if not info:
+            return
+
+        detectors = self.parse_detector_func(info)
+        resolved = []
+        for th in subscribers:
+            # The last matching detector is taken as AudioWorkerToneDetectorThread.get_info() does
+            chandle = None
+            for key, value in detectors.items():
+                if any(th.target_detected(each["target-freq"]) for each in value["Targets"]):
+                    chandle = key
+            if chandle:
+                Logger.log(self.get_tag(), "found detector handle: {} for target {} Hz".format(
+                    chandle, th.target_freq))
+                resolved.append((th, chandle))
+
+        with self.dump_lock:
+            enabled = []
+            with self.subscribers_lock:
+                for th, chandle in resolved:
+                    if not th in self.subscribers:
+                        continue
+                    th.chandle = chandle
+                    self.dump_refs[chandle] = self.dump_refs.get(chandle, 0) + 1
+                    if self.dump_refs[chandle] == 1:
+                        enabled.append(chandle)
+
+            with AudioWorkerApp.pipeline(self.serialno, tolog=False):
+                for chandle in enabled:
+                    self.detector_setparams_func(
+                        serialno=self.serialno, chandle=chandle, params={"dump-history": "true"})
+
+    def poll(self):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers.items())
+
+        unresolved = [th for th, _ in subscribers if not th.chandle]
+        if len(unresolved) > 0:
+            self.resolve_handles(unresolved)
+
+        paths = {th.chandle: th.get_history_path() for th, _ in subscribers if th.chandle}
+        handles = sorted(paths.keys())
+        if len(handles) == 0:
+            return
+
+        for chandle in handles:
+            if not chandle in self.histories or self.histories[chandle].path != paths[chandle]:
+                self.histories[chandle] = AudioWorkerDetectorHistory(paths[chandle])
+
+        tictoc = TicToc()
+        tictoc.tic()
+        results = Adb.execute_batch(
+            self.serialno, [self.histories[chandle].build_read_cmd() for chandle in handles],
+            tolog=False)
+        elapsed = tictoc.toc()
+        self.extra["adb-read-prop-max-elapsed"] = \
+            max(elapsed, self.extra["adb-read-prop-max-elapsed"])
+
+        for chandle, (out, _, _) in zip(handles, results):
+            records, lines = self.histories[chandle].feed(out)
+            if len(records) == 0:
+                continue
+
+            for th, msgs in subscribers:
+                if th.chandle != chandle:
+                    continue
+                matched = np.flatnonzero(
+                    AudioWorkerDetectorHistory.match_target(records["freq"], th.target_freq))
+                if len(matched) > 0:
+                    msgs.put((lines[matched[-1]], elapsed))
+
+    def run(self):
+        while not self.stoprequest.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                Logger.log(self.get_tag(), "failed to poll: {}".format(e))
+            self.stoprequest.wait(__class__.PERIOD_SEC)
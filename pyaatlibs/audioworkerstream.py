@@ -0,0 +1,220 @@
+import bisect
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from pyaatlibs.adbutils import Adb
+from pyaatlibs.audioworker import AudioWorkerApp
+from pyaatlibs.logger import Logger
+
+# Streams the audio of a running record task to the host. The app can only dump the latest
+# dump-buffer-ms of a task, so a long-lived "adb exec-out" loop on the device dumps the task
+# every period and sends the tail of each dump, which covers the time since the previous dump
+# plus overlap_sec, with its device uptime. The host finds where each dump continues the frames
+# it has received by matching their last PROBE_FRAMES frames, keeps the new part in a bounded
+# ring buffer, and delivers fixed-size frames to subscribers. The uptime, which ticks in 10 ms
+# and includes the latency of the broadcast, only picks the nearest match and dates the frames
+# after a gap.
+#
+# The period should be shorter than the dump-buffer-ms of the task, otherwise there are gaps.
+class AudioWorkerRecordStream(threading.Thread):
+    TAG = "AudioWorkerRecordStream"
+    HEADER = b"PYAAT_PCM"
+    PROBE_FRAMES = 32
+
+    def __init__(
+        self, serialno=None, task_index=0, period_sec=0.2, buffer_sec=10., overlap_sec=0.2,
+        tolog=False):
+        super(AudioWorkerRecordStream, self).__init__()
+        self.daemon = True
+        self.serialno = serialno
+        self.task_index = int(task_index)
+        self.period_sec = period_sec
+        self.buffer_sec = buffer_sec
+        self.overlap_sec = overlap_sec
+        self.tolog = tolog
+        self.stream = None
+        self.fs = None
+        self.nch = None
+        self.bit_depth = None
+        self.buffer = None
+        self.num_frames = 0
+        self.last_time = None
+        # The (position, device uptime) of the first frame after each gap
+        self.anchors = []
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.extra = {"dumps": 0, "dropped-frames": 0}
+
+    def log(self, msg):
+        Logger.log(self.TAG, msg)
+
+    def subscribe(self, frame_size, callback):
+        # callback(frames, timestamp) is called on the stream thread with frames of shape
+        # (frame_size, num_channels) and the device uptime in seconds of the first frame.
+        with self.lock:
+            self.subscribers.append({
+                "frame_size": int(frame_size), "callback": callback, "position": self.num_frames})
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s["callback"] != callback]
+
+    def build_cmd(self):
+        filename = "pyaat-stream-{}.pcm".format(self.task_index)
+        path = AudioWorkerApp.get_record_dump_path(filename)
+        intent = AudioWorkerApp.build_intent_cmd(
+            AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX + "record.dump",
+            {"filename": filename, "task-index": self.task_index})
+        # The uptime is in 10 ms ticks, which are counted as "ct" for the shell arithmetic
+        return ("last=0; while true; do rm -f {path}; t=$(cut -d ' ' -f 1 /proc/uptime); "
+            "ct=${{t%.*}}${{t#*.}}; "
+            "{intent} > /dev/null; i=0; prev=-1; n=0; while [ $i -lt 50 ]; do "
+            "size=$(stat -c %s {path} 2> /dev/null || echo 0); "
+            "if [ $size -gt 0 ] && [ $size -eq $prev ]; then n=$((n+1)); else n=0; fi; "
+            "[ $n -ge {checks} ] && break; "
+            "prev=$size; sleep 0.02; i=$((i+1)); done; "
+            "n=$size; [ $last -gt 0 ] && n=$(((ct - last + {overlap}) * {fs} / 100 * {fbytes})); "
+            "[ $n -gt $size ] && n=$size; last=$ct; "
+            "echo \"{header} $n $t\"; [ $n -gt 0 ] && head -c $size {path} | tail -c $n; "
+            "sleep {period}; done").format(
+                path=path, intent=intent, header=__class__.HEADER.decode(), period=self.period_sec,
+                checks=AudioWorkerApp.DUMP_STABLE_CHECKS, overlap=int(self.overlap_sec * 100),
+                fs=self.fs, fbytes=self.nch * self.bit_depth // 8)
+
+    def start(self):
+        params = AudioWorkerApp._record_task_params(
+            AudioWorkerApp.record_info(serialno=self.serialno, task_index=self.task_index),
+            self.task_index)
+        if params is None:
+            raise RuntimeError("no record task {} is running".format(self.task_index))
+
+        self.fs = params["sampling-freq"]
+        self.nch = params["num-channels"]
+        self.bit_depth = params["pcm-bit-width"]
+        self.buffer = None
+        self.stream = Adb.stream(
+            ["exec-out", self.build_cmd()], serialno=self.serialno, binary=True, tolog=self.tolog)
+        super(AudioWorkerRecordStream, self).start()
+
+    def join(self, timeout=None):
+        if self.stream is not None:
+            self.stream.close()
+        super(AudioWorkerRecordStream, self).join(timeout)
+
+    def read_latest(self, num_frames):
+        # Returns a copy of the latest num_frames frames and the device uptime of the first one
+        with self.lock:
+            if self.buffer is None:
+                return None, None
+            num_frames = min(num_frames, self.num_frames, len(self.buffer))
+            start = self.num_frames - num_frames
+            return self._copy_frames(start, num_frames), self._time_of(start)
+
+    def _time_of(self, position):
+        idx = max(0, bisect.bisect_right(self.anchors, (position, float("inf"))) - 1)
+        anchor_position, anchor_time = self.anchors[idx]
+        return anchor_time + (position - anchor_position) / self.fs
+
+    def _copy_frames(self, position, num_frames):
+        idx = np.arange(position, position + num_frames) % len(self.buffer)
+        return self.buffer[idx]
+
+    def _find_overlap(self, data, expected):
+        # Returns the number of the leading frames of data which have been received, taking the
+        # match nearest to the expected number, or None if data does not continue the frames
+        num_probe = min(__class__.PROBE_FRAMES, self.num_frames, len(self.buffer), len(data))
+        if num_probe == 0:
+            return None
+
+        probe = self._copy_frames(self.num_frames - num_probe, num_probe)
+        windows = sliding_window_view(data, num_probe, axis=0)
+        matched = np.flatnonzero(np.all(windows == probe.T, axis=(1, 2))) + num_probe
+        if len(matched) == 0:
+            return None
+        return int(matched[np.argmin(np.abs(matched - expected))])
+
+    def _write(self, data, t):
+        if self.buffer is None:
+            self.buffer = np.zeros(
+                (int(self.buffer_sec * self.fs), data.shape[1]), dtype=data.dtype)
+
+        # Keep only the frames after the previous dump
+        overlap = None
+        if self.last_time is not None:
+            expected = int(round((t - self.last_time) * self.fs))
+            overlap = self._find_overlap(data, len(data) - expected)
+            if overlap is None and expected > len(data):
+                self.extra["dropped-frames"] += expected - len(data)
+
+        if overlap is None:
+            self.anchors.append((self.num_frames, t - len(data) / self.fs))
+            overlap = 0
+        self.last_time = t
+
+        num_new = len(data) - overlap
+        data = data[overlap:][-len(self.buffer):]
+        position = self.num_frames + num_new - len(data)
+        idx = np.arange(position, position + len(data)) % len(self.buffer)
+        self.buffer[idx] = data
+        self.num_frames += num_new
+
+        # Only the anchor dating the oldest frame in the buffer and the later ones are kept
+        oldest = self.num_frames - len(self.buffer)
+        while len(self.anchors) > 1 and self.anchors[1][0] <= oldest:
+            del self.anchors[0]
+
+    def _dispatch(self):
+        deliveries = []
+        with self.lock:
+            for subscriber in self.subscribers:
+                # The frames overwritten in the ring buffer are skipped
+                subscriber["position"] = max(
+                    subscriber["position"], self.num_frames - len(self.buffer))
+                while self.num_frames - subscriber["position"] >= subscriber["frame_size"]:
+                    position = subscriber["position"]
+                    deliveries.append((subscriber["callback"],
+                        self._copy_frames(position, subscriber["frame_size"]),
+                        self._time_of(position)))
+                    subscriber["position"] += subscriber["frame_size"]
+
+        for callback, frames, t in deliveries:
+            try:
+                callback(frames, t)
+            except Exception as e:
+                self.log("crashed in the subscriber callback: {}".format(e))
+
+    def handle_dump(self, payload, t):
+        self.extra["dumps"] += 1
+        if len(payload) == 0:
+            return
+
+        data, _ = AudioWorkerApp.parse_pcm(
+            payload, fs=self.fs, nch=self.nch, bit_depth=self.bit_depth)
+        with self.lock:
+            self._write(data, t)
+        self._dispatch()
+
+    def run(self):
+        buf = bytearray()
+        header = None
+        for chunk in self.stream:
+            buf += chunk
+            while True:
+                if header is None:
+                    end = buf.find(b"\n")
+                    if end < 0:
+                        break
+                    line = bytes(buf[:end]).split()
+                    del buf[:end+1]
+                    if len(line) != 3 or line[0] != __class__.HEADER:
+                        continue
+                    header = (int(line[1]), float(line[2]))
+
+                size, t = header
+                if len(buf) < size:
+                    break
+                payload = bytearray(buf[:size])
+                del buf[:size]
+                header = None
+                self.handle_dump(payload, t)
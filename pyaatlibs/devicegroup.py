@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyaatlibs.adbutils import Adb
+from pyaatlibs.logger import Logger
+
+class DeviceResult(object):
+    def __init__(self, serialno, result=None, exception=None, elapsed_ms=0):
+        self.serialno = serialno
+        self.result = result
+        self.exception = exception
+        self.elapsed_ms = elapsed_ms
+
+    def succeeded(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return "DeviceResult(serialno={}, result={}, exception={}, elapsed_ms={:.1f})".format(
+            self.serialno, self.result, repr(self.exception), self.elapsed_ms)
+
+# Runs the same Adb/AudioWorkerApp operation on a set of devices concurrently. Any callable
+# accepting the keyword argument "serialno" can be fanned out, e.g.
+#
+#   with DeviceGroup(serialnos) as group:
+#       group.run(AudioWorkerApp.install, grant=True)
+#       results = group.run(AudioWorkerApp.record_info)
+class DeviceGroup(object):
+    TAG = "DeviceGroup"
+
+    def __init__(self, serialnos, max_workers=16, max_per_device=1, max_adb_commands=None):
+        self.serialnos = list(serialnos)
+        self.device_semaphores = {
+            serialno: threading.BoundedSemaphore(max_per_device) for serialno in self.serialnos}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # The cap applies to the adb commands and streams of the calls run by the group only
+        self.command_semaphore = \
+            threading.BoundedSemaphore(max_adb_commands) if max_adb_commands else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _run(self, serialno, func, args, kwargs):
+        with self.device_semaphores[serialno]:
+            saved_semaphore = Adb.set_thread_command_limit(self.command_semaphore)
+            start = time.time()
+            try:
+                result = func(*args, serialno=serialno, **kwargs)
+                exception = None
+            except Exception as e:
+                Logger.log(self.TAG, "'{}' failed on '{}': {}".format(
+                    getattr(func, "__name__", func), serialno, repr(e)))
+                result = None
+                exception = e
+            finally:
+                Adb.set_thread_command_limit(saved_semaphore)
+
+            return DeviceResult(
+                serialno, result=result, exception=exception,
+                elapsed_ms=(time.time() - start) * 1000.)
+
+    def submit(self, func, *args, serialnos=None, **kwargs):
+        serialnos = self.serialnos if serialnos is None else serialnos
+        unknown_serialnos = [serialno for serialno in serialnos \
+            if not serialno in self.device_semaphores]
+        if len(unknown_serialnos) > 0:
+            raise ValueError("{} are not in the group".format(unknown_serialnos))
+
+        return {serialno: self.executor.submit(self._run, serialno, func, args, kwargs) \
+            for serialno in serialnos}
+
+    def run(self, func, *args, serialnos=None, **kwargs):
+        futures = self.submit(func, *args, serialnos=serialnos, **kwargs)
+        return {serialno: future.result() for serialno, future in futures.items()}
@@ -0,0 +1,117 @@
+import re
+
+# Parses the output of dumpsys into sections. The section headers are indexed in one pass, and
+# the lines of a section are sliced and parsed only when the section is accessed.
+class DumpsysSection(object):
+    def __init__(self, name, header, lines):
+        self.name = name
+        self.header = header
+        self.lines = lines
+        self._values = None
+
+    def __repr__(self):
+        return "DumpsysSection({}, {} lines)".format(self.name, len(self.lines))
+
+    @staticmethod
+    def parse_value(str_v):
+        str_v = str_v.strip()
+        if str_v.lower() in ["true", "false"]:
+            return str_v.lower() == "true"
+
+        if str_v.isdigit():
+            return int(str_v)
+
+        try:
+            return float(str_v)
+        except ValueError:
+            return str_v
+
+    @staticmethod
+    def parse_line(line):
+        # "k: v" gives {k: v}, and "k: subk0: v0, subk1: v1" gives {k: {subk0: v0, subk1: v1}}
+        result = [v for fragment in line.strip().split(":") for v in fragment.split(",")]
+        if len(result) == 2:
+            k, v = result
+            return {k.strip(): __class__.parse_value(v)}
+
+        if len(result) % 2 == 1 and len(result) > 1:
+            return {result[0]: {
+                result[idx].strip(): __class__.parse_value(result[idx+1])
+                for idx in range(1, len(result), 2)}}
+
+        return {}
+
+    def values(self):
+        if self._values is None:
+            self._values = {}
+            for line in self.lines:
+                self._values.update(__class__.parse_line(line))
+
+        return self._values
+
+class DumpsysParser(object):
+    # Matches headers like "- STREAM_MUSIC:"
+    HEADER_PATTERN = r"^(\s*)- (\S+):\s*$"
+
+    def __init__(self, lines, header_pattern=None):
+        self.lines = lines
+        self.header_re = re.compile(header_pattern if header_pattern else __class__.HEADER_PATTERN)
+        self.index = {}
+        self.names = []
+        for idx, line in enumerate(lines):
+            m = self.header_re.match(line)
+            if m and not m.group(2) in self.index:
+                self.index[m.group(2)] = (idx, len(m.group(1)))
+                self.names.append(m.group(2))
+
+        self.sections = {}
+
+    @staticmethod
+    def indent_of(line):
+        return len(line) - len(line.lstrip())
+
+    @classmethod
+    def from_lines(child, lines, section_prefix=None, header_pattern=None):
+        # Consumes lines from any iterable, e.g. an AdbStream. With section_prefix, only the run of
+        # sections whose names start with the prefix is kept and the iteration stops after it.
+        if not section_prefix:
+            return child(list(lines), header_pattern=header_pattern)
+
+        header_re = re.compile(header_pattern if header_pattern else child.HEADER_PATTERN)
+        kept = []
+        indent = None
+        for line in lines:
+            m = header_re.match(line)
+            if m and m.group(2).startswith(section_prefix):
+                indent = len(m.group(1))
+            elif indent is None:
+                continue
+            elif len(line.strip()) > 0 and child.indent_of(line) <= indent:
+                break
+            kept.append(line)
+
+        return child(kept, header_pattern=header_pattern)
+
+    def get_section_names(self, prefix=""):
+        return [name for name in self.names if name.startswith(prefix)]
+
+    def get_section(self, name):
+        if name in self.sections:
+            return self.sections[name]
+        if not name in self.index:
+            return None
+
+        start, indent = self.index[name]
+        end = start + 1
+        while end < len(self.lines):
+            line = self.lines[end]
+            if len(line.strip()) > 0 and __class__.indent_of(line) <= indent:
+                break
+            end += 1
+
+        section = DumpsysSection(name, self.lines[start], self.lines[start+1:end])
+        self.sections[name] = section
+        return section
+
+    def get_sections(self, prefix=""):
+        return [self.get_section(name) for name in self.get_section_names(prefix)]
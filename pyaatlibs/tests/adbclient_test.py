@@ -0,0 +1,93 @@
+import pytest
+
+import threading
+import time
+
+from pyaatlibs.adbclient import AdbServerClient
+from pyaatlibs.adbutils import Adb, AdbDeviceTracker
+
+@pytest.fixture
+def native_backend(fake_adb_server, monkeypatch):
+    monkeypatch.setattr(Adb, "HAS_BEEN_INIT", True)
+    Adb.set_backend(Adb.BACKEND_NATIVE, port=fake_adb_server.port)
+    yield fake_adb_server
+    Adb.set_backend(Adb.BACKEND_CLI)
+
+def test_host_requests(fake_adb_server):
+    client = AdbServerClient(port=fake_adb_server.port)
+    assert client.host_request("host:version") == "0029"
+    assert client.devices() == [("fake-serialno", "device")]
+    assert "shell_v2" in client.get_features("fake-serialno")
+
+    with pytest.raises(RuntimeError, match="unknown host service"):
+        client.host_request("host:unknown")
+
+def test_shell_v2(fake_adb_server):
+    client = AdbServerClient(port=fake_adb_server.port)
+    assert client.shell("echo out; echo err >&2; exit 2", "fake-serialno") == \
+        (b"out\n", b"err\n", 2)
+    assert client.exec_out("printf '\\001\\002'", "fake-serialno") == b"\x01\x02"
+    assert fake_adb_server.requests[-2:] == \
+        ["host:transport:fake-serialno", "exec:printf '\\001\\002'"]
+
+    with pytest.raises(RuntimeError, match="not found"):
+        client.shell("true", "unknown-serialno")
+
+def test_legacy_shell(fake_adb_server):
+    fake_adb_server.features = "cmd"
+    client = AdbServerClient(port=fake_adb_server.port)
+    assert client.shell("echo out; echo err >&2", "fake-serialno") == (b"out\nerr\n", b"", None)
+
+def test_adb_native_backend(native_backend):
+    assert Adb.get_devices(tolog=False) == ["fake-serialno"]
+    assert Adb.execute(["shell", "echo", "hello"], serialno="fake-serialno", tolog=False) == \
+        ("hello\n", "")
+
+    native_backend.set_devices({"fake-serialno": "offline"})
+    out, err = Adb._execute(["shell", "true"], serialno="fake-serialno", tolog=False)
+    assert err == "error: device 'fake-serialno' not found\n"
+
+def test_adb_native_stream(native_backend):
+    serialno = "fake-serialno"
+    with Adb.stream(["shell", "echo a; echo err >&2; echo b"], serialno, tolog=False) as stream:
+        assert list(stream) == ["a", "b"]
+    with Adb.stream(["exec-out", "printf '\\001'"], serialno, binary=True, tolog=False) as stream:
+        assert b"".join(stream) == b"\x01"
+
+    native_backend.features = "cmd"
+    Adb.NATIVE_CLIENT.features.clear()
+    with Adb.stream(["shell", "echo a; echo b"], serialno, tolog=False) as stream:
+        assert next(iter(stream)) == "a"
+
+def test_device_tracker(native_backend):
+    Adb.start_device_tracker()
+    try:
+        assert Adb.DEVICE_TRACKER.is_ready()
+        assert Adb.get_devices(tolog=False) == ["fake-serialno"]
+
+        timer = threading.Timer(0.2, native_backend.set_devices, args=[
+            {"fake-serialno": "device", "another-serialno": "device"}])
+        timer.start()
+        Adb.wait_for_device("another-serialno", timeoutsec=5, tolog=False)
+        assert Adb.is_device_available("another-serialno", tolog=False)
+        timer.join()
+
+        requests = list(native_backend.requests)
+        assert Adb.get_devices(tolog=False) == ["fake-serialno", "another-serialno"]
+        assert native_backend.requests == requests
+    finally:
+        Adb.stop_device_tracker()
+
+def test_device_tracker_wait_for_devices():
+    tracker = AdbDeviceTracker()
+    tracker._update([("fake-serialno", "device")])
+    assert tracker.wait_for_devices(lambda devices: "fake-serialno" in devices, 0)
+    assert not tracker.wait_for_devices(lambda devices: "another-serialno" in devices, 0.1)
+
+    timer = threading.Timer(0.1, tracker._update, args=[
+        [("fake-serialno", "device"), ("another-serialno", "device")]])
+    timer.start()
+    tictoc = time.time()
+    assert tracker.wait_for_devices(lambda devices: "another-serialno" in devices, 5)
+    assert time.time() - tictoc < 1
+    timer.join()
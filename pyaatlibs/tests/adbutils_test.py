@@ -0,0 +1,164 @@
+import pytest
+
+import os
+import subprocess
+import sys
+import threading
+
+import pyaatlibs
+
+from pyaatlibs.adbstats import AdbCommandStats
+from pyaatlibs.adbutils import Adb, AdbShellScript, AdbShellSession
+
+def test_shell_session_output(fake_adb):
+    session = AdbShellSession(fake_adb)
+    assert session.execute("echo out; echo err >&2") == ("out\n", "err\n", 0)
+    assert session.execute("printf no-newline") == ("no-newline", "", 0)
+    assert session.execute("printf 'a\\n\\n'") == ("a\n\n", "", 0)
+    assert session.execute("exit 3") == ("", "", 3)
+    assert session.execute("cat") == ("", "", 0)
+    assert session.execute("echo alive") == ("alive\n", "", 0)
+    session.close()
+
+def test_shell_session_merged_output(fake_adb, tmp_path):
+    from conftest import FAKE_ADB_SCRIPT
+
+    # the shell of devices without the shell protocol v2 merges stderr into stdout
+    (tmp_path / "adb").write_text(FAKE_ADB_SCRIPT.replace("exec sh;", "exec sh 2>&1;"))
+    session = AdbShellSession(fake_adb)
+    assert session.execute("printf abc") == ("abc", "", 0)
+    assert session.execute("echo out; echo err >&2") == ("out\nerr\n", "", 0)
+    assert session.execute("printf 'a\\n\\n'") == ("a\n\n", "", 0)
+    assert session.execute("exit 3") == ("", "", 3)
+    session.close()
+
+def test_shell_session_reconnect(fake_adb):
+    session = AdbShellSession(fake_adb)
+    assert session.execute("echo 1")[0] == "1\n"
+    session.proc.kill()
+    session.proc.wait()
+    assert session.execute("echo 2")[0] == "2\n"
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        session.execute("sleep 5", timeoutsec=0.2)
+    assert session.execute("echo 3")[0] == "3\n"
+    session.close()
+
+def test_execute_through_shell_session(fake_adb):
+    Adb.enable_shell_session()
+    assert Adb.execute(["shell", "echo", "hello"], serialno=fake_adb, tolog=False) == \
+        ("hello\n", "")
+    assert fake_adb in Adb.SHELL_SESSIONS
+
+    Adb.enable_shell_session(False)
+    assert len(Adb.SHELL_SESSIONS) == 0
+    assert Adb.execute(["shell", "echo", "hello"], serialno=fake_adb, tolog=False) == \
+        ("hello\n", "")
+
+def test_execute_batch(fake_adb):
+    cmds = ["echo out; echo err >&2", "printf no-newline", "exit 3", "cat", "echo last"]
+    expected = [
+        ("out\n", "err\n", 0),
+        ("no-newline", "", 0),
+        ("", "", 3),
+        ("", "", 0),
+        ("last\n", "", 0)
+    ]
+    assert Adb.execute_batch(fake_adb, cmds, tolog=False) == expected
+    assert Adb.execute_batch(fake_adb, [], tolog=False) == []
+
+    Adb.enable_shell_session()
+    assert Adb.execute_batch(fake_adb, cmds, tolog=False) == expected
+
+def test_split_batch_output():
+    sentinel = "S"
+    # stderr merged into stdout by devices without the shell protocol v2
+    out = "a\nerr\n\nS 0\n\nS 0 1\n\n\nS 1\n\nS 1 0\n"
+    assert AdbShellScript.split(out, "", sentinel, 2) == [("a\nerr\n", "", 1), ("\n", "", 0)]
+
+    # the script is interrupted in the second command
+    out, err = "a\n\nS 0 0\npartial", "\nS 0\nerror: closed\n"
+    assert AdbShellScript.split(out, err, sentinel, 3) == \
+        [("a\n", "", 0), ("partial", "error: closed\n", None), ("", "", None)]
+
+def test_stream(fake_adb):
+    with Adb.stream(["shell", "printf 'a\\r\\nb\\n\\nc'"], serialno=fake_adb, tolog=False) as s:
+        assert list(s) == ["a", "b", "", "c"]
+
+    cmd = ["exec-out", "printf '\\001\\002'"]
+    with Adb.stream(cmd, serialno=fake_adb, binary=True, tolog=False) as s:
+        assert b"".join(s) == b"\x01\x02"
+
+def test_stream_early_termination(fake_adb):
+    stream = Adb.stream(["shell", "yes"], serialno=fake_adb, tolog=False)
+    for idx, line in enumerate(stream):
+        if idx == 10:
+            break
+    stream.close()
+    assert stream.proc.returncode is not None
+
+    # close() from another thread stops a blocked iteration
+    stream = Adb.stream(["shell", "echo first; exec sleep 5"], serialno=fake_adb, tolog=False)
+    threading.Timer(0.2, stream.close).start()
+    assert list(stream) == ["first"]
+
+def test_stream_timeout(fake_adb):
+    import time
+
+    stream = Adb.stream(
+        ["shell", "echo first; exec sleep 5"], serialno=fake_adb, tolog=False, timeoutsec=0.3)
+    lines = []
+    tictoc = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        with stream:
+            for line in stream:
+                lines.append(line)
+    assert lines == ["first"] and time.time() - tictoc < 2
+    assert stream.proc.returncode is not None
+
+    # the deadline does not apply once the stream is closed
+    with Adb.stream(["shell", "echo done"], serialno=fake_adb, tolog=False, timeoutsec=5) as s:
+        assert list(s) == ["done"]
+    assert s.timer.finished.is_set() and not s.timedout
+
+def test_command_stats(fake_adb):
+    Adb.reset_stats()
+    Adb.set_slow_command_threshold(100)
+    try:
+        Adb.execute(["shell", "getprop ro.serialno"], serialno=fake_adb, tolog=False)
+        Adb.execute(["shell", "sleep 0.2"], serialno=fake_adb, tolog=False)
+        Adb.execute_batch(fake_adb, ["true", "true"], tolog=False)
+    finally:
+        Adb.set_slow_command_threshold(AdbCommandStats.DEFAULT_SLOW_THRESHOLD_MS)
+
+    stats = Adb.stats()
+    entries = {(e["serialno"], e["kind"]): e for e in stats["commands"]}
+    assert set(entries.keys()) >= \
+        {(fake_adb, "getprop"), (fake_adb, "shell"), (fake_adb, "batch")}
+    assert entries[(fake_adb, "shell")]["count"] == 1
+    assert entries[(fake_adb, "shell")]["transport"] == "usb"
+    assert entries[(fake_adb, "shell")]["max_ms"] >= 200
+    assert sum(entries[(fake_adb, "shell")]["histogram"].values()) == 1
+    assert [e["cmd"] for e in stats["slow_commands"]] == [["shell", "sleep 0.2"]]
+    assert len(Adb.COMMAND_STATS.dump()) > 1
+
+def test_finalize_at_exit(fake_adb):
+    script = "\n".join([
+        "from pyaatlibs.adbutils import Adb",
+        "Adb.HAS_BEEN_INIT = True",
+        "Adb.execute(['shell', 'true'], serialno='{}', tolog=False)".format(fake_adb)])
+    out = subprocess.check_output(
+        [sys.executable, "-c", script], text=True,
+        cwd=os.path.dirname(os.path.dirname(pyaatlibs.__file__)))
+    assert out.count("command stats:") == 1
+
+    Adb.reset_stats()
+    Adb.execute(["shell", "true"], serialno=fake_adb, tolog=False)
+    Adb.finalize()
+    assert len(Adb.COMMAND_STATS.entries) == 0
+
+def test_command_kind():
+    assert AdbCommandStats.get_kind(["pull", "/sdcard/a", "b"]) == "pull"
+    assert AdbCommandStats.get_kind(["shell", "am", "broadcast", "-a", "x"]) == "broadcast"
+    assert AdbCommandStats.get_transport("192.168.0.2:5555") == "wifi"
+    assert AdbCommandStats.get_transport(None) == "host"
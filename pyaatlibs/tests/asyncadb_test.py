@@ -0,0 +1,30 @@
+import pytest
+
+import asyncio
+import subprocess
+
+from pyaatlibs.asyncadb import AsyncAdb
+
+def test_execute(fake_adb):
+    async def run():
+        return await asyncio.gather(
+            AsyncAdb.execute(["shell", "echo out; echo err >&2"], serialno=fake_adb, tolog=False),
+            AsyncAdb.get_devices(tolog=False))
+
+    assert asyncio.run(run()) == [("out\n", "err\n"), [fake_adb]]
+
+def test_execute_timeout(fake_adb):
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(AsyncAdb.execute(
+            ["shell", "exec sleep 5"], serialno=fake_adb, tolog=False, timeoutsec=0.2))
+
+def test_gather(fake_adb):
+    results = asyncio.run(AsyncAdb.gather(
+        AsyncAdb.shell, ["serialno-0", "serialno-1"], "echo $0", tolog=False))
+    assert set(results.keys()) == {"serialno-0", "serialno-1"}
+    assert all(out == "sh\n" for out, _ in results.values())
+
+def test_execute_batch(fake_adb):
+    results = asyncio.run(AsyncAdb.execute_batch(
+        fake_adb, ["echo a", "echo b >&2; exit 3"], tolog=False))
+    assert results == [("a\n", "", 0), ("", "b\n", 3)]
@@ -0,0 +1,193 @@
+import numpy as np
+import pytest
+
+from pyaatlibs import audiothread
+from pyaatlibs.audiothread import *
+
+class FakeStatus(object):
+    input_overflow = False
+
+@pytest.fixture
+def fake_input_stream(monkeypatch):
+    # Feeds the given blocks to the stream callback and stops the command afterwards
+    blocks = []
+    def make_stream(raw):
+        class FakeInputStream(object):
+            def __init__(self, channels, callback, samplerate, dtype):
+                self.callback = callback
+
+            def __enter__(self):
+                for block in blocks:
+                    data = block.astype(np.float32)
+                    self.callback(
+                        bytes(data.tobytes()) if raw else data, len(data), None, FakeStatus())
+                return self
+
+            def __exit__(self, exc_type, exc_value, traceback):
+                pass
+        return FakeInputStream
+
+    monkeypatch.setattr(audiothread.sd, "InputStream", make_stream(False))
+    monkeypatch.setattr(audiothread.sd, "RawInputStream", make_stream(True))
+    return blocks
+
+def test_ring_buffer():
+    ring = AudioRingBuffer(4, ch=2)
+    frames = np.arange(24, dtype=np.float32).reshape(-1, 2)
+
+    assert ring.write(frames[:3]) == 0
+    assert np.array_equal(ring.read(2), frames[:2])
+    assert ring.read(2) is None
+
+    # the read across the end of the storage is still a contiguous view
+    assert ring.write(frames[3:6]) == 0
+    view = ring.read(4)
+    assert np.array_equal(view, frames[2:6]) and np.shares_memory(view, ring.buff)
+    assert ring.overruns == 0
+
+    assert ring.write(frames[6:9]) == 0
+    assert ring.write(frames[9:]) == 2
+    assert ring.overruns == 1 and ring.dropped_frames == 2
+    assert np.array_equal(ring.read(4), frames[8:])
+
+@pytest.mark.parametrize("raw_stream", [False, True])
+def test_raw_record_command(fake_input_stream, raw_stream):
+    frames = []
+    cmd = RawRecordCommand(
+        AudioConfig(fs=1000, ch=2, cb=lambda indata: frames.append(indata), raw_stream=raw_stream),
+        framemillis=10)
+    data = np.arange(70, dtype=np.float32).reshape(-1, 2)
+    fake_input_stream += [data[:7], data[7:25], data[25:]]
+    cmd.stop()
+    AudioCommandThread()._process_command(cmd)
+
+    assert [len(f) for f in frames] == [10, 10, 10]
+    assert np.array_equal(np.vstack(frames), data[:30])
+    assert cmd.overruns == 0
+
+@pytest.mark.parametrize("window", [None, "hann"])
+def test_spectral_engine(window):
+    fs, framesize = 8000, 400
+    engine = AudioSpectralEngine(fs, framesize, nfft=800, hop=100, window=window)
+    signal = 0.5 * np.sin(2*np.pi*1000*np.arange(1000) / fs)
+    spectra = engine.analyze(signal)
+    assert spectra.shape == (7, 400)
+
+    idx, amps = engine.find_peaks(spectra)
+    assert np.all(engine.freqs[idx] == 1000)
+    # the level of the tone does not depend on the window
+    assert np.allclose(amps, 0.5 * framesize / 2, rtol=1e-3)
+
+    ring = AudioRingBuffer(2000)
+    ring.write(signal[:, None])
+    assert np.allclose(engine.consume(ring), spectra, atol=1e-3)
+    assert ring.available() == 300
+
+@pytest.mark.parametrize("window", [None, "hann"])
+def test_spectral_engine_long_frames(window):
+    # the frames of 50 ms at 48 kHz are cut to nfft
+    fs, framesize, nfft = 48000, 2400, 2048
+    engine = AudioSpectralEngine(fs, framesize, nfft=nfft, window=window)
+    signal = 0.5 * np.sin(2*np.pi*3000*np.arange(4800) / fs)
+    idx, amps = engine.find_peaks(engine.analyze(signal))
+    assert np.all(engine.freqs[idx] == 3000)
+    assert np.allclose(20*np.log10(amps), 20*np.log10(0.5 * nfft / 2), atol=0.1)
+
+def test_tone_detect_command(fake_input_stream):
+    tones, batches = [], []
+    cmd = ToneDetectCommand(
+        AudioConfig(fs=8000, ch=2, cb=lambda detected_tones: tones.append(detected_tones)),
+        framemillis=50, nfft=800, hopmillis=25,
+        spectra_cb=lambda spectra, freqs: batches.append(spectra))
+    t = np.arange(1000) / 8000
+    fake_input_stream += [np.vstack((np.sin(2*np.pi*500*t), np.sin(2*np.pi*2000*t))).T]
+    cmd.stop()
+    AudioCommandThread()._process_command(cmd)
+
+    assert len(tones) == 4 and all(tone[0][0] == 500 for tone in tones)
+    assert len(batches) == 1 and batches[0].shape == (4, 400)
+
+def test_per_channel_tone_detect_command(fake_input_stream):
+    results = []
+    cmd = ToneDetectCommand(
+        AudioConfig(fs=8000, ch=3, cb=lambda **kwargs: results.append(kwargs)),
+        framemillis=50, nfft=800, per_channel=True)
+    t = np.arange(800) / 8000
+    fake_input_stream += [np.vstack([np.sin(2*np.pi*f*t) for f in [500, 1000, 3000]]).T]
+    cmd.stop()
+    AudioCommandThread()._process_command(cmd)
+
+    assert len(results) == 2
+    for result in results:
+        assert [tones[0][0] for tones in result["channel_tones"]] == [500, 1000, 3000]
+        assert result["detected_tones"] == result["channel_tones"][0]
+
+def test_target_detection():
+    fs, framesize = 8000, 400
+    engine = AudioSpectralEngine(fs, framesize)
+    engine.set_targets([500, 1000, 1500], tolerance_semitone=2)
+    t = np.arange(framesize) / fs
+    frames = np.vstack([
+        0.5 * np.sin(2*np.pi*1000*t),
+        0.5 * np.sin(2*np.pi*1000*2**(1/12.)*t),
+        np.random.RandomState(0).normal(0, 0.5, framesize)
+    ])
+
+    freqs, dbs, target_mags = engine.detect_targets(frames)
+    assert freqs.tolist() == [1000, 1000, 0]
+    assert target_mags.shape == (3, 3)
+    assert dbs[0] == pytest.approx(20*np.log10(0.5 * framesize / 2), abs=0.1)
+
+    # the tone is out of the tolerance
+    engine.set_targets([500, 1000, 1500])
+    assert engine.detect_targets(frames)[0].tolist() == [1000, 0, 0]
+
+def test_noisy_target_detection():
+    fs, framesize, nfft = 48000, 2400, 2048
+    engine = AudioSpectralEngine(fs, framesize, nfft=nfft)
+    engine.set_targets([1000], tolerance_semitone=2)
+    t = np.arange(framesize) / fs
+    rand = np.random.RandomState(0)
+    tone = 0.5 * np.sin(2*np.pi*1000*t)
+    # a tone in the noise of the same power, with a DC offset, and the noise or the offset alone
+    noise = rand.normal(0, 0.5 / np.sqrt(2), size=(20, framesize))
+    frames = np.vstack((tone + noise, tone + 0.3, noise, np.full((1, framesize), 0.3)))
+
+    freqs, dbs, _ = engine.detect_targets(frames.astype(np.float32))
+    assert freqs.tolist() == [1000] * 21 + [0] * 21
+    assert dbs[20] == pytest.approx(20*np.log10(0.5 * nfft / 2), abs=0.1)
+
+@pytest.mark.parametrize("target_freqs", [[440, 880], np.array([440, 880])])
+def test_target_tone_detect_command(fake_input_stream, target_freqs):
+    tones = []
+    cmd = ToneDetectCommand(
+        AudioConfig(fs=8000, ch=2, cb=lambda **kwargs: tones.append(kwargs["channel_tones"])),
+        framemillis=50, per_channel=True, target_freqs=target_freqs)
+    t = np.arange(800) / 8000
+    fake_input_stream += [np.vstack((np.sin(2*np.pi*880*t), np.zeros(len(t)))).T]
+    cmd.stop()
+    AudioCommandThread()._process_command(cmd)
+
+    assert [[tone[0][0] for tone in frame_tones] for frame_tones in tones] == [[880, 0], [880, 0]]
+
+def test_oscillator():
+    fs = 8000
+    oscillator = AudioOscillator(fs, ch=2, freqs=[1000, [500, 1500]], amp=[0.5, 0.8])
+    outdata = np.zeros((1000, 2), dtype=np.float32)
+    for start in range(0, 1000, 300):
+        oscillator.render(outdata[start:start+300])
+
+    t = np.arange(1000) / fs
+    expected = np.vstack((
+        0.5 * np.sin(2*np.pi*1000*t),
+        0.4 * (np.sin(2*np.pi*500*t) + np.sin(2*np.pi*1500*t)))).T
+    assert np.allclose(outdata, expected, atol=1e-5)
+
+    # the phase stays wrapped over a long run
+    oscillator.set_freqs(997.)
+    for _ in range(10000):
+        oscillator.render(outdata[:480])
+    assert np.allclose(oscillator.phase, 997. * 480 * 10000 / fs % 1., atol=1e-9)
+
+    with pytest.raises(ValueError):
+        oscillator.set_freqs([[440], [880], [1760]])
@@ -138,6 +138,425 @@ def test_is_subdict():
     assert not is_subdict({"b": {"a": 1}}, {"a": 1, "b": {}})
     assert not is_subdict({"b": {"a": 1}}, {"a": 1, "b": {"a": 2}})
 
+def test_intent_pipeline(fake_adb, tmp_path):
+    am_log = tmp_path / "am.log"
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\necho \"$3\" >> {}\n".format(am_log) +
+        "[ \"$3\" = fail ] && exit 1\n" +
+        "echo 'Broadcast completed: result=0'\n")
+    am.chmod(0o755)
+
+    prefix = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX
+    with AudioWorkerApp.pipeline(fake_adb, tolog=False) as pipeline:
+        AudioWorkerApp.record_start(serialno=fake_adb)
+        AudioWorkerApp.send_intent(None, fake_adb, "fail")
+        AudioWorkerApp.voip_stop(serialno=fake_adb)
+        assert not am_log.exists()
+
+    assert am_log.read_text().splitlines() == \
+        [prefix + "record.start", "fail", prefix + "voip.stop"]
+    assert [(r["intent"], r["result"]) for r in pipeline.results] == \
+        [(prefix + "record.start", 0), ("fail", None), (prefix + "voip.stop", 0)]
+
+    # the intents are sent right away out of the pipeline
+    AudioWorkerApp.voip_stop(serialno=fake_adb)
+    assert len(am_log.read_text().splitlines()) == 4
+
+def test_info_cache(fake_adb, tmp_path, monkeypatch):
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "PlaybackController").mkdir()
+    am_log = tmp_path / "am.log"
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\necho \"$3\" >> {}\n".format(am_log) +
+        "case \"$3\" in *.info) printf 'info::1\\n{{\"a\": 1}}' > {}/PlaybackController/$6 ;; "
+        "esac\n".format(tmp_path))
+    am.chmod(0o755)
+
+    AudioWorkerApp.set_info_cache_ttl(10)
+    try:
+        info = AudioWorkerApp.playback_info(serialno=fake_adb)
+        assert info == {"a": 1}
+        info["a"] = 2
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 1}
+        assert len(am_log.read_text().splitlines()) == 1
+
+        AudioWorkerApp.voip_stop(serialno=fake_adb)
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 1}
+        assert len(am_log.read_text().splitlines()) == 3
+    finally:
+        AudioWorkerApp.set_info_cache_ttl(0)
+
+def test_info_cache_after_intents(fake_adb, tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    from pyaatlibs.asyncaudioworker import AsyncAudioWorkerApp
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "PlaybackController").mkdir()
+    state = tmp_path / "state"
+    state.write_text("{\"a\": 1}")
+    # the state is changed by the app a while after the broadcast of other intents
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\n".format(tmp_path) +
+        "case \"$3\" in *.info) (printf 'info::1\\n'; cat state) > PlaybackController/$6 ;; "
+        "*) sleep 0.3; echo '{\"a\": 2}' > state ;; esac\n")
+    am.chmod(0o755)
+
+    AudioWorkerApp.set_info_cache_ttl(10)
+    try:
+        # the info queried while the intent is being delivered is not kept
+        th = threading.Thread(target=AudioWorkerApp.voip_stop, kwargs={"serialno": fake_adb})
+        th.start()
+        time.sleep(0.1)
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 1}
+        th.join()
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 2}
+
+        # the queued intents clear the cache once the pipeline is flushed
+        state.write_text("{\"a\": 1}")
+        AudioWorkerApp.invalidate_info_cache(fake_adb)
+        infos = []
+        with AudioWorkerApp.pipeline(fake_adb, tolog=False):
+            AudioWorkerApp.voip_stop(serialno=fake_adb)
+            th = threading.Thread(
+                target=lambda: infos.append(AudioWorkerApp.playback_info(serialno=fake_adb)))
+            th.start()
+            th.join()
+        assert infos == [{"a": 1}]
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 2}
+
+        # the async queries and intents share the cache
+        state.write_text("{\"a\": 1}")
+        AudioWorkerApp.invalidate_info_cache(fake_adb)
+        assert asyncio.run(AsyncAudioWorkerApp.playback_info(serialno=fake_adb)) == {"a": 1}
+        state.write_text("{\"a\": 3}")
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 1}
+        asyncio.run(AsyncAudioWorkerApp.voip_stop(serialno=fake_adb))
+        assert AudioWorkerApp.playback_info(serialno=fake_adb) == {"a": 2}
+    finally:
+        AudioWorkerApp.set_info_cache_ttl(0)
+
+def test_info_query_cmd(monkeypatch):
+    monkeypatch.setattr(AudioWorkerApp, "INFO_QUERY_TIMEOUT_SEC", 1.)
+    monkeypatch.setattr(AudioWorkerApp, "INFO_QUERY_POLL_INTERVAL_SEC", 0.05)
+    name, configs, filepath = AudioWorkerApp._info_request(
+        "record", "RecordController", {"task-index": -1})
+    cmd = AudioWorkerApp._info_query_cmd(name, configs, filepath)
+    assert cmd.startswith(AudioWorkerApp.build_intent_cmd(name, configs) + " > /dev/null;")
+    assert "[ $i -lt 20 ]" in cmd and "sleep 0.05" in cmd
+    assert cmd.endswith("cat {0} 2> /dev/null; rm -f {0}".format(filepath))
+
+@pytest.mark.parametrize("combined", [True, False])
+def test_info_query(fake_adb, tmp_path, monkeypatch, combined):
+    import asyncio
+    import json
+    from pyaatlibs.asyncaudioworker import AsyncAudioWorkerApp
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    monkeypatch.setattr(AudioWorkerApp, "INFO_QUERY_COMBINED", combined)
+    (tmp_path / "RecordController").mkdir()
+    info = [{"params": {"task-index": 0}}, {"detector@0": json.dumps({"Targets": []})}]
+    (tmp_path / "info.txt").write_text("info::1000\n" + json.dumps(info, indent=2))
+
+    # the app writes the info file a while after the broadcast has returned
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\n".format(tmp_path) +
+        "case \"$3\" in *.info) (sleep 0.1; cp info.txt RecordController/$6) & ;; esac\n")
+    am.chmod(0o755)
+
+    expected = [{"params": {"task-index": 0}}, {"detector@0": {"Targets": []}}]
+    assert AudioWorkerApp.record_info(serialno=fake_adb) == expected
+    assert asyncio.run(AsyncAudioWorkerApp.record_info(serialno=fake_adb)) == expected
+    time.sleep(0.2)
+    assert list((tmp_path / "RecordController").iterdir()) == []
+
+    # no info file is written
+    if combined:
+        monkeypatch.setattr(AudioWorkerApp, "INFO_QUERY_TIMEOUT_SEC", 0.2)
+        am.write_text("#!/bin/sh\n")
+        tictoc = time.time()
+        assert AudioWorkerApp.record_info(serialno=fake_adb) is None
+        assert asyncio.run(AsyncAudioWorkerApp.record_info(serialno=fake_adb)) is None
+        assert time.time() - tictoc < 2
+
+def test_detector_history(fake_adb, tmp_path):
+    from pyaatlibs.audioworker import AudioWorkerDetectorHistory
+
+    path = tmp_path / "detector.txt"
+    history = AudioWorkerDetectorHistory(str(path))
+    records, lines = history.read(fake_adb)
+    assert len(records) == 0 and lines == []
+
+    path.write_text("1000: 440.0 active\n1040: 0.0 inactive\nbad line here\n1080: 43")
+    records, lines = history.read(fake_adb)
+    assert records["timestamp"].tolist() == [1000., 1040.]
+    assert records["active"].tolist() == [True, False]
+    assert lines == ["1000: 440.0 active", "1040: 0.0 inactive"]
+
+    with open(path, "a") as f:
+        f.write("0.0 active\n")
+    records, lines = history.read(fake_adb)
+    assert lines == ["1080: 430.0 active"]
+    assert len(history.read(fake_adb)[0]) == 0
+
+    # truncated
+    path.write_text("2000: 220.0 active\n")
+    assert history.read(fake_adb)[1] == ["2000: 220.0 active"]
+
+    matched = AudioWorkerDetectorHistory.match_target([0., 430., 440., 880., 220.], 440)
+    assert matched.tolist() == [False, True, True, False, False]
+    assert AudioWorkerDetectorHistory.match_target([0., 100.], None).tolist() == [False, True]
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_tone_detector_thread(fake_adb, tmp_path, monkeypatch, streaming):
+    from pyaatlibs.audiofunction import ToneDetector
+    from pyaatlibs.audioworker import AudioWorkerToneDetectorThread
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    history = tmp_path / "detector@0.txt"
+    events = []
+    th = AudioWorkerToneDetectorThread(
+        serialno=fake_adb, target_freq=440,
+        detector_reg_func=lambda **kwargs: None,
+        detector_unreg_func=lambda **kwargs: None,
+        detector_setparams_func=lambda **kwargs: None,
+        info_func=lambda **kwargs: [{}, {}],
+        parse_detector_func=lambda info: {"detector@0": {"Targets": [{"target-freq": 440}]}},
+        callback=lambda event: events.append(event[1]),
+        streaming=streaming)
+    th.start()
+    try:
+        time.sleep(0.2)
+        with open(history, "a") as f:
+            f.write("1572251050140: 220.0 active\n")
+            f.write("1572251050190: 440.0 active\n")
+        time.sleep(0.5)
+        assert events == [ToneDetector.Event.TONE_DETECTED]
+
+        with open(history, "a") as f:
+            f.write("1572251050240: 440.0 inactive\n")
+        time.sleep(0.5)
+        assert events == [ToneDetector.Event.TONE_DETECTED, ToneDetector.Event.TONE_MISSING]
+    finally:
+        th.join(timeout=5)
+    assert not th.is_alive()
+
+def test_shared_detector_poller(fake_adb, tmp_path, monkeypatch):
+    from pyaatlibs.audiofunction import ToneDetector
+    from pyaatlibs.audioworker import AudioWorkerToneDetectorThread, AudioWorkerDetectorPoller
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    info_calls = []
+    def info_func(serialno):
+        info_calls.append(serialno)
+        return [{}, {}]
+
+    detectors = {
+        "detector@0": {"Targets": [{"target-freq": 440}]},
+        "detector@1": {"Targets": [{"target-freq": 880}]}
+    }
+    events = {440: [], 880: []}
+    ths = [AudioWorkerToneDetectorThread(
+        serialno=fake_adb, target_freq=freq,
+        detector_reg_func=lambda **kwargs: None,
+        detector_unreg_func=lambda **kwargs: None,
+        detector_setparams_func=lambda **kwargs: None,
+        info_func=info_func,
+        parse_detector_func=lambda info: detectors,
+        callback=lambda event, freq=freq: events[freq].append(event[1]),
+        shared_poller=True) for freq in events.keys()]
+
+    for th in ths:
+        th.start()
+    try:
+        time.sleep(0.2)
+        assert len(AudioWorkerDetectorPoller.POLLERS) == 1
+        (tmp_path / "detector@0.txt").write_text("1000: 440.0 active\n")
+        (tmp_path / "detector@1.txt").write_text("1000: 880.0 inactive\n")
+        time.sleep(0.5)
+        assert events == \
+            {440: [ToneDetector.Event.TONE_DETECTED], 880: [ToneDetector.Event.TONE_MISSING]}
+        assert [th.chandle for th in ths] == ["detector@0", "detector@1"]
+        assert len(info_calls) == 1
+    finally:
+        for th in ths:
+            th.join(timeout=5)
+    assert len(AudioWorkerDetectorPoller.POLLERS) == 0
+
+def test_shared_detector_poller_dump_history(fake_adb, tmp_path, monkeypatch):
+    from pyaatlibs.audioworker import AudioWorkerToneDetectorThread
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    detectors = {
+        "detector@0": {"Targets": [{"target-freq": 440}]},
+        "detector@1": {"Targets": [{"target-freq": 440}]}
+    }
+    setparams = []
+    info_func = lambda serialno: [{}, {}]
+    ths = [AudioWorkerToneDetectorThread(
+        serialno=fake_adb, target_freq=440,
+        detector_reg_func=lambda **kwargs: None,
+        detector_unreg_func=lambda **kwargs: None,
+        detector_setparams_func=lambda chandle, params, **kwargs: \
+            setparams.append((chandle, params["dump-history"])),
+        info_func=info_func,
+        parse_detector_func=lambda info: detectors,
+        shared_poller=True) for _ in range(2)]
+
+    for th in ths:
+        th.start()
+    try:
+        time.sleep(0.2)
+        # the last matching detector is taken
+        assert [th.chandle for th in ths] == ["detector@1", "detector@1"]
+        assert setparams == [("detector@1", "true")]
+
+        # the history is dumped until the last subscriber of the handle leaves
+        ths[0].join(timeout=5)
+        assert setparams == [("detector@1", "true")]
+    finally:
+        for th in ths:
+            th.join(timeout=5)
+    assert setparams == [("detector@1", "true"), ("detector@1", "false")]
+
+def test_record_session(fake_adb, tmp_path, monkeypatch):
+    import json
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "RecordController").mkdir()
+    info = []
+    for task_index in [0, 1, 3]:
+        info += [{"params": {"task-index": task_index}}, {"detector@0": json.dumps({})}]
+    (tmp_path / "info.txt").write_text("info::1\n" + json.dumps(info))
+
+    am_log = tmp_path / "am.log"
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\necho \"$*\" >> am.log\n".format(tmp_path) +
+        "case \"$3\" in *.info) cp info.txt RecordController/$6 ;; esac\n")
+    am.chmod(0o755)
+
+    prefix = AudioWorkerApp.AUDIOWORKER_INTENT_PREFIX
+    def sent():
+        lines = am_log.read_text().splitlines() if am_log.exists() else []
+        am_log.write_text("")
+        return [(line.split()[2], line.split()[-1]) for line in lines]
+
+    session = AudioWorkerApp.record_session(fake_adb, task_indices=[2, 0, 1], fs=48000)
+    session.set_task_configs(2, nch=1)
+    with session:
+        assert sent() == [(prefix + "record.start", str(i)) for i in range(3)]
+
+        assert list(session.info().keys()) == [0, 1]
+        assert not session.is_running() and session.is_running(1)
+        assert session.get_detectors(0) == {"detector@0": {}}
+        assert session.get_track_info(2) is None
+        assert sent() == [(prefix + "record.info", "-1")]
+
+        session.detector_clear()
+        assert sent() == [(prefix + "record.detect.unregister", str(i)) for i in range(2)]
+        session.get_detectors(0)
+        assert sent() == [(prefix + "record.info", "-1")]
+
+        with pytest.raises(ValueError):
+            session.detector_register(3, "dclass")
+
+    assert sent() == [(prefix + "record.stop", str(i)) for i in range(3)]
+
+def test_relaunch_app(fake_adb, tmp_path, monkeypatch):
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "PlaybackController").mkdir()
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\necho \"$1\" >> am.log\n".format(tmp_path) +
+        "case \"$1\" in force-stop) echo 3 > alive ;; "
+        "start) printf 'Status: ok\\nLaunchState: COLD\\nTotalTime: 345\\nWaitTime: 350\\n' ;; "
+        "broadcast) printf 'info::1\\n{}' > PlaybackController/$6 ;; esac\n")
+    am.chmod(0o755)
+
+    # the process dies after being polled 3 times
+    pidof = tmp_path / "pidof"
+    pidof.write_text(
+        "#!/bin/sh\ncd {}\nn=$(cat alive)\n[ $n -eq 0 ] && exit 1\n".format(tmp_path) +
+        "echo $((n-1)) > alive\necho 1234\n")
+    pidof.chmod(0o755)
+
+    timings = AudioWorkerApp.relaunch_app(serialno=fake_adb, tolog=False)
+    assert (tmp_path / "am.log").read_text().splitlines() == ["force-stop", "start", "broadcast"]
+    assert timings["status"] == "ok" and timings["launch_state"] == "COLD"
+    assert timings["total_time_ms"] == 345 and timings["wait_time_ms"] == 350
+    assert timings["stop_time_ms"] >= 0 and timings["ready_time_ms"] is not None
+
+def test_parse_pcm():
+    import io
+    import numpy as np
+    import wave
+
+    samples = np.arange(-6, 6, dtype=np.int16).reshape(-1, 2)
+    f = io.BytesIO()
+    with wave.open(f, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(samples.tobytes())
+
+    data, fs = AudioWorkerApp.parse_pcm(bytearray(f.getvalue()), fs=16000, nch=1, bit_depth=32)
+    assert fs == 48000 and data.dtype == np.int16 and np.array_equal(data, samples)
+
+    # raw PCM with a partial frame at the end
+    data, fs = AudioWorkerApp.parse_pcm(samples.tobytes() + b"\x01", fs=16000, nch=2, bit_depth=16)
+    assert fs == 16000 and np.array_equal(data, samples)
+
+    data, _ = AudioWorkerApp.parse_pcm(b"\x01\x00\x00\xff\xff\xff", fs=8000, nch=1, bit_depth=24)
+    assert data.flatten().tolist() == [1, -1]
+
+    # AudioWorker records the 32-bit samples as float
+    samples = np.array([[0.5, -0.25]], dtype=np.float32)
+    data, _ = AudioWorkerApp.parse_pcm(samples.tobytes(), fs=8000, nch=2, bit_depth=32)
+    assert data.dtype == np.float32 and np.array_equal(data, samples)
+    data, _ = AudioWorkerApp.parse_pcm(
+        np.array([1, -1], dtype=np.int32).tobytes(), fs=8000, nch=1, bit_depth=32, is_float=False)
+    assert data.flatten().tolist() == [1, -1]
+
+def test_record_dump_fetch(fake_adb, tmp_path, monkeypatch):
+    import json
+    import numpy as np
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "RecordController").mkdir()
+    info = [{"params": {
+        "task-index": 0, "sampling-freq": 8000, "num-channels": 2, "pcm-bit-width": 16}}, {}]
+    (tmp_path / "info.txt").write_text("info::1\n" + json.dumps(info))
+    samples = np.arange(100, dtype=np.int16).reshape(-1, 2)
+    (tmp_path / "dump.raw").write_bytes(samples.tobytes())
+
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\n".format(tmp_path) +
+        "case \"$3\" in *.info) cp info.txt RecordController/$6 ;; "
+        "*.dump) cp dump.raw RecordController/$6 ;; esac\n")
+    am.chmod(0o755)
+
+    data, fs = AudioWorkerApp.record_dump_fetch(serialno=fake_adb, path="dump.pcm")
+    assert fs == 8000 and np.array_equal(data, samples)
+    assert not (tmp_path / "RecordController" / "dump.pcm").exists()
+
+    assert AudioWorkerApp.record_dump_fetch(serialno=fake_adb, task_index=1) is None
+
+    # the file is read once its size stays unchanged over several checks
+    am.write_text(
+        "#!/bin/sh\ncd {}\n".format(tmp_path) +
+        "case \"$3\" in *.info) cp info.txt RecordController/$6 ;; "
+        "*.dump) head -c 100 dump.raw > RecordController/$6; "
+        "(sleep 0.25; tail -c +101 dump.raw >> RecordController/$6) > /dev/null 2>&1 & ;; "
+        "esac\n")
+    data, fs = AudioWorkerApp.record_dump_fetch(serialno=fake_adb, path="dump.pcm")
+    assert np.array_equal(data, samples)
+
 def test_install(check_options, serialno, apk_path):
     if not any([serialno, apk_path]):
         pytest.skip("The information of DuT is not provided.")
@@ -172,14 +591,16 @@ def test_apk_version(check_options, target_version, serialno, skip_version_check
     print(m.groupdict())
     assert m.groupdict()["pyaat_version"] >= target_version
 
-def wait_for_activities(serialno, func, onset=True):
-    retry = 10
-    while retry > 0:
+def wait_for_activities(serialno, func, onset=True, timeoutsec=10):
+    # Poll with a growing interval, as the activities usually change within a few hundred ms
+    interval = 0.05
+    deadline = time.time() + timeoutsec
+    while time.time() < deadline:
         if bool(func(serialno=serialno)) == onset:
             return True
 
-        retry -= 1
-        time.sleep(1)
+        time.sleep(interval)
+        interval = min(interval * 2, 1)
 
     return False
 
@@ -198,7 +619,6 @@ def wait_for_record_activities(serialno, onset=True, task_index=TaskIndex.ALL):
 
 def prepare_app(serialno):
     AudioWorkerApp.relaunch_app(serialno=serialno)
-    time.sleep(3)
 
 def run_general_single_playback(serialno, playback_type):
     prepare_app(serialno=serialno)
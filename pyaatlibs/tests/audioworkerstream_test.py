@@ -0,0 +1,101 @@
+import pytest
+
+import numpy as np
+
+from pyaatlibs.audioworkerstream import AudioWorkerRecordStream
+
+def make_stream(fs=1000, nch=2, buffer_sec=1.):
+    stream = AudioWorkerRecordStream(buffer_sec=buffer_sec)
+    stream.fs, stream.nch, stream.bit_depth = fs, nch, 16
+    return stream
+
+def test_overlapping_dumps():
+    stream = make_stream()
+    frames = []
+    stream.subscribe(100, lambda data, t: frames.append((data[:, 0].copy(), t)))
+
+    signal = np.repeat(np.arange(2000, dtype=np.int16)[:, None], 2, axis=1)
+    # each dump holds the last 500 ms, taken every 200 ms
+    for end in [500, 700, 900, 1100]:
+        stream.handle_dump(bytearray(signal[end-500:end].tobytes()), end / 1000.)
+
+    assert stream.num_frames == 1100
+    assert [f[0][0] for f in frames] == list(range(0, 1100, 100))
+    assert all(np.array_equal(f[0], np.arange(f[0][0], f[0][0] + 100)) for f in frames)
+    assert frames[3][1] == pytest.approx(0.3)
+
+    latest, t = stream.read_latest(10)
+    assert latest[:, 1].tolist() == list(range(1090, 1100)) and t == pytest.approx(1.09)
+
+def test_ring_buffer_overrun():
+    stream = make_stream(buffer_sec=0.5)
+    signal = np.repeat(np.arange(3000, dtype=np.int16)[:, None], 2, axis=1)
+    stream.handle_dump(bytearray(signal[:400].tobytes()), 0.4)
+    # a gap longer than the dump
+    stream.handle_dump(bytearray(signal[1000:1400].tobytes()), 1.4)
+
+    assert stream.extra["dropped-frames"] == 600
+    latest, t = stream.read_latest(1000)
+    assert len(latest) == 500 and latest[-1, 0] == 1399
+    # the frames before the gap keep their time
+    assert latest[0, 0] == 300 and t == pytest.approx(0.3)
+    assert stream._time_of(400) == pytest.approx(1.0)
+
+def test_jittered_dumps():
+    stream = make_stream(fs=8000)
+    frames = []
+    stream.subscribe(160, lambda data, t: frames.append(data))
+
+    rand = np.random.RandomState(0)
+    signal = rand.randint(-32768, 32767, size=(16000, 2)).astype(np.int16)
+    stream.handle_dump(bytearray(signal[:4000].tobytes()), 0.5)
+    end = 4000
+    while True:
+        advance = rand.randint(800, 2400)
+        end += advance
+        if end > len(signal):
+            break
+        # the uptime ticks in 10 ms and lags the dump by the latency of the broadcast
+        t = np.floor((end / 8000. + rand.uniform(0, 0.05)) * 100) / 100
+        # the tail covering the time since the previous dump plus an overlap
+        stream.handle_dump(
+            bytearray(signal[end-advance-rand.randint(400, 1600):end].tobytes()), t)
+
+    received = np.vstack(frames)
+    assert np.array_equal(received, signal[:len(received)])
+    assert stream.num_frames - len(received) < 160
+    assert stream.extra["dropped-frames"] == 0
+
+def test_record_stream(fake_adb, tmp_path, monkeypatch):
+    import json
+    import time
+    from pyaatlibs.audioworker import AudioWorkerApp
+
+    monkeypatch.setattr(AudioWorkerApp, "DATA_FOLDER", str(tmp_path))
+    (tmp_path / "RecordController").mkdir()
+    info = [{"params": {
+        "task-index": 0, "sampling-freq": 8000, "num-channels": 1, "pcm-bit-width": 16}}, {}]
+    (tmp_path / "info.txt").write_text("info::1\n" + json.dumps(info))
+    (tmp_path / "dump.raw").write_bytes(np.ones(4000, dtype=np.int16).tobytes())
+
+    am = tmp_path / "am"
+    am.write_text(
+        "#!/bin/sh\ncd {}\n".format(tmp_path) +
+        "case \"$3\" in *.info) cp info.txt RecordController/$6 ;; "
+        "*.dump) cp dump.raw RecordController/$6 ;; esac\n")
+    am.chmod(0o755)
+
+    frames = []
+    stream = AudioWorkerRecordStream(serialno=fake_adb, period_sec=0.1)
+    stream.subscribe(800, lambda data, t: frames.append(data))
+    stream.start()
+    try:
+        deadline = time.time() + 5
+        while stream.extra["dumps"] < 3 and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        stream.join(timeout=5)
+
+    assert not stream.is_alive()
+    assert stream.extra["dumps"] >= 3
+    assert len(frames) >= 5 and all(f.shape == (800, 1) for f in frames)
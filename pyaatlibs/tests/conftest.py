@@ -1,5 +1,39 @@
+import pytest
+
+import os
+import stat
+
+from fakeadbserver import FakeAdbServer
+from pyaatlibs.adbutils import Adb
+
 def pytest_addoption(parser):
     parser.addoption("--apk_path", action="store", default=None)
     parser.addoption("--serialno", action="store", default=None)
     parser.addoption("--skip_version_check", action="store_true")
     parser.addoption("--skip_function_check", action="store_true")
+
+@pytest.fixture
+def fake_adb_server():
+    server = FakeAdbServer()
+    server.start()
+    yield server
+    server.stop()
+
+FAKE_ADB_SCRIPT = """#!/bin/sh
+[ "$1" = "-s" ] && shift 2
+case "$1" in
+devices) printf 'List of devices attached\\nfake-serialno\\tdevice\\n\\n' ;;
+shell) shift; if [ $# -eq 0 ]; then exec sh; else exec sh -c "$*" </dev/null; fi ;;
+exec-out) shift; exec sh -c "$*" </dev/null ;;
+esac
+"""
+
+@pytest.fixture
+def fake_adb(tmp_path, monkeypatch):
+    path = tmp_path / "adb"
+    path.write_text(FAKE_ADB_SCRIPT)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", "{}{}{}".format(tmp_path, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setattr(Adb, "HAS_BEEN_INIT", True)
+    yield "fake-serialno"
+    Adb.enable_shell_session(False)
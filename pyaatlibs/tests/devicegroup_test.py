@@ -0,0 +1,88 @@
+import pytest
+
+import threading
+import time
+
+from pyaatlibs.adbutils import Adb
+from pyaatlibs.devicegroup import DeviceGroup
+
+def test_run():
+    def work(serialno, value):
+        if serialno == "bad":
+            raise RuntimeError("failed")
+        time.sleep(0.2)
+        return "{}-{}".format(serialno, value)
+
+    serialnos = ["serialno-{}".format(idx) for idx in range(8)] + ["bad"]
+    with DeviceGroup(serialnos, max_workers=len(serialnos)) as group:
+        start = time.time()
+        results = group.run(work, value=1)
+        assert time.time() - start < 1
+
+    assert list(results.keys()) == serialnos
+    assert results["serialno-0"].result == "serialno-0-1"
+    assert results["serialno-0"].elapsed_ms >= 200
+    assert not results["bad"].succeeded()
+    assert isinstance(results["bad"].exception, RuntimeError)
+
+def test_per_device_limit():
+    active = {"count": 0, "max": 0}
+    lock = threading.Lock()
+
+    def work(serialno):
+        with lock:
+            active["count"] += 1
+            active["max"] = max(active["max"], active["count"])
+        time.sleep(0.05)
+        with lock:
+            active["count"] -= 1
+
+    with DeviceGroup(["serialno"], max_workers=4, max_per_device=1) as group:
+        futures = [group.submit(work) for _ in range(4)]
+        [future.result() for f in futures for future in f.values()]
+
+    assert active["max"] == 1
+
+def test_max_adb_commands(fake_adb):
+    with DeviceGroup(["serialno-0", "serialno-1"], max_adb_commands=1) as group:
+        start = time.time()
+        results = group.run(Adb.execute, ["shell", "sleep 0.2"], tolog=False)
+        assert time.time() - start >= 0.4
+
+    assert all(r.succeeded() for r in results.values())
+    assert Adb.COMMAND_SEMAPHORE is None
+
+def test_max_adb_commands_of_streams(fake_adb):
+    def stream(serialno):
+        with Adb.stream(["shell", "sleep 0.2; echo done"], serialno=fake_adb, tolog=False) as s:
+            return list(s)
+
+    with DeviceGroup(["serialno-0", "serialno-1"], max_adb_commands=1) as group:
+        start = time.time()
+        results = group.run(stream)
+        assert time.time() - start >= 0.4
+
+    assert all(r.result == ["done"] for r in results.values())
+
+def test_overlapping_groups(fake_adb):
+    serialnos = ["serialno-0", "serialno-1"]
+    group0 = DeviceGroup(serialnos, max_adb_commands=1)
+    group1 = DeviceGroup(serialnos, max_adb_commands=2)
+
+    # each group keeps its own cap, whatever the order they are closed in
+    start = time.time()
+    group1.run(Adb.execute, ["shell", "sleep 0.2"], tolog=False)
+    assert time.time() - start < 0.4
+    group0.close()
+    start = time.time()
+    group1.run(Adb.execute, ["shell", "sleep 0.2"], tolog=False)
+    assert time.time() - start < 0.4
+    group1.close()
+
+    assert Adb.COMMAND_SEMAPHORE is None
+    assert Adb.set_thread_command_limit() is None
+
+def test_unknown_serialnos():
+    with DeviceGroup(["serialno-0"]) as group:
+        with pytest.raises(ValueError, match="serialno-1"):
+            group.run(lambda serialno: None, serialnos=["serialno-0", "serialno-1"])
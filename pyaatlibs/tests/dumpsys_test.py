@@ -0,0 +1,55 @@
+import pytest
+
+from pyaatlibs.adbutils import AudioAdb
+from pyaatlibs.dumpsys import DumpsysParser
+
+DUMPSYS_AUDIO = """Audio event log:
+Stream volumes (device: index)
+- STREAM_VOICE_CALL:
+   Muted: false
+   Min: 1
+   Max: 5
+   Current: 2 (earpiece): 3, 4000000 (usb_headset): 2
+   Devices: earpiece
+- STREAM_MUSIC:
+   Muted: true
+   Min: 0
+   Max: 15
+   Current: 2 (earpiece): 9
+   Devices: speaker
+
+- mute affected streams = 0x2f
+Ringer mode:
+"""
+
+def test_parser_sections():
+    parser = DumpsysParser(("Nested:\n   - STREAM_NESTED:\n" + DUMPSYS_AUDIO).splitlines())
+    assert parser.get_section_names("STREAM_") == \
+        ["STREAM_NESTED", "STREAM_VOICE_CALL", "STREAM_MUSIC"]
+    assert parser.get_section("STREAM_NESTED").lines == []
+    assert parser.get_section("unknown") is None
+
+    section = parser.get_section("STREAM_VOICE_CALL")
+    assert section is parser.get_section("STREAM_VOICE_CALL")
+    assert section.values() == {
+        "Muted": False, "Min": 1, "Max": 5, "Devices": "earpiece",
+        "Current": {"2 (earpiece)": 3, "4000000 (usb_headset)": 2}}
+
+def test_parser_from_lines():
+    lines = iter(DUMPSYS_AUDIO.splitlines())
+    parser = DumpsysParser.from_lines(lines, section_prefix="STREAM_V")
+    assert parser.get_section_names() == ["STREAM_VOICE_CALL"]
+    assert next(lines) == "   Muted: true"
+
+def test_get_stream_volumes(fake_adb, tmp_path):
+    dumpsys = tmp_path / "dumpsys"
+    dumpsys.write_text("#!/bin/sh\ncat <<'EOF'\n{}EOF\n".format(DUMPSYS_AUDIO))
+    dumpsys.chmod(0o755)
+
+    volumes = AudioAdb.get_stream_volumes(serialno=fake_adb, tolog=False)
+    assert list(volumes.keys()) == ["STREAM_VOICE_CALL", "STREAM_MUSIC"]
+    assert volumes["STREAM_MUSIC"]["Muted"] == True
+    assert volumes["STREAM_MUSIC"]["Current"] == {"2 (earpiece)": 9}
+
+    # the timeout is applied to the stream of the output as to Adb.execute
+    assert AudioAdb.get_stream_volumes(serialno=fake_adb, tolog=False, timeoutsec=5) == volumes
@@ -0,0 +1,119 @@
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+
+# A minimal adb server speaking the smart-socket protocol on a local port. Shell services are
+# executed by the local "sh", so the tests can run without any Android device attached.
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, devices=None, features="shell_v2,cmd"):
+        super(FakeAdbServer, self).__init__(("127.0.0.1", 0), FakeAdbRequestHandler)
+        self.devices = devices if devices is not None else {"fake-serialno": "device"}
+        self.features = features
+        self.requests = []
+        self.devices_changed = threading.Condition()
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def set_devices(self, devices):
+        with self.devices_changed:
+            self.devices = devices
+            self.devices_changed.notify_all()
+
+    def devices_payload(self):
+        return "".join("{}\t{}\n".format(k, v) for k, v in self.devices.items())
+
+class FakeAdbRequestHandler(socketserver.BaseRequestHandler):
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def read_request(self):
+        size = int(self.read_exactly(4), 16)
+        request = self.read_exactly(size).decode("utf-8")
+        self.server.requests.append(request)
+        return request
+
+    def okay(self, payload=None):
+        self.request.sendall(b"OKAY")
+        if payload is not None:
+            payload = payload.encode("utf-8")
+            self.request.sendall("{:04x}".format(len(payload)).encode("ascii") + payload)
+
+    def fail(self, msg):
+        msg = msg.encode("utf-8")
+        self.request.sendall(b"FAIL" + "{:04x}".format(len(msg)).encode("ascii") + msg)
+
+    def handle(self):
+        try:
+            request = self.read_request()
+            if request == "host:version":
+                self.okay("0029")
+            elif request == "host:devices":
+                self.okay(self.server.devices_payload())
+            elif request == "host:track-devices":
+                self.track_devices()
+            elif request.startswith("host-serial:") and request.endswith(":features"):
+                self.okay(self.server.features)
+            elif request.startswith("host:transport"):
+                serialno = request.partition("host:transport:")[-1]
+                if serialno and self.server.devices.get(serialno) != "device":
+                    self.fail("device '{}' not found".format(serialno))
+                    return
+                self.okay()
+                self.handle_service(self.read_request())
+            else:
+                self.fail("unknown host service")
+        except (EOFError, OSError):
+            pass
+
+    def track_devices(self):
+        self.okay()
+        while True:
+            with self.server.devices_changed:
+                payload = self.server.devices_payload().encode("utf-8")
+                self.request.sendall("{:04x}".format(len(payload)).encode("ascii") + payload)
+                self.server.devices_changed.wait()
+
+    def handle_service(self, service):
+        if service.startswith("shell,v2,raw:"):
+            self.okay()
+            proc = subprocess.Popen(
+                ["sh", "-c", service.partition(":")[-1]], stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            for packet_id, data in [(1, out), (2, err), (3, bytes([proc.returncode]))]:
+                if len(data) > 0:
+                    self.request.sendall(struct.pack("<BI", packet_id, len(data)) + data)
+        elif service.startswith("shell:") or service.startswith("exec:"):
+            self.okay()
+            proc = subprocess.Popen(
+                ["sh", "-c", service.partition(":")[-1]], stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if service.startswith("shell:") else subprocess.DEVNULL)
+            for chunk in iter(lambda: proc.stdout.read(4096), b""):
+                self.request.sendall(chunk)
+            proc.wait()
+        else:
+            self.fail("unknown service")
+        self.request.shutdown(socket.SHUT_WR)
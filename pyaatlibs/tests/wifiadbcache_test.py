@@ -0,0 +1,81 @@
+import pytest
+
+from pyaatlibs.adbutils import Adb
+from pyaatlibs.wifiadbcache import WifiAdbCache
+
+def test_cache_entries(tmp_path):
+    path = str(tmp_path / "cache" / "wifi_adb_devices.json")
+    cache = WifiAdbCache(path)
+    assert cache.get_ip_infos() == {}
+
+    ip_info = {"addr": "10.0.0.2", "port": "5555"}
+    cache.update("serialno-0", ip_info)
+    cache.update("serialno-1", {"addr": "10.0.0.3", "port": None})
+    assert WifiAdbCache(path).is_validated("serialno-0", ip_info)
+    assert not cache.is_validated("serialno-0", {"addr": "10.0.0.2", "port": "5556"})
+
+    cache.invalidate("serialno-0")
+    assert not cache.is_validated("serialno-0")
+    assert cache.get_ip_infos() == {"serialno-1": {"addr": "10.0.0.3", "port": None}}
+
+    cache.remove("serialno-1")
+    assert list(cache.load().keys()) == ["serialno-0"]
+
+def test_adb_wifi_adb_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(Adb, "SERIAL_TO_IP_INFO", {})
+    path = str(tmp_path / "wifi_adb_devices.json")
+    WifiAdbCache(path).update("serialno-0", {"addr": "10.0.0.2", "port": "5555"})
+
+    Adb.enable_wifi_adb_cache(path=path)
+    try:
+        assert Adb._wifi_adb_addr("serialno-0") == "10.0.0.2:5555"
+        devices = ["10.0.0.2:5555", "10.0.0.3:5555"]
+        assert [device for device, _ in Adb._unknown_wifi_adb_devices(devices)] == \
+            ["10.0.0.3:5555"]
+
+        # a mapping learned by another process is picked up before probing
+        WifiAdbCache(path).update("serialno-1", {"addr": "10.0.0.3", "port": "5555"})
+        assert list(Adb._unknown_wifi_adb_devices(devices)) == []
+
+        # the address now belongs to another device
+        Adb._set_wifi_adb_ip_info("serialno-2", {"addr": "10.0.0.3", "port": "5555"})
+        assert not "serialno-1" in Adb.SERIAL_TO_IP_INFO
+        assert not "serialno-1" in WifiAdbCache(path).load()
+
+        Adb._invalidate_wifi_adb_ip_info("serialno-0")
+        assert Adb._wifi_adb_addr("serialno-0") is None
+        assert [device for device, _ in Adb._unknown_wifi_adb_devices(devices)] == \
+            ["10.0.0.2:5555"]
+    finally:
+        Adb.enable_wifi_adb_cache(False)
+
+def test_wifi_adb_invalidation(tmp_path, monkeypatch):
+    ip_info = {"addr": "10.0.0.2", "port": "5555"}
+    monkeypatch.setattr(Adb, "SERIAL_TO_IP_INFO", {"serialno-0": dict(ip_info)})
+    monkeypatch.setattr(Adb, "HAS_BEEN_INIT", True)
+    monkeypatch.setattr(Adb, "_resolve_serialno",
+        classmethod(lambda child, serialno, tolog=True: "10.0.0.2:5555"))
+    errs = []
+    monkeypatch.setattr(Adb, "_execute",
+        classmethod(lambda child, cmd, serialno=None, tolog=True, timeoutsec=None: ("", errs[-1])))
+
+    # the in-memory mapping is kept without the cache
+    errs.append("error: device '10.0.0.2:5555' not found\n")
+    Adb.execute(["shell", "true"], serialno="serialno-0", tolog=False)
+    assert Adb._wifi_adb_addr("serialno-0") == "10.0.0.2:5555"
+
+    path = str(tmp_path / "wifi_adb_devices.json")
+    WifiAdbCache(path).update("serialno-0", ip_info)
+    Adb.enable_wifi_adb_cache(path=path)
+    try:
+        # the errors printed by the command on the device do not invalidate the mapping
+        errs.append("error: printed by the command\n")
+        Adb.execute(["shell", "true"], serialno="serialno-0", tolog=False)
+        assert Adb._wifi_adb_addr("serialno-0") == "10.0.0.2:5555"
+
+        errs.append("error: closed\n")
+        Adb.execute(["shell", "true"], serialno="serialno-0", tolog=False)
+        assert Adb._wifi_adb_addr("serialno-0") is None
+        assert not WifiAdbCache(path).is_validated("serialno-0")
+    finally:
+        Adb.enable_wifi_adb_cache(False)
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+class WifiAdbCacheLock(object):
+    # An exclusive lock across threads and processes, taken on a sidecar file so that the cache
+    # file itself can be replaced atomically.
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.f = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            self.f = open(self.path, "a+")
+            if fcntl:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            elif msvcrt:
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        except:
+            self._release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+    def _release(self):
+        if self.f is not None:
+            try:
+                if fcntl:
+                    fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+                elif msvcrt:
+                    self.f.seek(0)
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                self.f.close()
+                self.f = None
+        self.thread_lock.release()
+
+# The serialno to Wifi adb address mapping shared by all processes on the host. Each entry is
+# {"ip_info": {"addr": ..., "port": ...}, "validated": <time of the last validation or None>}.
+class WifiAdbCache(object):
+    DEFAULT_PATH = os.path.join(
+        os.path.expanduser("~"), ".cache", "pyaatlibs", "wifi_adb_devices.json")
+
+    def __init__(self, path=None):
+        self.path = path if path else __class__.DEFAULT_PATH
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(dirname, exist_ok=True)
+        self.lock = WifiAdbCacheLock(self.path + ".lock")
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def _write(self, entries):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        with self.lock:
+            return self._read()
+
+    def get_ip_infos(self):
+        # The invalidated mappings are left out until they are validated again
+        return {serialno: dict(entry["ip_info"]) for serialno, entry in self.load().items()
+            if isinstance(entry, dict) and isinstance(entry.get("ip_info"), dict) \
+            and entry.get("validated")}
+
+    def update(self, serialno, ip_info, validated=True):
+        with self.lock:
+            entries = self._read()
+            entries[serialno] = {
+                "ip_info": dict(ip_info),
+                "validated": time.time() if validated else None
+            }
+            self._write(entries)
+
+    def invalidate(self, serialno):
+        with self.lock:
+            entries = self._read()
+            if not serialno in entries:
+                return
+            entries[serialno]["validated"] = None
+            self._write(entries)
+
+    def remove(self, serialno):
+        with self.lock:
+            entries = self._read()
+            if entries.pop(serialno, None) is None:
+                return
+            self._write(entries)
+
+    def is_validated(self, serialno, ip_info=None, max_age_sec=None):
+        entry = self.load().get(serialno)
+        if not isinstance(entry, dict) or not entry.get("validated"):
+            return False
+        if ip_info is not None and entry.get("ip_info") != ip_info:
+            return False
+        if max_age_sec is not None and time.time() - entry["validated"] > max_age_sec:
+            return False
+        return True